@@ -0,0 +1,145 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Benchmark of the chunking and compression settings of HDF5 feature files
+
+The frames of an existing feature file are rewritten with every combination of chunk size and codec, then each
+copy is read back in the two access patterns of our tools:
+ - sequential: the whole file in windows of num_tbins timeslices (HDF5Iterator, inference)
+ - random: windows of num_tbins timeslices starting at random frames (SequentialDataLoader in training)
+
+Example:
+python3 benchmark_hdf5_layout.py Dataset_1/train/left_1.h5 -o /mnt/nas/h5_benchmark --chunk-tbins 1 4 16 \
+    --codecs none lzf gzip:1 gzip:4 --csv layout.csv
+
+Put the output folder on the storage to evaluate (e.g. the NAS). The copies are read right after being written,
+so use files larger than the page cache or drop the caches for cold read numbers.
+"""
+
+import argparse
+import csv
+import os
+import time
+
+import h5py
+import numpy as np
+
+from hdf5_features import FeatureHDF5Writer
+
+
+def parse_codec(codec):
+    """Parses "none", "lzf" or "gzip:<level>" into (compression, compression_level)"""
+    name, _, level = codec.partition(":")
+    return name, int(level) if level else None
+
+
+def rewrite(input_path, output_path, chunk_tbins, compression, compression_level, max_frames=None,
+            read_size=64):
+    """Copies the "data" dataset of a feature file with a new layout, returns the write time in seconds"""
+    with h5py.File(input_path, "r") as f:
+        data = f["data"]
+        num_frames = len(data) if max_frames is None else min(max_frames, len(data))
+        writer = FeatureHDF5Writer(output_path, data.shape[1:], data.dtype, dict(data.attrs),
+                                   chunk_tbins=chunk_tbins, compression=compression,
+                                   compression_level=compression_level)
+        elapsed = 0.
+        for start in range(0, num_frames, read_size):
+            frames = data[start:min(start + read_size, num_frames)]
+            t0 = time.perf_counter()
+            writer.write(frames)
+            elapsed += time.perf_counter() - t0
+        t0 = time.perf_counter()
+        writer.close()
+        elapsed += time.perf_counter() - t0
+    return elapsed
+
+
+def read_sequential(path, num_tbins):
+    """Reads the whole file in windows of num_tbins timeslices, returns the read time in seconds"""
+    t0 = time.perf_counter()
+    with h5py.File(path, "r") as f:
+        data = f["data"]
+        for start in range(0, len(data), num_tbins):
+            data[start:start + num_tbins]
+    return time.perf_counter() - t0
+
+
+def read_random(path, num_tbins, num_reads, seed=0):
+    """Reads num_reads windows of num_tbins timeslices at random positions, returns the read time in seconds"""
+    t0 = time.perf_counter()
+    with h5py.File(path, "r") as f:
+        data = f["data"]
+        starts = np.random.RandomState(seed).randint(0, max(len(data) - num_tbins, 0) + 1, size=num_reads)
+        for start in starts:
+            data[start:start + num_tbins]
+    return time.perf_counter() - t0
+
+
+def benchmark(input_path, output_folder, chunk_tbins_list, codecs, num_tbins=10, num_random_reads=100,
+              max_frames=None, keep=False):
+    """Writes and reads back a feature file with each layout
+
+    Returns:
+        rows (list): one dictionary per (chunk_tbins, codec) with the file size and the throughputs in MB/s of
+            uncompressed frames
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    with h5py.File(input_path, "r") as f:
+        num_frames = len(f["data"]) if max_frames is None else min(max_frames, len(f["data"]))
+        frame_bytes = int(np.prod(f["data"].shape[1:])) * f["data"].dtype.itemsize
+    num_tbins = min(num_tbins, num_frames)
+
+    rows = []
+    for chunk_tbins in chunk_tbins_list:
+        for codec in codecs:
+            compression, compression_level = parse_codec(codec)
+            output_path = os.path.join(output_folder, f"chunk{chunk_tbins}_{codec.replace(':', '')}.h5")
+            write_time = rewrite(input_path, output_path, chunk_tbins, compression, compression_level,
+                                 max_frames=max_frames)
+            sequential_time = read_sequential(output_path, num_tbins)
+            random_time = read_random(output_path, num_tbins, num_random_reads)
+            size = os.path.getsize(output_path)
+            mb = 1e6
+            rows.append({"chunk_tbins": chunk_tbins, "codec": codec,
+                         "size_MB": round(size / mb, 1),
+                         "ratio": round(num_frames * frame_bytes / size, 2),
+                         "write_MB_s": round(num_frames * frame_bytes / mb / write_time, 1),
+                         "sequential_read_MB_s": round(num_frames * frame_bytes / mb / sequential_time, 1),
+                         "random_read_MB_s": round(num_random_reads * num_tbins * frame_bytes / mb / random_time, 1)})
+            print(", ".join(f"{key}: {value}" for key, value in rows[-1].items()))
+            if not keep:
+                os.remove(output_path)
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Compare the write throughput, size and read throughput of HDF5 '
+                                     'feature files for several chunk sizes and codecs.')
+    parser.add_argument('path', help='existing HDF5 feature file whose frames are rewritten')
+    parser.add_argument('-o', '--output-folder', required=True, help='where the rewritten files are written')
+    parser.add_argument('--chunk-tbins', type=int, nargs="+", default=[1, 4, 16],
+                        help='numbers of timeslices per chunk')
+    parser.add_argument('--codecs', nargs="+", default=["none", "lzf", "gzip:1", "gzip:4", "gzip:9"],
+                        help='codecs: none, lzf or gzip:<level>')
+    parser.add_argument('--num-tbins', type=int, default=10, help='number of timeslices per read')
+    parser.add_argument('--num-random-reads', type=int, default=100, help='number of random reads')
+    parser.add_argument('--max-frames', type=int, default=None, help='only rewrite the first frames of the file')
+    parser.add_argument('--keep', action="store_true", help='keep the rewritten files')
+    parser.add_argument('--csv', default="", help='if set, the results are also written in this CSV file')
+    return parser.parse_args(argv) if argv is not None else parser.parse_args()
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    ROWS = benchmark(ARGS.path, ARGS.output_folder, ARGS.chunk_tbins, ARGS.codecs, num_tbins=ARGS.num_tbins,
+                     num_random_reads=ARGS.num_random_reads, max_frames=ARGS.max_frames, keep=ARGS.keep)
+    if ARGS.csv:
+        with open(ARGS.csv, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=list(ROWS[0].keys()))
+            writer.writeheader()
+            writer.writerows(ROWS)
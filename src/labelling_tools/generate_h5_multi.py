@@ -1,57 +1,209 @@
 import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
 import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 from metavision_ml.preprocessing import get_preprocess_function_names, get_preprocess_dict
 from metavision_ml.preprocessing.hdf5 import generate_hdf5
+
+from hdf5_features import generate_hdf5_multi_representation
 """
 Python script to run source code from prophesee metavision sdk module found here :
-https://docs.prophesee.ai/stable/samples/modules/core/file_to_video.html 
+https://docs.prophesee.ai/stable/samples/modules/core/file_to_video.html
 
 python3 generate_hdf5.py EVK_4_LCR_dataset/test/right.raw -o EVK_4_LCR_dataset/test --delta-t 10000 --preprocess histo_quantized --neg_bit_len_quantized 4 --total_bit_len_quantized 8 --normalization_quantized --num-workers
  32 --height_width 360 640
 Usage:
-python3 generate_h5_multi.py -n <name1> <name2> ... -i <num_runs>
+python3 generate_h5_multi.py -d <data_folder> -n <name1> <name2> ... -i <num_runs>
 
 Example:
-python3 raw_to_video.py -n left right center -i 5
+python3 generate_h5_multi.py -d DATASET -n left right center -i 5
+
+The conversion is incremental: a manifest (h5_manifest.json in the data folder) records for each RAW file
+its size, modification time, the preprocessing parameters and the hash of the HDF5 file produced from it.
+Files whose HDF5 is up to date are skipped, so running the script again after adding new recordings only
+converts the new ones. Each HDF5 is written in a temporary folder and moved in place once complete, so a
+conversion interrupted by a crash is simply redone on the next run.
+Several files are converted concurrently in a pool of processes, sharing a global budget of worker processes.
+
+With several representations (e.g. --preprocess event_cube histo_quantized diff_quantized), the events of each
+RAW file are decoded once and every representation is computed from the same time slices. Each one is written
+in its own subfolder of the data folder, e.g. DATASET/event_cube/left_1.h5.
 """
 
-def run_metavision_conversion(data_folder, names, num_runs):
+MANIFEST_NAME = "h5_manifest.json"
+TMP_FOLDER_NAME = ".h5_tmp"
+
+PREPROCESS = "event_cube"
+DELTA_T = 25000
+HEIGHT = 360
+WIDTH = 640
+
+
+# parameters used for each representation of the EVK_4_* datasets
+PREPROCESS_KWARGS = {
+    "event_cube": {"max_incr_per_pixel": 4,
+                   "split_polarity": True,
+                   "preprocess_dtype": np.float32},
+    "diff_quantized": {"negative_bit_length": 4,
+                       "normalization": True,
+                       "preprocess_dtype": np.float32},
+    "histo_quantized": {"negative_bit_length": 4,
+                        "total_bit_length": 8,
+                        "normalization": True,
+                        "preprocess_dtype": np.float32},
+    "multi_channel_timesurface": {"preprocess_dtype": np.float32},
+}
+
+
+def get_preprocess_kwargs(preprocess=PREPROCESS):
+    preprocess_kwargs = get_preprocess_dict(preprocess)['kwargs']
+    preprocess_kwargs.update(PREPROCESS_KWARGS.get(preprocess, {}))
+    return preprocess_kwargs
+
+
+def file_hash(path, block_size=1 << 23):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest(object):
+    """Thread-safe record of the conversions already done in a data folder"""
+
+    def __init__(self, data_folder):
+        self.path = os.path.join(data_folder, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+
+    def is_up_to_date(self, input_file, params, verify_hash=False):
+        entry = self.entries.get(os.path.basename(input_file))
+        if entry is None or entry.get("status") != "done" or "outputs" not in entry:
+            return False
+        stat = os.stat(input_file)
+        if entry["input_size"] != stat.st_size or entry["input_mtime"] != stat.st_mtime_ns \
+                or entry["params"] != params:
+            return False
+        for output in entry["outputs"]:
+            if not os.path.exists(output["path"]) or os.path.getsize(output["path"]) != output["size"]:
+                return False
+            if verify_hash and file_hash(output["path"]) != output["hash"]:
+                return False
+        return True
+
+    def update(self, input_file, **fields):
+        with self._lock:
+            self.entries[os.path.basename(input_file)] = dict(fields)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f, indent=4, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+
+def convert_file(input_file, data_folder, preprocesses):
+    """Converts one RAW file, writing the HDF5 files in a temporary folder before moving them in place
+
+    With a single preprocessing the HDF5 file is written in `data_folder`, with several ones each
+    representation goes in `data_folder/<preprocess name>`. Runs in a worker process, the manifest is
+    updated by the parent process with the returned outputs.
+    """
+    name = os.path.splitext(os.path.basename(input_file))[0]
+    tmp_folder = os.path.join(data_folder, TMP_FOLDER_NAME, name)
+    # leftovers of an interrupted conversion
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+
+    if len(preprocesses) == 1:
+        [(preprocess, preprocess_kwargs)] = preprocesses.items()
+        generate_hdf5(paths=input_file,
+                    output_folder=tmp_folder,
+                    preprocess=preprocess,
+                    delta_t=DELTA_T,
+                    n_processes=1,
+                    height=HEIGHT,
+                    width=WIDTH,
+                    preprocess_kwargs=preprocess_kwargs)
+        tmp_outputs = glob.glob(os.path.join(tmp_folder, "*.h5"))
+        assert len(tmp_outputs) == 1, f"expected one HDF5 file for {input_file}, got {tmp_outputs}"
+        moves = [(tmp_outputs[0], os.path.join(data_folder, os.path.basename(tmp_outputs[0])))]
+    else:
+        [tmp_outputs] = generate_hdf5_multi_representation(input_file, tmp_folder, preprocesses, DELTA_T,
+                                                           height=HEIGHT, width=WIDTH, n_processes=1)
+        moves = [(path, os.path.join(data_folder, preprocess, os.path.basename(path)))
+                 for preprocess, paths in tmp_outputs.items() for path in paths]
+
+    outputs = []
+    for tmp_path, output_file in moves:
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        os.replace(tmp_path, output_file)
+        outputs.append({"path": output_file, "size": os.path.getsize(output_file), "hash": file_hash(output_file)})
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    return outputs
+
+
+def run_metavision_conversion(data_folder, names, num_runs, total_workers=32, max_parallel_files=None, force=False,
+                              verify_hash=False, preprocesses=(PREPROCESS,)):
+    input_files = []
     for name in names:
-        for i in range(1, num_runs + 1):  # Start the loop from 1
-            if num_runs == 0:
+        for i in (range(1, num_runs + 1) if num_runs else [None]):  # Start the loop from 1
+            if i is None:
                 input_file = f"{data_folder}/{name}.raw"
             else:
                 input_file = f"{data_folder}/{name}_{i}.raw"
-            
-            #command = f"{input_file}, -o {data_folder}, --delta-t 10000, --preprocess histo_quantized, --neg_bit_len_quantized 4, --total_bit_len_quantized 8, --normalization_quantized, --num-workers 32, --height_width 360 640"
-            """ preprocess_kwargs = get_preprocess_dict("diff_quantized")['kwargs']
-            preprocess_kwargs.update({"negative_bit_length": 4,
-                            "negative_bit_length": 8,
-                            "normalization": True,
-                            "preprocess_dtype": np.float32}) """
-            
-            preprocess_kwargs = get_preprocess_dict("event_cube")['kwargs']
-            preprocess_kwargs.update({"max_incr_per_pixel": 4,
-                            "split_polarity": True,
-                            "preprocess_dtype": np.float32}) 
-            # preprocess_kwargs = get_preprocess_dict("multi_channel_timesurface")['kwargs']
-            # preprocess_kwargs.update({
-            #                 "preprocess_dtype": np.float32})
+            input_files.append(input_file)
+
+    preprocesses = {preprocess: get_preprocess_kwargs(preprocess) for preprocess in preprocesses}
+    params = json.loads(json.dumps({"preprocesses": preprocesses, "delta_t": DELTA_T, "height": HEIGHT,
+                                    "width": WIDTH}, sort_keys=True, default=str))
+    manifest = Manifest(data_folder)
+
+    todo = []
+    for input_file in input_files:
+        if not os.path.exists(input_file):
+            print(f"Error: {input_file} not found.")
+        elif not force and manifest.is_up_to_date(input_file, params, verify_hash=verify_hash):
+            print(f"{input_file} is up to date, skipped.")
+        else:
+            todo.append(input_file)
+    if not todo:
+        return
+
+    # metavision generate_hdf5 parallelizes across the files it is given, so each file is converted by a
+    # single process and the whole worker budget goes to the pool converting the files concurrently
+    max_parallel_files = max(1, min(max_parallel_files or total_workers, len(todo), total_workers))
+    print(f"Converting {len(todo)} files in {max_parallel_files} worker processes.")
+
+    stats = {}
+    with ProcessPoolExecutor(max_workers=max_parallel_files) as executor:
+        futures = {}
+        for input_file in todo:
+            stat = os.stat(input_file)
+            stats[input_file] = stat
+            manifest.update(input_file, status="in_progress", input_size=stat.st_size,
+                            input_mtime=stat.st_mtime_ns, params=params)
+            futures[executor.submit(convert_file, input_file, data_folder, preprocesses)] = input_file
+        for future in as_completed(futures):
+            input_file = futures[future]
             try:
-                generate_hdf5(paths=input_file,
-                            output_folder=data_folder,
-                            preprocess="event_cube",
-                            delta_t=25000,
-                            n_processes=32, 
-                            height=360,
-                            width=640,
-                            preprocess_kwargs=preprocess_kwargs)
-                
-                print(f"Conversion {name}_{i} completed successfully.")
-            except subprocess.CalledProcessError as e:
-                print(f"Error occurred during conversion {name}_{i}: {e}")
-    
+                outputs = future.result()
+            except (subprocess.CalledProcessError, OSError, AssertionError) as e:
+                print(f"Error occurred during conversion {input_file}: {e}")
+                continue
+            stat = stats[input_file]
+            manifest.update(input_file, status="done", input_size=stat.st_size, input_mtime=stat.st_mtime_ns,
+                            params=params, outputs=outputs)
+            print(f"Conversion {input_file} completed successfully.")
+    shutil.rmtree(os.path.join(data_folder, TMP_FOLDER_NAME), ignore_errors=True)
 
 
 if __name__ == "__main__":
@@ -59,6 +211,18 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--data_folder", type=str, help="Name of dataset folder for converting", required=True)
     parser.add_argument("-n", "--names", nargs="+", help="List of input file prefixes", required=True)
     parser.add_argument("-i", "--num_runs", type=int, help="Number of runs for each input file prefix", required=True)
+    parser.add_argument("-w", "--total_workers", type=int, default=32,
+                        help="Global budget of worker processes, shared by the files converted concurrently")
+    parser.add_argument("-p", "--max_parallel_files", type=int, default=None,
+                        help="Maximum number of files converted concurrently, the worker budget by default")
+    parser.add_argument("--force", action="store_true", help="Convert all the files, even the up to date ones")
+    parser.add_argument("--verify_hash", action="store_true",
+                        help="Also check the hash of existing HDF5 files before skipping them")
+    parser.add_argument("--preprocess", nargs="+", default=[PREPROCESS], choices=get_preprocess_function_names(),
+                        help="Representations to compute. With several ones, the events are decoded only once "
+                             "and each representation is written in its own subfolder")
     args = parser.parse_args()
 
-    run_metavision_conversion(args.data_folder, args.names, args.num_runs)
+    run_metavision_conversion(args.data_folder, args.names, args.num_runs, total_workers=args.total_workers,
+                              max_parallel_files=args.max_parallel_files, force=args.force,
+                              verify_hash=args.verify_hash, preprocesses=args.preprocess)
@@ -13,6 +13,8 @@ import numpy as np
 from metavision_ml.preprocessing import get_preprocess_function_names, get_preprocess_dict
 from metavision_ml.preprocessing.hdf5 import generate_hdf5
 
+from hdf5_features import COMPRESSIONS, generate_hdf5_multi_representation
+
 
 def parse_args(argv=None, only_default_values=False):
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -34,7 +36,9 @@ def parse_args(argv=None, only_default_values=False):
         'files will be produced.')
     parser.add_argument('-n', '--num-workers', type=int, default=2,
                         help='Number of processes used for precomputation')
-    parser.add_argument('--preprocess', default='histo', help='name of the preprocessing function used',
+    parser.add_argument('--preprocess', default=['histo'], nargs="+",
+                        help='name of the preprocessing function used. With several names, the events are decoded '
+                        'once and each representation is written in its own subfolder of the output folder.',
                         choices=get_preprocess_function_names())
     parser.add_argument('--height_width', nargs=2, default=None, type=int,
                         help="if set, downscale the feature tensor to the requested resolution using interpolation"
@@ -70,9 +74,39 @@ def parse_args(argv=None, only_default_values=False):
         "In this mode, event frames are saved in integer values and in original resolution. Thus, "
         "parameter --height_width should not be set")
 
+    parser.add_argument('--chunk-tbins', type=int, default=None,
+                        help="number of timeslices per HDF5 chunk. 1 favours random access to single frames, "
+                        "larger values favour sequential reads of num_tbins timeslices and compress better.")
+    parser.add_argument('--compression', default=None, choices=COMPRESSIONS,
+                        help="HDF5 compression filter. gzip gives the smallest files, lzf is much faster to read "
+                        "and write.")
+    parser.add_argument('--sparse', action="store_true",
+                        help="only store the nonzero voxels of each timeslice (CSR along time). Much smaller files "
+                        "for low activity recordings, read with z2_ml_classification_LCR/sparse_hdf5.py.")
+    parser.add_argument('--compression-level', type=int, default=None, choices=range(10), metavar="[0-9]",
+                        help="gzip compression level")
+
     return parser.parse_args(argv) if argv is not None else parser.parse_args()
 
 
+def get_preprocess_kwargs(preprocess, args):
+    preprocess_kwargs = get_preprocess_dict(preprocess)['kwargs']
+    if "preprocess_dtype" in preprocess_kwargs:
+        preprocess_kwargs.pop('preprocess_dtype')
+    if preprocess == "diff_quantized":
+        preprocess_kwargs.update({"negative_bit_length": args.neg_bit_len_quantized,
+                             "normalization": args.normalization_quantized,
+                             "preprocess_dtype": np.int8 if args.simu_sensor_output_quantized else np.float32})
+    elif preprocess == "histo_quantized":
+        preprocess_kwargs.update({"negative_bit_length": args.neg_bit_len_quantized,
+                             "total_bit_length": args.total_bit_len_quantized,
+                             "normalization": args.normalization_quantized,
+                             "preprocess_dtype": np.uint8 if args.simu_sensor_output_quantized else np.float32})
+    else:
+        preprocess_kwargs.update({"max_incr_per_pixel": args.max_val})
+    return preprocess_kwargs
+
+
 if __name__ == '__main__':
 
     ARGS = parse_args()
@@ -82,25 +116,26 @@ if __name__ == '__main__':
         assert height is None and width is None, "Downsampling is not allowed if we simulate sensor ouput!!!"
         assert not ARGS.normalization_quantized, "Normalization is not allowed if we simulate sensor ouput!!!"
 
-    preprocess_kwargs = get_preprocess_dict(ARGS.preprocess)['kwargs']
-    if "preprocess_dtype" in preprocess_kwargs:
-        preprocess_kwargs.pop('preprocess_dtype')
-    if ARGS.preprocess == "diff_quantized":
-        preprocess_kwargs.update({"negative_bit_length": ARGS.neg_bit_len_quantized,
-                             "normalization": ARGS.normalization_quantized,
-                             "preprocess_dtype": np.int8 if ARGS.simu_sensor_output_quantized else np.float32})
-    elif ARGS.preprocess == "histo_quantized":
-        preprocess_kwargs.update({"negative_bit_length": ARGS.neg_bit_len_quantized,
-                             "total_bit_length": ARGS.total_bit_len_quantized,
-                             "normalization": ARGS.normalization_quantized,
-                             "preprocess_dtype": np.uint8 if ARGS.simu_sensor_output_quantized else np.float32})
+    max_duration = ARGS.max_duration_ms * 1000 if ARGS.max_duration_ms else None
+    custom_layout = ARGS.chunk_tbins is not None or ARGS.compression is not None \
+        or ARGS.compression_level is not None or ARGS.sparse
+    if len(ARGS.preprocess) > 1 or custom_layout:
+        # single pass over the events, one HDF5 file per representation, written with the requested layout
+        assert ARGS.mode == "delta_t", \
+            "only the delta_t mode is available with several preprocessings or a custom chunking or compression"
+        assert not ARGS.store_as_uint8 and not ARGS.box_labels, "--store_as_uint8 and --box-labels are not " \
+            "available with several preprocessings or a custom chunking or compression"
+        preprocesses = {preprocess: get_preprocess_kwargs(preprocess, ARGS) for preprocess in ARGS.preprocess}
+        generate_hdf5_multi_representation(ARGS.path, ARGS.output_folder, preprocesses, ARGS.delta_t,
+                                           height=height, width=width, start_ts=ARGS.start_ts,
+                                           max_duration=max_duration, n_processes=ARGS.num_workers,
+                                           chunk_tbins=ARGS.chunk_tbins or 1,
+                                           compression=ARGS.compression or "none",
+                                           compression_level=ARGS.compression_level, sparse=ARGS.sparse)
     else:
-        preprocess_kwargs.update({"max_incr_per_pixel": ARGS.max_val})
-
-
-    generate_hdf5(ARGS.path, ARGS.output_folder, ARGS.preprocess, ARGS.delta_t,
-                  height=height, width=width, start_ts=ARGS.start_ts,
-                  max_duration=ARGS.max_duration_ms * 1000 if ARGS.max_duration_ms else None,
-                  box_labels=ARGS.box_labels, n_processes=ARGS.num_workers,
-                  store_as_uint8=ARGS.store_as_uint8, mode=ARGS.mode, n_events=ARGS.n_events,
-                  preprocess_kwargs=preprocess_kwargs)
+        generate_hdf5(ARGS.path, ARGS.output_folder, ARGS.preprocess[0], ARGS.delta_t,
+                      height=height, width=width, start_ts=ARGS.start_ts,
+                      max_duration=max_duration,
+                      box_labels=ARGS.box_labels, n_processes=ARGS.num_workers,
+                      store_as_uint8=ARGS.store_as_uint8, mode=ARGS.mode, n_events=ARGS.n_events,
+                      preprocess_kwargs=get_preprocess_kwargs(ARGS.preprocess[0], ARGS))
@@ -0,0 +1,287 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Generation of HDF5 feature files computing several representations in a single pass over the events, with
+a configurable chunk shape and compression
+"""
+
+import math
+import os
+from multiprocessing import Pool
+
+import h5py
+import numpy as np
+
+from metavision_core.event_io import EventsIterator
+from metavision_ml.preprocessing import CDProcessor
+
+COMPRESSIONS = ("none", "gzip", "lzf")
+
+
+class FeatureHDF5Writer(object):
+    """Appends feature frames to the "data" dataset of an HDF5 file
+
+    The attributes follow the ones written by metavision_ml's generate_hdf5, so that the files can be read by
+    HDF5Iterator and SequentialDataLoader.
+
+    Each chunk holds `chunk_tbins` consecutive full frames. One timeslice per chunk is best for random access to
+    single frames (plot_h5.py), larger chunks favour reading sequences of timeslices (HDF5Iterator,
+    SequentialDataLoader) and compress better. The frames are buffered so that every chunk is written, and
+    compressed, only once.
+
+    Args:
+        path (str): output path
+        shape (tuple): shape of one frame (C, H, W)
+        dtype (np.dtype): data type of the frames
+        attrs (dict): attributes of the "data" dataset
+        chunk_tbins (int): number of timeslices per chunk
+        compression (str): "gzip", "lzf" or "none"
+        compression_level (int): gzip level between 0 and 9, only used with gzip
+        size_increment (int): number of frames by which the dataset is grown when full
+    """
+
+    def __init__(self, path, shape, dtype, attrs, chunk_tbins=1, compression="none", compression_level=None,
+                 size_increment=100):
+        assert compression in COMPRESSIONS, f"compression should be one of {COMPRESSIONS}"
+        assert compression_level is None or compression == "gzip", "only gzip has a compression level"
+        shape = tuple(int(d) for d in shape)
+        self.file = h5py.File(path, "w")
+        self.chunk_tbins = chunk_tbins
+        self.size_increment = max(size_increment // chunk_tbins, 1) * chunk_tbins
+        self.dataset = self.file.create_dataset("data", shape=(0,) + shape, maxshape=(None,) + shape,
+                                                dtype=dtype, chunks=(chunk_tbins,) + shape,
+                                                compression=None if compression == "none" else compression,
+                                                compression_opts=compression_level)
+        for key, value in attrs.items():
+            self.dataset.attrs[key] = value
+        self.buffer = np.zeros((chunk_tbins,) + shape, dtype=dtype)
+        self.buffered = 0
+        self.index = 0
+
+    def write(self, frames):
+        """Writes an array of frames of shape (N, C, H, W)"""
+        for frame in frames:
+            self.buffer[self.buffered] = frame
+            self.buffered += 1
+            if self.buffered == self.chunk_tbins:
+                self._flush()
+
+    def _flush(self):
+        end = self.index + self.buffered
+        if end > len(self.dataset):
+            self.dataset.resize(max(end, len(self.dataset) + self.size_increment), axis=0)
+        self.dataset[self.index:end] = self.buffer[:self.buffered]
+        self.index = end
+        self.buffered = 0
+
+    def close(self):
+        if self.buffered:
+            self._flush()
+        self.dataset.resize(self.index, axis=0)
+        self.file.close()
+
+
+class SparseFeatureHDF5Writer(object):
+    """Stores only the nonzero voxels of the feature frames
+
+    The frames are stored in CSR form along time: "indices" holds the flat index c * H * W + y * W + x of
+    every nonzero voxel and "values" its value, frame after frame, and the voxels of frame i are
+    indices[offsets[i]:offsets[i + 1]]. The attributes of the dense files are set on the root group, together
+    with format="sparse_csr". These files are read by z2_ml_classification_LCR/sparse_hdf5.py.
+
+    Args:
+        path (str): output path
+        shape (tuple): shape of one frame (C, H, W)
+        dtype (np.dtype): data type of the frames
+        attrs (dict): attributes of the dense "data" dataset
+        compression (str): "gzip", "lzf" or "none"
+        compression_level (int): gzip level between 0 and 9, only used with gzip
+        chunk_size (int): number of voxels per HDF5 chunk of "indices" and "values"
+    """
+
+    def __init__(self, path, shape, dtype, attrs, compression="none", compression_level=None, chunk_size=1 << 16):
+        assert compression in COMPRESSIONS, f"compression should be one of {COMPRESSIONS}"
+        assert compression_level is None or compression == "gzip", "only gzip has a compression level"
+        assert np.prod(shape) < 2 ** 32, "frames are too large for uint32 indices"
+        self.file = h5py.File(path, "w")
+        filters = dict(compression=None if compression == "none" else compression, compression_opts=compression_level)
+        self.indices = self.file.create_dataset("indices", shape=(0,), maxshape=(None,), dtype=np.uint32,
+                                                chunks=(chunk_size,), **filters)
+        self.values = self.file.create_dataset("values", shape=(0,), maxshape=(None,), dtype=dtype,
+                                               chunks=(chunk_size,), **filters)
+        self.chunk_size = chunk_size
+        self.offsets = [0]
+        self.pending_indices, self.pending_values, self.num_pending = [], [], 0
+        for key, value in attrs.items():
+            self.file.attrs[key] = value
+        self.file.attrs["format"] = "sparse_csr"
+
+    def write(self, frames):
+        """Writes an array of frames of shape (N, C, H, W)"""
+        for frame in frames:
+            flat = frame.reshape(-1)
+            indices = np.flatnonzero(flat).astype(np.uint32)
+            self.pending_indices.append(indices)
+            self.pending_values.append(flat[indices])
+            self.num_pending += len(indices)
+            self.offsets.append(self.offsets[-1] + len(indices))
+            if self.num_pending >= self.chunk_size:
+                self._flush()
+
+    def _flush(self):
+        # voxels are appended by blocks of at least one chunk, so that few chunks are compressed twice
+        if self.num_pending:
+            start = len(self.indices)
+            end = start + self.num_pending
+            self.indices.resize(end, axis=0)
+            self.values.resize(end, axis=0)
+            self.indices[start:end] = np.concatenate(self.pending_indices)
+            self.values[start:end] = np.concatenate(self.pending_values)
+        self.pending_indices, self.pending_values, self.num_pending = [], [], 0
+
+    def close(self):
+        self._flush()
+        self.file.create_dataset("offsets", data=np.array(self.offsets, dtype=np.uint64))
+        self.file.close()
+
+
+def feature_attrs(preprocess, preprocess_kwargs, delta_t, event_input_height, event_input_width, shape):
+    """Attributes of the "data" dataset of a feature file"""
+    attrs = {"events_to_tensor": np.string_(preprocess),
+             "delta_t": np.uint32(delta_t),
+             "event_input_height": event_input_height,
+             "event_input_width": event_input_width,
+             "shape": shape,
+             "store_as_uint8": False,
+             "mode": "delta_t",
+             "n_events": 0}
+    for key, value in preprocess_kwargs.items():
+        attrs[key] = np.string_(np.dtype(value).name) if key == "preprocess_dtype" else value
+    return attrs
+
+
+def _downsampling_factor(sensor_height, sensor_width, height, width):
+    if height is None and width is None:
+        return 0
+    factor = math.log2(sensor_height / height)
+    assert factor == int(factor) and sensor_width / width == sensor_height / height, \
+        "only power of two downscaling of the sensor resolution is possible"
+    return int(factor)
+
+
+def generate_multi_representation(path, output_folder, preprocesses, delta_t, height=None, width=None,
+                                  start_ts=0, max_duration=None, chunk_tbins=1, compression="none",
+                                  compression_level=None, sparse=False):
+    """Computes several representations of a recording, decoding its events only once
+
+    Each time slice of events is given to one CDProcessor per representation and one HDF5 file is written
+    per representation, in `output_folder/<preprocess name>/<recording name>.h5`. With a single representation
+    the file is written directly in `output_folder`. With a max_duration, the recording is split into files of
+    at most max_duration us, named `<recording name>_<start timestamp in us>.h5`.
+
+    Args:
+        path (str): RAW or DAT file
+        output_folder (str): root output folder
+        preprocesses (dict): maps each preprocessing function name to its preprocess_kwargs
+        delta_t (int): duration of a time slice in us
+        height (int): output height, if None the sensor resolution is used
+        width (int): output width, if None the sensor resolution is used
+        start_ts (int): timestamp in us from which the computation begins
+        max_duration (int): maximum duration of an output file in us, the recording is split into several files
+        chunk_tbins (int): number of timeslices per HDF5 chunk
+        compression (str): "gzip", "lzf" or "none"
+        compression_level (int): gzip compression level
+        sparse (boolean): if True, only the nonzero voxels are stored (see SparseFeatureHDF5Writer)
+
+    Returns:
+        outputs (dict): paths of the HDF5 files of each representation, in time order
+    """
+    assert max_duration is None or max_duration >= delta_t, "max_duration should be at least delta_t"
+    mv_it = EventsIterator(path, start_ts=start_ts, delta_t=delta_t)
+    sensor_height, sensor_width = mv_it.get_size()
+    downsampling_factor = _downsampling_factor(sensor_height, sensor_width, height, width)
+    name = os.path.splitext(os.path.basename(path))[0]
+
+    processors = {}
+    outputs = {}
+    for preprocess, preprocess_kwargs in preprocesses.items():
+        processor = CDProcessor(sensor_height, sensor_width, num_tbins=1, preprocessing=preprocess,
+                                downsampling_factor=downsampling_factor, preprocess_kwargs=preprocess_kwargs)
+        frame = processor.init_output_tensor()
+        folder = os.path.join(output_folder, preprocess) if len(preprocesses) > 1 else output_folder
+        os.makedirs(folder, exist_ok=True)
+        attrs = feature_attrs(preprocess, preprocess_kwargs, delta_t, sensor_height, sensor_width, frame.shape[1:])
+        processors[preprocess] = (processor, frame, folder, attrs)
+        outputs[preprocess] = []
+
+    def open_writers(file_start_ts):
+        writers = {}
+        for preprocess, (_, frame, folder, attrs) in processors.items():
+            file_name = name + (f"_{file_start_ts}" if max_duration is not None else "") + ".h5"
+            outputs[preprocess].append(os.path.join(folder, file_name))
+            if sparse:
+                writers[preprocess] = SparseFeatureHDF5Writer(outputs[preprocess][-1], frame.shape[1:],
+                                                              frame.dtype, attrs, compression=compression,
+                                                              compression_level=compression_level)
+            else:
+                writers[preprocess] = FeatureHDF5Writer(outputs[preprocess][-1], frame.shape[1:], frame.dtype,
+                                                        attrs, chunk_tbins=chunk_tbins, compression=compression,
+                                                        compression_level=compression_level)
+        return writers
+
+    file_start_ts = start_ts
+    writers = open_writers(file_start_ts)
+    try:
+        for events in mv_it:
+            cur_frame_start_ts = mv_it.get_current_time() - delta_t
+            if max_duration is not None and cur_frame_start_ts >= file_start_ts + max_duration:
+                for writer in writers.values():
+                    writer.close()
+                writers = {}
+                file_start_ts = cur_frame_start_ts
+                writers = open_writers(file_start_ts)
+            for preprocess, (processor, frame, _, _) in processors.items():
+                frame[...] = 0
+                processor.process_events(cur_frame_start_ts, events, frame)
+                writers[preprocess].write(frame)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return outputs
+
+
+def _generate_one(kwargs):
+    return generate_multi_representation(**kwargs)
+
+
+def generate_hdf5_multi_representation(paths, output_folder, preprocesses, delta_t, height=None, width=None,
+                                       start_ts=0, max_duration=None, n_processes=2, chunk_tbins=1,
+                                       compression="none", compression_level=None, sparse=False):
+    """Runs `generate_multi_representation` on several files with a pool of processes
+
+    Args:
+        paths (list): RAW or DAT files
+        start_ts (int or list): a single timestamp for all files or one per file
+        n_processes (int): number of files processed in parallel
+        (the other arguments are the ones of `generate_multi_representation`)
+
+    Returns:
+        outputs (list): for each file, the paths of the HDF5 files of each representation
+    """
+    paths = [paths] if isinstance(paths, str) else list(paths)
+    start_ts = list(start_ts) if isinstance(start_ts, (list, tuple)) else [start_ts]
+    if len(start_ts) == 1:
+        start_ts = start_ts * len(paths)
+    assert len(start_ts) == len(paths), "either a single start_ts or one per input file"
+    jobs = [dict(path=path, output_folder=output_folder, preprocesses=preprocesses, delta_t=delta_t, height=height,
+                 width=width, start_ts=ts, max_duration=max_duration, chunk_tbins=chunk_tbins,
+                 compression=compression, compression_level=compression_level, sparse=sparse)
+            for path, ts in zip(paths, start_ts)]
+    if n_processes <= 1 or len(jobs) == 1:
+        return [_generate_one(job) for job in jobs]
+    with Pool(min(n_processes, len(jobs))) as pool:
+        return pool.map(_generate_one, jobs)
@@ -2,6 +2,10 @@
 
 import argparse
 import os
+import queue
+import sys
+import threading
+import time
 import numpy as np
 import cv2
 import torch
@@ -15,8 +19,17 @@ import glob
 from collections import deque
 
 import rclpy
+from rclpy.callback_groups import MutuallyExclusiveCallbackGroup
+from rclpy.executors import MultiThreadedExecutor
 from rclpy.node import Node
-from std_msgs.msg import Int32
+from rclpy.qos import DurabilityPolicy, HistoryPolicy, QoSProfile, ReliabilityPolicy
+from rclpy.utilities import remove_ros_args
+from classification_msgs.msg import ClassificationResult, EventPacket, LabelMap
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+
+from .event_topic import EVENT_QOS, EventTopicIterator
+
+WINDOW_NAME = "Gesture Recognition"
 
 
 def viz_histo_filtered(im, val_max=0.5):
@@ -38,6 +51,9 @@ def inference_parser():
                         help='RAW, HDF5 or DAT filename, leave blank to use a camera. '
                              'Warning if you use an HDF5 file the parameters used for pre-computation must '
                              'match those of the model.')
+    parser.add_argument('--event-topic', type=str, default="",
+                        help='if set, the events are received as EventPacket messages on this '
+                             'topic instead of being read from --path or a camera')
     parser.add_argument('--delta-t', type=int, default=50000,
                         help='duration of timeslice (in us) in which events are accumulated to compute features.')
     parser.add_argument('--start-ts', type=int, default=0,
@@ -82,18 +98,24 @@ def _proc(
         video_process=None,
         h5writer=None,
         publisher=None,
+        stop_event=None,
 ):
     COLOR = (0, 255, 0)
     FONT = cv2.FONT_HERSHEY_SIMPLEX
     nb_consecutive_low_activity_frames = 0
-    if args.display:
-        WINDOW_NAME = "Gesture Recognition"
+    # HighGUI must stay on the main thread: with a publisher, _proc runs in the worker thread of
+    # the node and the frames are shown by the main loop
+    show_window = args.display and publisher is None
+    if show_window:
         cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
 
     if args.use_FF_model:
         Q = deque(maxlen=args.max_rolling_window)
 
-    for tensor in preprocessor:
+    start_ts = 0 if args.path.endswith('h5') else args.start_ts
+    for i, tensor in enumerate(preprocessor):
+        if stop_event is not None and stop_event.is_set():
+            break
         do_reset = False
         if not args.use_FF_model:
             tensor = tensor[None]
@@ -122,24 +144,34 @@ def _proc(
             yhat_indice = np.argmax(yhat, axis=-1)
         yhat_cls = model_json["label_map"][yhat_indice]
         model_predictions = f"[Background : {yhat[0]:.2f}] [Left : {yhat[1]:.2f}] [Center :  {yhat[2]:.2f}] [Right :  {yhat[3]:.2f}]"
-        print(model_predictions)
+        # the publisher logs the predictions at a limited rate
+        if publisher is None:
+            print(model_predictions)
         # filter out background and predictions with low confidence value
-        if yhat[yhat_indice] >= args.cls_threshold and yhat_indice != 0:
+        accepted = yhat[yhat_indice] >= args.cls_threshold and yhat_indice != 0
+        if accepted:
             cv2.putText(img, yhat_cls, (10, img.shape[0] - 60), FONT, 0.5, COLOR)
             cv2.putText(img, "Score: {:.2f}".format(yhat[yhat_indice]), (10, img.shape[0] - 20), FONT, 0.5, COLOR)
         
-        # Publish yhat_cls to ROS 2 topic
+        # Publish the result to ROS 2 topic
         if publisher is not None:
-            publisher.publish(int(yhat_indice))
+            if hasattr(preprocessor, "get_time"):
+                frame_start_ts = preprocessor.get_time() - args.delta_t
+            else:
+                frame_start_ts = start_ts + i * args.delta_t
+            publisher.publish(frame_start_ts, frame_start_ts + args.delta_t, yhat, yhat_indice,
+                              accepted, do_reset)
 
         if do_reset and args.display_reset_memory:
             cv2.putText(img, "RESET MEMORY", (10, 20), FONT, 0.4, COLOR)
         
-        if args.display:
+        if show_window:
             cv2.imshow(WINDOW_NAME, img[..., ::-1])
             key = cv2.waitKey(1)
             if key == 27 or key == ord("q"):
                 break
+        elif args.display:
+            publisher.show(img)
 
         if video_process is not None:
             video_process.writeFrame(img)
@@ -149,27 +181,233 @@ def _proc(
 
 
 class ModelPublisher(Node):
+    """Node running the inference in a worker thread and publishing its results from the executor
+
+    The worker pushes each result in a bounded queue, dropping the oldest one when the queue is
+    full, and a timer drains the queue and publishes. The node thus keeps servicing its callbacks,
+    parameters and shutdown while classifying, and the publish latency and dropped results are
+    reported on /diagnostics. The visualization frames of the worker are shown by the main thread
+    with `display`, since OpenCV windows can't be driven from another thread.
+
+    The results are ClassificationResult messages published with a best effort, keep last QoS: at
+    100 Hz a late result is better dropped than retransmitted. The class names are not repeated in
+    every result, they are published once as a LabelMap on the transient local topic
+    classify_label_map.
+
+    ROS parameters:
+        queue_size (int): number of results waiting to be published before the oldest is dropped
+        publish_period (float): period in s of the timer publishing the queued results
+        diagnostics_period (float): period in s of the diagnostics
+        qos_depth (int): depth of the QoS history of the results
+        log_period (float): minimum period in s between two logs of the published results
+        event_queue_size (int): number of EventPacket messages waiting to be processed before the
+            oldest is dropped
+    """
+
     def __init__(self):
         super().__init__('model_publisher')
-        self.publisher_ = self.create_publisher(Int32, 'classify_results', 10)
-
-    def publish(self, yhat_cls):
-        msg = Int32()
-        msg.data = yhat_cls
-        self.publisher_.publish(msg)
-        self.get_logger().info(f'Publishing: {yhat_cls}')
+        self.declare_parameter('queue_size', 8)
+        self.declare_parameter('publish_period', 0.005)
+        self.declare_parameter('diagnostics_period', 1.0)
+        self.declare_parameter('qos_depth', 5)
+        self.declare_parameter('log_period', 1.0)
+        self.declare_parameter('event_queue_size', 1000)
+        qos = QoSProfile(reliability=ReliabilityPolicy.BEST_EFFORT,
+                         durability=DurabilityPolicy.VOLATILE,
+                         history=HistoryPolicy.KEEP_LAST,
+                         depth=self.get_parameter('qos_depth').value)
+        self.publisher_ = self.create_publisher(ClassificationResult, 'classify_results', qos)
+        # latched: late subscribers still receive the label map
+        label_map_qos = QoSProfile(reliability=ReliabilityPolicy.RELIABLE,
+                                   durability=DurabilityPolicy.TRANSIENT_LOCAL,
+                                   history=HistoryPolicy.KEEP_LAST, depth=1)
+        self.label_map_publisher = self.create_publisher(LabelMap, 'classify_label_map',
+                                                         label_map_qos)
+        self.label_map = []
+        self.log_period = self.get_parameter('log_period').value
+        self.diagnostics_publisher = self.create_publisher(DiagnosticArray, '/diagnostics', 1)
+
+        self.results = queue.Queue(maxsize=self.get_parameter('queue_size').value)
+        self.stop_event = threading.Event()
+        self.worker = None
+        self._lock = threading.Lock()
+        self.num_published = 0
+        self.num_dropped = 0
+        self._latencies = []
+        self._window_dropped = 0
+        self.event_packets = queue.Queue(maxsize=self.get_parameter('event_queue_size').value)
+        self.num_dropped_packets = 0
+        # only the latest visualization frame is worth showing
+        self.frames = queue.Queue(maxsize=1)
+
+        # the publishing and diagnostics callbacks can run concurrently in the
+        # MultiThreadedExecutor
+        self.create_timer(self.get_parameter('publish_period').value, self._publish_results,
+                          callback_group=MutuallyExclusiveCallbackGroup())
+        self.create_timer(self.get_parameter('diagnostics_period').value,
+                          self._publish_diagnostics,
+                          callback_group=MutuallyExclusiveCallbackGroup())
+
+    def start(self, args):
+        """Starts the inference on `args.path` or `args.event_topic` in a worker thread"""
+        if args.event_topic:
+            self.create_subscription(EventPacket, args.event_topic, self._on_event_packet,
+                                     EVENT_QOS, callback_group=MutuallyExclusiveCallbackGroup())
+        self.worker = threading.Thread(target=self._work, args=(args,), name="inference",
+                                       daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.worker is not None:
+            self.worker.join()
+
+    def done(self):
+        """True once the worker has finished and every queued result has been published"""
+        return self.worker is not None and not self.worker.is_alive() and self.results.empty()
+
+    def show(self, img):
+        """Queues a visualization frame for the main thread, called from the worker thread"""
+        try:
+            self.frames.get_nowait()
+        except queue.Empty:
+            pass
+        self.frames.put_nowait(img)
+
+    def display(self):
+        """Shows the latest visualization frame, must be called from the main thread
+
+        Returns False once the user has asked to quit the display with q or escape.
+        """
+        try:
+            img = self.frames.get_nowait()
+            cv2.imshow(WINDOW_NAME, img[..., ::-1])
+        except queue.Empty:
+            pass
+        key = cv2.waitKey(1)
+        return key != 27 and key != ord("q")
+
+    def _on_event_packet(self, msg):
+        try:
+            self.event_packets.put_nowait(msg)
+        except queue.Full:
+            self.event_packets.get_nowait()
+            with self._lock:
+                self.num_dropped_packets += 1
+            self.event_packets.put_nowait(msg)
+
+    def _work(self, args):
+        try:
+            run(args, self, stop_event=self.stop_event, event_packets=self.event_packets)
+        except Exception as e:
+            self.get_logger().error(f'Inference stopped: {e}')
+            raise
+
+    def publish_label_map(self, label_map):
+        """Publishes the class names once, called from the worker thread with the model loaded"""
+        self.label_map = list(label_map)
+        msg = LabelMap(label_map=self.label_map)
+        msg.header.stamp = self.get_clock().now().to_msg()
+        self.label_map_publisher.publish(msg)
+
+    def publish(self, start_ts, end_ts, yhat, yhat_indice, accepted, reset):
+        """Queues the result of a timeslice, called from the worker thread"""
+        msg = ClassificationResult()
+        msg.start_ts = int(start_ts)
+        msg.end_ts = int(end_ts)
+        msg.scores = yhat.astype(np.float32).tolist()
+        msg.decision = int(yhat_indice)
+        msg.decision_score = float(yhat[yhat_indice])
+        msg.accepted = bool(accepted)
+        msg.reset = bool(reset)
+        item = (msg, time.perf_counter())
+        try:
+            self.results.put_nowait(item)
+        except queue.Full:
+            # the oldest result is the least useful one, it is dropped to keep the latency bounded
+            try:
+                self.results.get_nowait()
+                with self._lock:
+                    self.num_dropped += 1
+                    self._window_dropped += 1
+            except queue.Empty:
+                pass
+            self.results.put_nowait(item)
+
+    def _publish_results(self):
+        while True:
+            try:
+                msg, produced = self.results.get_nowait()
+            except queue.Empty:
+                return
+            msg.header.stamp = self.get_clock().now().to_msg()
+            self.publisher_.publish(msg)
+            with self._lock:
+                self.num_published += 1
+                self._latencies.append(time.perf_counter() - produced)
+            self.get_logger().info(
+                f'Publishing [{msg.start_ts}, {msg.end_ts}): {self.label_map[msg.decision]} '
+                f'{msg.decision_score:.2f}' + (' (reset)' if msg.reset else ''),
+                throttle_duration_sec=self.log_period)
+
+    def _publish_diagnostics(self):
+        with self._lock:
+            latencies_ms = np.array(self._latencies) * 1000
+            window_dropped = self._window_dropped
+            self._latencies, self._window_dropped = [], 0
+            num_published, num_dropped = self.num_published, self.num_dropped
+
+        status = DiagnosticStatus(name=f'{self.get_name()}: inference',
+                                  hardware_id=self.get_name())
+        status.level = DiagnosticStatus.WARN if window_dropped else DiagnosticStatus.OK
+        status.message = f'{window_dropped} results dropped' if window_dropped else 'OK'
+        values = {
+            'published': num_published,
+            'dropped': num_dropped,
+            'dropped_event_packets': self.num_dropped_packets,
+            'event_queue_depth': self.event_packets.qsize(),
+            'queue_depth': self.results.qsize(),
+            'publish_rate_hz': len(latencies_ms) / self.get_parameter('diagnostics_period').value,
+            'publish_latency_mean_ms': latencies_ms.mean() if len(latencies_ms) else 0.,
+            'publish_latency_p95_ms': np.percentile(latencies_ms, 95) if len(latencies_ms) else 0.,
+            'publish_latency_max_ms': latencies_ms.max() if len(latencies_ms) else 0.,
+            'worker_alive': self.worker is not None and self.worker.is_alive(),
+        }
+        status.values = [KeyValue(key=key,
+                                  value=f'{value:.3f}' if isinstance(value, float) else str(value))
+                         for key, value in values.items()]
+        msg = DiagnosticArray(status=[status])
+        msg.header.stamp = self.get_clock().now().to_msg()
+        self.diagnostics_publisher.publish(msg)
 
 
 def main(args=None):
     rclpy.init(args=args)
     model_publisher = ModelPublisher()
-    args = inference_parser().parse_args()
-    run(args, model_publisher)
-    rclpy.spin(model_publisher)
-    rclpy.shutdown()
+    args = inference_parser().parse_args(remove_ros_args(args=sys.argv)[1:])
+    executor = MultiThreadedExecutor()
+    executor.add_node(model_publisher)
+    if args.display:
+        cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
+    model_publisher.start(args)
+    try:
+        while rclpy.ok() and not model_publisher.done():
+            executor.spin_once(timeout_sec=0.01 if args.display else 0.1)
+            if args.display and not model_publisher.display():
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        model_publisher.stop()
+        if args.display:
+            cv2.destroyAllWindows()
+        executor.shutdown()
+        model_publisher.destroy_node()
+        if rclpy.ok():
+            rclpy.shutdown()
 
 
-def run(args, publisher):
+def run(args, publisher, stop_event=None, event_packets=None):
     # Load the network
     model_file = glob.glob(os.path.join(args.torchscript_dir, "*.ptjit"))
     assert len(model_file) == 1, "more than one torchjit models is ambiguous"
@@ -179,6 +417,7 @@ def run(args, publisher):
     json_file = json_file[0]
     with open(json_file, "r") as jfile:
         model_json = json.load(jfile)
+    publisher.publish_label_map(model_json["label_map"])
 
     # Get delta t
     if model_json['delta_t'] != args.delta_t:
@@ -211,7 +450,11 @@ def run(args, publisher):
         preprocess_kwargs.update({'max_incr_per_pixel': max_incr_per_pixel})
     
     # Process the events
-    if args.path.endswith('h5'):
+    if args.event_topic:
+        preprocessor = EventTopicIterator(
+            event_packets, model_json["preprocess"], args.delta_t, device=device, height=height,
+            width=width, preprocess_kwargs=preprocess_kwargs, stop_event=stop_event)
+    elif args.path.endswith('h5'):
         preprocessor = HDF5Iterator(args.path, device=device, height=height, width=width)
         preprocessor.checks(model_json["preprocess"], delta_t=args.delta_t)
     else:
@@ -254,7 +497,8 @@ def run(args, publisher):
         args=args,
         video_process=process,
         h5writer=h5w,
-        publisher=publisher
+        publisher=publisher,
+        stop_event=stop_event
     )
 
     # close everything
@@ -271,7 +515,7 @@ def run(args, publisher):
         cls_h5.create_dataset("cls_end_ts", data=cls_end_ts_np, compression="gzip")
         cls_h5.close()
 
-    if args.display:
+    if args.display and publisher is None:
         cv2.destroyAllWindows()
 
 
@@ -0,0 +1,114 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+
+"""Node replaying a RAW, DAT or numpy event file as EventPacket messages, at N times real time."""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import rclpy
+from metavision_core.event_io import EventsIterator
+from rclpy.node import Node
+from rclpy.utilities import remove_ros_args
+
+from classification_msgs.msg import EventPacket
+
+from .event_topic import EVENT_QOS, events_to_packet
+
+
+def replay_parser():
+    parser = argparse.ArgumentParser(
+        description='Publish the events of a file as EventPacket messages',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('path', type=str, help='RAW, DAT or .npy file of EventCD')
+    parser.add_argument('--topic', type=str, default='events',
+                        help='topic of the EventPacket messages')
+    parser.add_argument('--packet-duration', type=int, default=1000,
+                        help='duration of the events of a packet in us')
+    parser.add_argument('--speed', type=float, default=1.,
+                        help='replay speed, 1 for real time, 0 to publish as fast as possible')
+    parser.add_argument('--height-width', dest='hw', nargs=2, default=None, type=int,
+                        help='sensor resolution of a .npy file, defaults to the extent of its '
+                             'coordinates')
+    parser.add_argument('--loop', action='store_true', help='replay the file in a loop')
+    return parser
+
+
+def npy_packets(path, packet_duration):
+    """Splits the events of a numpy file in packets of packet_duration us."""
+    events = np.load(path)
+    if not len(events):
+        return
+    first = int(events['t'][0]) // packet_duration * packet_duration
+    for start in range(first, int(events['t'][-1]) + 1, packet_duration):
+        lo, hi = np.searchsorted(events['t'], [start, start + packet_duration])
+        yield events[lo:hi]
+
+
+class EventReplay(Node):
+    """Publisher of the events of a file, packet by packet, paced on their timestamps."""
+
+    def __init__(self, args):
+        super().__init__('event_replay')
+        self.args = args
+        self.publisher_ = self.create_publisher(EventPacket, args.topic, EVENT_QOS)
+        if args.path.endswith('.npy'):
+            if args.hw:
+                self.height, self.width = args.hw
+            else:
+                events = np.load(args.path, mmap_mode='r')
+                self.height, self.width = int(events['y'].max()) + 1, int(events['x'].max()) + 1
+        else:
+            self.height, self.width = EventsIterator(args.path).get_size()
+
+    def packets(self):
+        if self.args.path.endswith('.npy'):
+            return npy_packets(self.args.path, self.args.packet_duration)
+        return EventsIterator(self.args.path, mode='delta_t', delta_t=self.args.packet_duration)
+
+    def replay(self):
+        """Publishes the file once, returns False if interrupted."""
+        wall_start, t_start = time.perf_counter(), None
+        num_events = 0
+        for events in self.packets():
+            if not rclpy.ok():
+                return False
+            if not len(events):
+                continue
+            if t_start is None:
+                t_start = int(events['t'][0])
+            if self.args.speed > 0:
+                # the packet is sent once the wall clock reaches the timestamp of its last event
+                stream_time = (int(events['t'][-1]) - t_start) * 1e-6 / self.args.speed
+                delay = stream_time - (time.perf_counter() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+            msg = events_to_packet(events, self.height, self.width)
+            msg.header.stamp = self.get_clock().now().to_msg()
+            self.publisher_.publish(msg)
+            num_events += len(events)
+            rclpy.spin_once(self, timeout_sec=0)
+        elapsed = time.perf_counter() - wall_start
+        self.get_logger().info(f'{num_events} events replayed in {elapsed:.2f}s '
+                               f'({num_events / max(elapsed, 1e-9) / 1e6:.2f} Mev/s)')
+        return True
+
+
+def main(args=None):
+    rclpy.init(args=args)
+    args = replay_parser().parse_args(remove_ros_args(args=sys.argv)[1:])
+    node = EventReplay(args)
+    try:
+        while node.replay() and args.loop:
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        node.destroy_node()
+        if rclpy.ok():
+            rclpy.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+
+"""Conversion of event arrays to EventPacket messages and tensors from an EventPacket topic."""
+
+import array
+import math
+import queue
+
+import numpy as np
+import torch
+from metavision_ml.preprocessing import CDProcessor
+from metavision_sdk_base import EventCD
+from rclpy.qos import DurabilityPolicy, HistoryPolicy, QoSProfile, ReliabilityPolicy
+
+from classification_msgs.msg import EventPacket
+
+# events lost in transit would bias the tensors, the packets are therefore sent reliably
+EVENT_QOS = QoSProfile(reliability=ReliabilityPolicy.RELIABLE,
+                       durability=DurabilityPolicy.VOLATILE,
+                       history=HistoryPolicy.KEEP_LAST, depth=100)
+
+
+def _sequence(typecode, values, dtype):
+    """array.array of the typecode of a ROS sequence field, which rclpy accepts unlike ndarrays."""
+    return array.array(typecode, np.ascontiguousarray(values, dtype=dtype).tobytes())
+
+
+def events_to_packet(events, height, width):
+    """Packs an array of EventCD into an EventPacket message."""
+    msg = EventPacket()
+    msg.height = height
+    msg.width = width
+    msg.time_base = int(events['t'][0]) if len(events) else 0
+    msg.t = _sequence('I', events['t'] - msg.time_base, np.uint32)
+    msg.x = _sequence('H', events['x'], np.uint16)
+    msg.y = _sequence('H', events['y'], np.uint16)
+    msg.p = _sequence('B', events['p'], np.uint8)
+    return msg
+
+
+def packet_to_events(msg):
+    """Unpacks an EventPacket message into an array of EventCD."""
+    events = np.empty(len(msg.t), dtype=EventCD)
+    events['t'] = np.asarray(msg.t, dtype=np.int64) + msg.time_base
+    events['x'] = np.asarray(msg.x)
+    events['y'] = np.asarray(msg.y)
+    events['p'] = np.asarray(msg.p)
+    return events
+
+
+class EventTopicIterator(object):
+    """Iterator of tensors computed from the events received on an EventPacket topic.
+
+    The packets put in `packets` by the subscription callback are consumed by the iterator,
+    which accumulates their events into consecutive slices of delta_t us, the first slice
+    starting at the first received timestamp rounded down to a multiple of delta_t. A slice is
+    processed once an event of a later slice is received. A packet older than the current slice
+    restarts the slices from its timestamps.
+
+    Args:
+        packets (queue.Queue): EventPacket messages received on the topic
+        preprocess (str): name of the preprocessing function
+        delta_t (int): duration of a slice in us
+        device (torch.device): device of the tensors
+        height (int): output height, if None the sensor resolution is used
+        width (int): output width, if None the sensor resolution is used
+        preprocess_kwargs (dict): parameters of the preprocessing function
+        stop_event (threading.Event): the iteration ends once it is set
+    """
+
+    def __init__(self, packets, preprocess, delta_t, device=torch.device('cpu'), height=None,
+                 width=None, preprocess_kwargs={}, stop_event=None):
+        self.packets = packets
+        self.preprocess = preprocess
+        self.delta_t = delta_t
+        self.device = device
+        self.height = height
+        self.width = width
+        self.preprocess_kwargs = preprocess_kwargs
+        self.stop_event = stop_event
+        self.processor = None
+        self.current_time = 0
+
+    def get_time(self):
+        return self.current_time
+
+    def _next_packet(self):
+        while self.stop_event is None or not self.stop_event.is_set():
+            try:
+                return self.packets.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _init_processor(self, msg):
+        downsampling_factor = 0
+        if self.height is not None and self.height != msg.height:
+            downsampling_factor = int(round(math.log2(msg.height / self.height)))
+        self.processor = CDProcessor(msg.height, msg.width, num_tbins=1,
+                                     preprocessing=self.preprocess,
+                                     downsampling_factor=downsampling_factor,
+                                     preprocess_kwargs=self.preprocess_kwargs)
+        self.frame = self.processor.init_output_tensor()
+
+    def _slice_tensor(self, start_ts, events):
+        self.frame[...] = 0
+        self.processor.process_events(start_ts, events, self.frame)
+        self.current_time = start_ts + self.delta_t
+        return torch.from_numpy(self.frame).to(self.device)
+
+    def __iter__(self):
+        buffered = []
+        slice_start = None
+        while True:
+            msg = self._next_packet()
+            if msg is None:
+                return
+            if not len(msg.t):
+                continue
+            if self.processor is None:
+                self._init_processor(msg)
+            events = packet_to_events(msg)
+            if slice_start is not None and events['t'][0] < slice_start:
+                # the timestamps went back, e.g. a replay restarting: the partial slice is
+                # flushed and the slices are anchored on the new timestamps
+                if buffered:
+                    yield self._slice_tensor(slice_start, np.concatenate(buffered))
+                buffered = []
+                slice_start = None
+            if slice_start is None:
+                slice_start = int(events['t'][0]) // self.delta_t * self.delta_t
+
+            # emits every slice ending before the last received event, empty ones included
+            while events['t'][-1] >= slice_start + self.delta_t:
+                slice_end = slice_start + self.delta_t
+                split = np.searchsorted(events['t'], slice_end)
+                buffered.append(events[:split])
+                events = events[split:]
+                yield self._slice_tensor(slice_start, np.concatenate(buffered))
+                buffered = []
+                slice_start = slice_end
+            buffered.append(events)
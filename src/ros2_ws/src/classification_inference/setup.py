@@ -20,7 +20,8 @@ setup(
     tests_require=['pytest'],
     entry_points={
         'console_scripts': [
-            'classification_inference = classification_inference.classification_inference:main'
+            'classification_inference = classification_inference.classification_inference:main',
+            'event_replay = classification_inference.event_replay:main'
         ],
     },
 )
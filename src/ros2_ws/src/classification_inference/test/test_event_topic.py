@@ -0,0 +1,45 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+
+import array
+import itertools
+import queue
+
+import numpy as np
+import pytest
+
+event_topic = pytest.importorskip('classification_inference.event_topic')
+
+
+def _events(num_events=1000, duration=30000, t0=1000000):
+    events = np.zeros(num_events, dtype=event_topic.EventCD)
+    events['t'] = np.sort(np.random.randint(t0, t0 + duration, size=num_events))
+    events['x'] = np.random.randint(0, 640, size=num_events)
+    events['y'] = np.random.randint(0, 480, size=num_events)
+    events['p'] = np.random.randint(0, 2, size=num_events)
+    return events
+
+
+def test_packet_round_trip():
+    events = _events()
+    msg = event_topic.events_to_packet(events, 480, 640)
+    for field, typecode in (('t', 'I'), ('x', 'H'), ('y', 'H'), ('p', 'B')):
+        assert isinstance(getattr(msg, field), array.array)
+        assert getattr(msg, field).typecode == typecode
+    decoded = event_topic.packet_to_events(msg)
+    for field in ('t', 'x', 'y', 'p'):
+        np.testing.assert_array_equal(decoded[field], events[field])
+
+
+def test_topic_iterator_slices():
+    delta_t = 10000
+    events = _events(duration=3 * delta_t, t0=0)
+    packets = queue.Queue()
+    for chunk in np.array_split(events, 7):
+        packets.put(event_topic.events_to_packet(chunk, 480, 640))
+    iterator = event_topic.EventTopicIterator(packets, 'histo', delta_t)
+    # the third slice is only emitted once a later event is received
+    frames = list(itertools.islice(iter(iterator), 2))
+    assert len(frames) == 2
+    assert iterator.get_time() == 2 * delta_t
+    for frame in frames:
+        assert frame.abs().sum().item() > 0
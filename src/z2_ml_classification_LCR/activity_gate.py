@@ -0,0 +1,83 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Activity gating: skips the classifier on idle timeslices
+"""
+
+import threading
+
+import torch
+
+STATISTICS = ("max", "count", "nonzero", "energy")
+
+
+class ActivityGate(object):
+    """Decides from a cheap statistic of a timeslice whether the classifier needs to run on it
+
+    The statistics are:
+     - max: maximum value of the tensor, as for --max-low-activity-tensor
+     - count: sum of the absolute values, proportional to the number of events for histogram like tensors
+     - nonzero: fraction of nonzero voxels
+     - energy: mean absolute value inside the ROI
+
+    Args:
+        statistic (str): one of STATISTICS
+        threshold (float): timeslices whose statistic is below the threshold are idle
+        roi (tuple): optional (x, y, width, height) region on which the statistic is computed
+    """
+
+    def __init__(self, statistic, threshold, roi=None):
+        assert statistic in STATISTICS, f"statistic should be one of {STATISTICS}"
+        self.statistic = statistic
+        self.threshold = threshold
+        self.roi = roi
+        self._lock = threading.Lock()
+        self.num_frames = 0
+        self.num_skipped = 0
+        self.model_time = 0.
+
+    def activity(self, tensor):
+        """Returns the activity statistic of a tensor of shape (..., H, W)"""
+        if self.roi is not None:
+            x, y, w, h = self.roi
+            tensor = tensor[..., y:y + h, x:x + w]
+        if self.statistic == "max":
+            return tensor.max().item()
+        if self.statistic == "count":
+            return tensor.abs().sum().item()
+        if self.statistic == "nonzero":
+            return torch.count_nonzero(tensor).item() / max(tensor.numel(), 1)
+        return tensor.abs().mean().item()
+
+    def is_idle(self, tensor):
+        return self.activity(tensor) < self.threshold
+
+    def record(self, skipped, model_time=0.):
+        """Counts a timeslice, with the duration of the model call in seconds when it wasn't skipped"""
+        with self._lock:
+            self.num_frames += 1
+            if skipped:
+                self.num_skipped += 1
+            else:
+                self.model_time += model_time
+
+    def summary(self):
+        """Skip rate and estimated model time saved by the gate"""
+        with self._lock:
+            num_run = self.num_frames - self.num_skipped
+            mean_model_ms = 1000 * self.model_time / num_run if num_run else 0.
+            return {"frames": self.num_frames,
+                    "skipped": self.num_skipped,
+                    "skip_rate": self.num_skipped / self.num_frames if self.num_frames else 0.,
+                    "mean_model_ms": mean_model_ms,
+                    "saved_ms": self.num_skipped * mean_model_ms}
+
+    def format_summary(self, name=""):
+        s = self.summary()
+        return (f"{name}gate ({self.statistic} < {self.threshold:g}): {s['skipped']}/{s['frames']} timeslices "
+                f"skipped ({100 * s['skip_rate']:.1f}%), model {s['mean_model_ms']:.2f} ms per call, "
+                f"~{s['saved_ms'] / 1000:.2f} s saved")
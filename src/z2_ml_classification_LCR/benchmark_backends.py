@@ -0,0 +1,144 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Per-frame latency and memory of TorchScript and ONNX Runtime on CPU, for each model family
+
+Every family of get_model_names() is built with the hyperparameters of a trained checkpoint (input resolution,
+channels, classes...) and random weights, exported in TorchScript and ONNX, and fed with one timeslice per call
+at its real input shape. The memory is the growth of the resident set size of the process while the model is
+loaded and run, so each backend is measured in a new process.
+
+Example:
+python3 benchmark_backends.py Data_results/EVK_4_LCR/checkpoints/epoch=50.ckpt -o backends.csv --threads 1 4
+"""
+
+import argparse
+import copy
+import csv
+import multiprocessing
+import os
+import queue
+import tempfile
+import time
+
+import numpy as np
+import torch
+from metavision_ml.classification import get_model_class, get_model_names, is_rnn
+
+from classification_inference import load_model
+from export_classifier import export_classifier
+
+
+def rss_mb():
+    """Resident set size of the process in MB"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def _measure(torchscript_dir, backend, num_threads, num_iters, warmup, results):
+    try:
+        results.put(_run_measure(torchscript_dir, backend, num_threads, num_iters, warmup))
+    except Exception as e:
+        results.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def _run_measure(torchscript_dir, backend, num_threads, num_iters, warmup):
+    torch.set_num_threads(num_threads)
+    rss_start = rss_mb()
+    model, model_json = load_model(torchscript_dir, backend, num_threads=num_threads)
+    model.eval()
+    rnn = hasattr(model, "reset_all")
+    channels = model_json["preprocess_channels"] * (1 if rnn else model_json.get("num_ev_reps", 1))
+    x = torch.rand((channels, model_json["height"], model_json["width"]))
+    x = x[None, None] if rnn else x[None]
+    latencies = []
+    with torch.no_grad():
+        for i in range(warmup + num_iters):
+            start = time.perf_counter()
+            model(x)
+            if i >= warmup:
+                latencies.append(1000 * (time.perf_counter() - start))
+    return {"p50_ms": float(np.percentile(latencies, 50)), "p95_ms": float(np.percentile(latencies, 95)),
+            "mean_ms": float(np.mean(latencies)), "fps": 1000 / float(np.mean(latencies)),
+            "rss_mb": rss_mb() - rss_start}
+
+
+def measure(torchscript_dir, backend, num_threads=1, num_iters=200, warmup=20):
+    """Measures the latency and memory of a backend in a child process, so that the backends don't share memory
+
+    Returns:
+        dict: the measures, or an "error" entry if the child process failed
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_measure, args=(torchscript_dir, backend, num_threads, num_iters, warmup,
+                                                     results))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            # the child can die without reporting, e.g. killed or crashed in native code
+            if not process.is_alive():
+                result = {"error": f"the measure process exited with code {process.exitcode}"}
+                break
+    process.join()
+    return result
+
+
+def export_family(checkpoint, family, out_directory):
+    """Exports a model of the family with the hyperparameters of the checkpoint and random weights"""
+    hparams = argparse.Namespace(**copy.deepcopy(torch.load(checkpoint, map_location="cpu")["hyper_parameters"]))
+    if not hasattr(hparams, "preprocess_channels"):
+        hparams.preprocess_channels = hparams.in_channels
+    hparams.models = family
+    model = get_model_class(family)(hparams)
+    export_classifier(model, out_directory, tseq=1, batch_size=1, onnx=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare TorchScript and ONNX Runtime on CPU for each model family',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('checkpoint', type=str, help='trained checkpoint giving the input shape and classes')
+    parser.add_argument('-o', '--output', type=str, default="backends.csv", help='CSV file of the results')
+    parser.add_argument('--families', nargs="+", default=get_model_names(), choices=get_model_names(),
+                        help='model families to benchmark')
+    parser.add_argument('--threads', type=int, nargs="+", default=[1], help='numbers of CPU threads')
+    parser.add_argument('--num-iters', type=int, default=200, help='number of timed forward calls')
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for family in args.families:
+            out_directory = os.path.join(tmp_dir, family)
+            os.makedirs(out_directory)
+            try:
+                export_family(args.checkpoint, family, out_directory)
+            except Exception as e:
+                print(f"{family} can't be exported, skipped: {e}")
+                continue
+            for num_threads in args.threads:
+                for backend in ("torchscript", "onnxruntime"):
+                    result = measure(out_directory, backend, num_threads, args.num_iters)
+                    if "error" in result:
+                        print(f"{family} can't be run with {backend}, skipped: {result['error']}")
+                        continue
+                    rows.append({"family": family, "rnn": is_rnn(family), "backend": backend, "threads": num_threads,
+                                 **{key: round(value, 3) for key, value in result.items()}})
+                    print(f"{family:<24}{backend:>12}{num_threads:>4} threads  p50 {result['p50_ms']:8.3f} ms  "
+                          f"p95 {result['p95_ms']:8.3f} ms  {result['rss_mb']:8.1f} MB")
+
+    with open(args.output, "w", newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=list(rows[0].keys()) if rows else ["family"])
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"results written in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Latency benchmark of the inference for a set of models and timeslice durations
+
+Every (model, delta_t) combination is run headless on the same recording with the per-frame instrumentation of
+classification_inference.py. The percentiles and histograms of each run are written in
+`<output-dir>/<model>_<delta_t>.json` and the percentiles of all the runs are merged in `summary.csv`.
+
+Example:
+python3 benchmark_inference.py test_recording/right.raw Data_results/EVK_4_*/model -o bench/ --delta-t 10000 25000 \
+    --max-duration 10000000 -- --cpu
+
+The events can also be generated at a controlled rate instead of being read from a recording, e.g. to measure the
+latency at 20 Mev/s:
+python3 benchmark_inference.py "" Data_results/EVK_4_*/model -o bench/ -- --cpu --synthetic mixed --synthetic-rate 20
+"""
+
+import argparse
+import csv
+import json
+import os
+
+import torch
+
+from classification_inference import get_sweep_dirs, inference_parser, load_model, run
+
+
+def benchmark_parser():
+    parser = argparse.ArgumentParser(description='Per-stage latency benchmark of the inference',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('path', type=str, help='RAW, DAT or HDF5 recording, "" with --synthetic')
+    parser.add_argument('torchscript_dirs', nargs="+", help='exported model directories or glob patterns')
+    parser.add_argument('-o', '--output-dir', type=str, required=True, help='where the JSON files are written')
+    parser.add_argument('--delta-t', type=int, nargs="+", default=None,
+                        help='timeslice durations in us, defaults to the delta_t of each model')
+    parser.add_argument('--max-duration', type=int, default=None, help='duration of the recording processed in us')
+    parser.add_argument('--torch-threads', type=int, default=None, help='number of torch threads')
+    return parser
+
+
+def benchmark(path, torchscript_dirs, output_dir, delta_ts=None, max_duration=None, inference_args=()):
+    """Runs the instrumented inference for each model and delta_t
+
+    Returns:
+        rows (list): p50, p95 and p99 of each stage for each run
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rows = []
+    for torchscript_dir in torchscript_dirs:
+        backend = inference_parser().parse_known_args([torchscript_dir] + list(inference_args))[0].backend
+        model, model_json = load_model(torchscript_dir, backend)
+        name = os.path.basename(os.path.normpath(torchscript_dir))
+        for delta_t in delta_ts or [model_json["delta_t"]]:
+            json_path = os.path.join(output_dir, f"{name}_{delta_t}.json")
+            argv = [torchscript_dir, "--path", path, "--delta-t", str(delta_t), "--no-display", "--quiet",
+                    "--latency-json", json_path]
+            if max_duration is not None:
+                argv += ["--max-duration", str(max_duration)]
+            args = inference_parser().parse_args(argv + list(inference_args))
+            if hasattr(model, "reset_all"):
+                model.reset_all()
+            run(args, model, model_json)
+
+            with open(json_path, "r") as f:
+                result = json.load(f)
+            row = {"model": name, "preprocess": model_json["preprocess"], "delta_t": delta_t,
+                   "num_frames": result["metadata"]["num_frames"]}
+            for stage, stats in result["stages"].items():
+                for key in ("p50_ms", "p95_ms", "p99_ms"):
+                    row[f"{stage}_{key}"] = round(stats[key], 3)
+            rows.append(row)
+
+    fieldnames = []
+    for row in rows:
+        fieldnames += [key for key in row if key not in fieldnames]
+    with open(os.path.join(output_dir, "summary.csv"), "w", newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+
+def main():
+    args, inference_args = benchmark_parser().parse_known_args()
+    inference_args = [arg for arg in inference_args if arg != "--"]
+    if args.torch_threads:
+        torch.set_num_threads(args.torch_threads)
+    torchscript_dirs = get_sweep_dirs(args.torchscript_dirs)
+    assert len(torchscript_dirs) > 0, f"no model found in {args.torchscript_dirs}"
+    benchmark(args.path, torchscript_dirs, args.output_dir, delta_ts=args.delta_t, max_duration=args.max_duration,
+              inference_args=inference_args)
+    print(f"summary written in {os.path.join(args.output_dir, 'summary.csv')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Benchmark of the FLOPs and CPU latency of a classifier on the full input and on regions of interest
+
+Example:
+python3 benchmark_roi.py Model_trained_EVK_4_LCR --roi 160 40 320 280 --roi-bin 1 2 --threads 1 4
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from classification_inference import load_model
+from roi import Roi, roi_from_bbox_labels
+
+
+def count_flops(model, x):
+    """Number of floating point operations of one forward call, as counted by the torch profiler"""
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], with_flops=True) as prof:
+        model(x)
+    return sum(evt.flops for evt in prof.key_averages() if evt.flops)
+
+
+def measure_latency(model, x, num_iters=50, warmup=5, reset=None):
+    """Returns the latencies in ms of `num_iters` forward calls"""
+    latencies = []
+    for i in range(warmup + num_iters):
+        if reset is not None:
+            reset()
+        start = time.perf_counter()
+        model(x)
+        if i >= warmup:
+            latencies.append(1000 * (time.perf_counter() - start))
+    return np.array(latencies)
+
+
+@torch.no_grad()
+def benchmark_rois(model, model_json, rois, threads=(1,), num_iters=50):
+    """Benchmarks a model on the full input and on each region of interest
+
+    Args:
+        model (torch.jit.ScriptModule): classifier
+        model_json (dict): model description
+        rois (list): Roi objects, None stands for the full input
+        threads (list): numbers of torch threads
+        num_iters (int): number of timed forward calls
+
+    Returns:
+        rows (list): one dictionary per (roi, number of threads)
+    """
+    model = model.cpu().eval()
+    rnn = hasattr(model, "reset_all")
+    channels = model_json["preprocess_channels"] * (1 if rnn else model_json.get("num_ev_reps", 1))
+    full = torch.rand((channels, model_json["height"], model_json["width"]))
+    rows = []
+    base = {}
+    for roi in rois:
+        tensor = roi(full) if roi is not None else full
+        x = tensor[None, None] if rnn else tensor[None]
+        if rnn:
+            model.reset_all()
+        flops = count_flops(model, x)
+        for num_threads in threads:
+            torch.set_num_threads(num_threads)
+            latencies = measure_latency(model, x, num_iters=num_iters, reset=model.reset_all if rnn else None)
+            p50 = float(np.percentile(latencies, 50))
+            base.setdefault(num_threads, (flops, p50))
+            rows.append({"roi": "full" if roi is None else f"{roi.x},{roi.y},{roi.width},{roi.height}/{roi.bin}",
+                         "input": "x".join(str(d) for d in tensor.shape[-2:]),
+                         "threads": num_threads,
+                         "GFLOPs": flops / 1e9,
+                         "flops_ratio": base[num_threads][0] / flops if flops else float("nan"),
+                         "p50_ms": p50,
+                         "p95_ms": float(np.percentile(latencies, 95)),
+                         "speedup": base[num_threads][1] / p50})
+    return rows
+
+
+def format_rows(rows):
+    header = f"{'roi':<24}{'input':>10}{'threads':>8}{'GFLOPs':>9}{'x fewer':>9}{'p50 ms':>9}{'p95 ms':>9}" \
+             f"{'speedup':>9}"
+    lines = [header, "-" * len(header)]
+    for r in rows:
+        lines.append(f"{r['roi']:<24}{r['input']:>10}{r['threads']:>8}{r['GFLOPs']:>9.3f}{r['flops_ratio']:>9.2f}"
+                     f"{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['speedup']:>9.2f}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the FLOPs and CPU latency of a classifier on the full '
+                                                 'input and on regions of interest',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('torchscript_dir', type=str, help='path to the torchscript model and the json file '
+                                                          'with model description.')
+    parser.add_argument('--roi', type=int, nargs=4, default=None, metavar=("X", "Y", "W", "H"),
+                        help='region of interest in the model input resolution, defaults to the ROI of the model '
+                             'json')
+    parser.add_argument('--roi-labels', type=str, default="",
+                        help='glob pattern of *_bbox.npy label files from which the ROI is computed')
+    parser.add_argument('--roi-bin', type=int, nargs="+", default=[1], help='binning factors to benchmark')
+    parser.add_argument('--threads', type=int, nargs="+", default=[1], help='numbers of torch threads')
+    parser.add_argument('--num-iters', type=int, default=50, help='number of timed forward calls')
+    args = parser.parse_args()
+
+    model, model_json = load_model(args.torchscript_dir)
+    height, width = model_json["height"], model_json["width"]
+    rois = [None]
+    for roi_bin in args.roi_bin:
+        if args.roi:
+            rois.append(Roi(*args.roi, bin=roi_bin))
+        elif args.roi_labels:
+            rois.append(roi_from_bbox_labels(args.roi_labels, height, width, bin=roi_bin))
+        elif model_json.get("roi"):
+            roi = Roi.from_dict(model_json["roi"])
+            rois.append(Roi(roi.x, roi.y, roi.width, roi.height, bin=roi_bin))
+    assert len(rois) > 1, "no ROI given and no ROI in the model json"
+    print(format_rows(benchmark_rois(model, model_json, rois, threads=args.threads, num_iters=args.num_iters)))
+
+
+if __name__ == "__main__":
+    main()
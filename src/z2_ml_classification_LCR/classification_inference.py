@@ -15,12 +15,25 @@ import cv2
 import torch
 import json
 from skvideo.io import FFmpegWriter
-import h5py
-from metavision_ml.data import CDProcessorIterator, HDF5Iterator
-from metavision_ml.utils.h5_writer import HDF5Writer
+from metavision_ml.data import CDProcessorIterator
 from datetime import datetime
 import glob
-from collections import deque
+import threading
+import time
+from collections import deque, namedtuple
+
+from activity_gate import STATISTICS, ActivityGate
+from inference_pipeline import Source, Stage, format_stats
+from jit_optimization import is_channels_last, to_channels_last
+from latency import InstrumentedCDProcessorIterator, LatencyRecorder, synchronize
+from offline_inference import run_offline
+from onnx_backend import BACKENDS, load_onnx_model
+from rnn_state import get_state, is_stateful, load_state_checkpoint, save_state_checkpoint, set_state
+from roi import get_roi
+from score_writers import make_score_sink
+from sparse_hdf5 import make_hdf5_iterator
+from synthetic_events import GESTURES, SyntheticEventsIterator
+from tensor_cache import CachedTensorIterator, TensorCache
 
 
 def viz_histo_filtered(im, val_max=0.5):
@@ -41,6 +54,56 @@ def viz_histo_filtered(im, val_max=0.5):
     return im
 
 
+class HistoRenderer(object):
+    """Same image as viz_histo_filtered, computed without float copies on the CPU
+
+    The difference of the two channels is converted to uint8 on the device of the tensor, through a lookup
+    table for integer tensors, so that only H x W bytes are transferred. The gray image is then expanded to
+    3 channels by OpenCV into one of `num_buffers` preallocated images, used in turn: an image must not be
+    referenced anymore (displayed, encoded) when its buffer comes back.
+
+    Args:
+        val_max (float): cutoff threshold for visualization
+        num_buffers (int): number of preallocated output images
+    """
+
+    def __init__(self, val_max=0.5, num_buffers=4):
+        self.val_max = val_max
+        self.num_buffers = num_buffers
+        self.buffers = []
+        self.index = 0
+        self.luts = {}
+
+    def _lut(self, dtype, device):
+        # gray level of every possible difference of two integers of the tensor dtype
+        key = (dtype, device)
+        if key not in self.luts:
+            info = torch.iinfo(dtype)
+            diffs = torch.arange(info.min - info.max, info.max - info.min + 1, dtype=torch.float32)
+            self.luts[key] = self._to_gray(diffs).to(device), info.max - info.min
+        return self.luts[key]
+
+    def _to_gray(self, diff):
+        diff = diff.clamp(-self.val_max, self.val_max)
+        return ((diff + self.val_max) * (255 / (2 * self.val_max))).to(torch.uint8)
+
+    def __call__(self, tensor):
+        """Renders a tensor of shape (2, H, W) into a (H, W, 3) uint8 image"""
+        if tensor.dtype not in (torch.uint8, torch.int8):
+            gray = self._to_gray(tensor[1].float() - tensor[0].float())
+        else:
+            lut, offset = self._lut(tensor.dtype, tensor.device)
+            gray = lut[tensor[1].long() - tensor[0].long() + offset]
+        gray = gray.cpu().numpy()
+        shape = gray.shape + (3,)
+        if not self.buffers or self.buffers[0].shape != shape:
+            self.buffers = [np.empty(shape, dtype=np.uint8) for _ in range(self.num_buffers)]
+        img = self.buffers[self.index]
+        self.index = (self.index + 1) % self.num_buffers
+        cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB, dst=img)
+        return img
+
+
 def inference_parser():
     parser = argparse.ArgumentParser(description='Perform inference with the classification module',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -63,6 +126,9 @@ def inference_parser():
     parser.add_argument('-t', '--threshold', dest='cls_threshold', default=0.7, type=float,
                         help="classification threshold")
     parser.add_argument("--cpu", action="store_true", help='run on CPU')
+    parser.add_argument("--backend", default="torchscript", choices=BACKENDS,
+                        help='runtime of the model: torchscript, or onnxruntime to run the ONNX graph exported with '
+                             'export_classifier.py --onnx on CPU')
     parser.add_argument("-s", "--save", dest='save_h5', default='',
                         help='Path of the directory to save the result in a hdf5 format')
     parser.add_argument("-w", "--write-video", default='',
@@ -85,138 +151,470 @@ def inference_parser():
                         help='Maximum number of frames for calculating the rolling average of prediction')
     parser.add_argument("--output-csv", type=str, default="",
                     help="Path to a CSV file where classification scores for each frame will be saved")
+    parser.add_argument("--quiet", action="store_true", help="if set, don't print the scores of each frame")
+    # args for the threaded pipeline
+    parser.add_argument('--queue-size', type=int, default=8,
+                        help='Maximum number of frames waiting in front of each stage of the pipeline')
+    parser.add_argument('--lossless-video', action="store_true",
+                        help='if set, the visualization stages block the classifier instead of dropping frames '
+                             'when they are too slow')
+    parser.add_argument('--stats-every', type=int, default=0,
+                        help='if > 0, print the queue depth and latency of each stage every N frames '
+                             '(they are always printed at the end of the run)')
+    # args for the tensor cache
+    parser.add_argument('--tensor-cache', type=str, default="",
+                        help='if set, directory of a cache of the preprocessed tensors of RAW and DAT files. A '
+                             'recording evaluated again with the same preprocessing is read from the cache '
+                             'without decoding the events.')
+    parser.add_argument('--tensor-cache-size-gb', type=float, default=20.,
+                        help='maximum size of the tensor cache, the least recently used entries are removed '
+                             'above it')
+    # args for the sweep mode
+    parser.add_argument('--sweep', nargs="+", default=[],
+                        help='additional torchscript directories (or glob patterns) evaluated on the same tensor '
+                             'stream. They must share the preprocessing settings of the main model. The events '
+                             'are decoded and preprocessed only once, each model writes its own HDF5 and CSV '
+                             'files, suffixed with the name of its directory.')
+    # args for the offline mode
+    parser.add_argument('--offline', action="store_true",
+                        help='process precomputed HDF5 files in batches, without display nor video. --path can '
+                             'then be a directory or a glob pattern. The HDF5 and CSV outputs are written once at '
+                             'the end (--output-csv is a directory if there are several files).')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='in offline mode, number of timeslices classified in a single forward call for FF '
+                             'models, number of recordings processed in parallel for RNN models')
+    parser.add_argument('--seq-len', type=int, default=32,
+                        help='in offline mode, maximum number of consecutive timeslices given to a RNN model in '
+                             'a single forward call')
+    parser.add_argument('--gate', type=str, default=None, choices=STATISTICS,
+                        help='skip the model on idle timeslices, detected with this activity statistic: max '
+                             '(maximum value), count (sum of absolute values), nonzero (fraction of nonzero '
+                             'voxels) or energy (mean absolute value in --gate-roi). Idle timeslices reuse the '
+                             'scores of the first idle timeslice of the idle period and follow the same reset '
+                             'policy as the others.')
+    parser.add_argument('--gate-threshold', type=float, default=None,
+                        help='timeslices whose activity statistic is below this value are idle. Defaults to '
+                             '--max-low-activity-tensor for the max statistic.')
+    parser.add_argument('--gate-roi', type=int, nargs=4, default=None, metavar=("X", "Y", "W", "H"),
+                        help='region of the model input on which the activity statistic is computed')
+    parser.add_argument('--roi', type=int, nargs=4, default=None, metavar=("X", "Y", "W", "H"),
+                        help='region of the input tensor (in the model input resolution) given to the model. '
+                             'Overrides the ROI recorded in the model json.')
+    parser.add_argument('--roi-labels', type=str, default="",
+                        help='glob pattern of *_bbox.npy label files from which the ROI is computed, used if --roi '
+                             'is not set')
+    parser.add_argument('--roi-bin', type=int, default=1,
+                        help='binning factor applied to the ROI given by --roi or --roi-labels')
+    parser.add_argument('--output-scores', nargs="+", default=[],
+                        help='additional score files, written as the inference goes. The format is given by the '
+                             'extension: .csv, .h5, .parquet or .arrow (Parquet and Arrow require pyarrow)')
+    parser.add_argument('--flush-every', type=int, default=256,
+                        help='number of frames buffered by the score files before being written to disk')
+    parser.add_argument('--latency-json', type=str, default="",
+                        help='if set, the duration of the ingest, preprocess, host to device copy, forward, '
+                             'postprocess and sink stages of every frame is recorded and their percentiles and '
+                             'histograms are written in this JSON file')
+    parser.add_argument('--state-checkpoint', type=str, default="",
+                        help='hidden state file of RNN models: if it exists the model starts from the state it holds '
+                             'instead of an empty one, and the state is saved in it at the end of the run')
+    parser.add_argument('--state-checkpoint-every', type=int, default=0,
+                        help='if > 0, the hidden state is also saved every this number of frames')
+    parser.add_argument('--resume', action="store_true",
+                        help='start the recording at the timestamp recorded in --state-checkpoint, the CSV and '
+                             'HDF5 score files being continued from its frame')
+    parser.add_argument('--synthetic', type=str, default="", choices=[""] + list(GESTURES),
+                        help='if set, the model is fed with a synthetic event stream of this gesture instead of '
+                             '--path, lasting --max-duration us (10s by default)')
+    parser.add_argument('--synthetic-rate', type=float, default=5.,
+                        help='event rate of the hand in the synthetic stream, in Mev/s')
+    parser.add_argument('--synthetic-noise', type=float, default=0.1,
+                        help='background noise of the synthetic stream in events per pixel per second')
+    parser.add_argument('--synthetic-size', type=int, nargs=2, default=[720, 1280], metavar=("HEIGHT", "WIDTH"),
+                        help='sensor resolution of the synthetic stream')
 
    # args = parser.parse_args()
     return parser
 
 
-@torch.no_grad()
-def _proc(
-        preprocessor,
-        cls_model,
-        model_json,
-        args,
-        video_process=None,
-        h5writer=None,
-):
-    """Sub function performing preprocessing and visualization. """
-    COLOR = (0, 255, 0)
-    FONT = cv2.FONT_HERSHEY_SIMPLEX
-    nb_consecutive_low_activity_frames = 0
-    if args.display:
-        WINDOW_NAME = "Gesture Recognition"
-        cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
+# models of a sweep must be fed with the same tensors
+SHARED_PREPROCESSING_KEYS = ["preprocess", "preprocess_kwargs", "delta_t", "height", "width", "roi"]
+
+FrameResult = namedtuple("FrameResult", ["index", "tensor", "yhat", "yhat_indice", "do_reset", "skipped",
+                                         "start_ts", "end_ts"], defaults=(False, None, None))
 
-    if args.use_FF_model:
-        Q = deque(maxlen=args.max_rolling_window)
 
-    # Initialize a list to store classification scores for each frame
-    # Each element is a dictionary containing frame index and the scores
-    results = []
-    frame_index = 0
+def _format_predictions(yhat):
+    """Formats the classification scores of one frame for the console"""
+    # RNN model
+    try:
+        return f"[Background : {yhat[0]:.2f}] [Left : {yhat[1]:.2f}] [Center :  {yhat[2]:.2f}] " \
+               f"[Right :  {yhat[3]:.2f}]"
+    except IndexError:
+        # FFN model
+        return f"[Left : {yhat[0]:.2f}] [Background : {yhat[1]:.2f}] [Right :  {yhat[2]:.2f}]"
 
-    for tensor in preprocessor:
+
+def _render_frame(result, model_json, args, renderer):
+    """Builds the visualization image of one frame with the prediction overlay"""
+    COLOR = (0, 255, 0)
+    FONT = cv2.FONT_HERSHEY_SIMPLEX
+    img = renderer(result.tensor)
+    yhat, yhat_indice = result.yhat, result.yhat_indice
+    # filter out background and predictions with low confidence value
+    if yhat[yhat_indice] >= args.cls_threshold and yhat_indice != 0:
+        cv2.putText(img, model_json["label_map"][yhat_indice], (10, img.shape[0] - 60), FONT, 0.5, COLOR)
+        cv2.putText(img, "Score: {:.2f}".format(yhat[yhat_indice]), (10, img.shape[0] - 20), FONT, 0.5, COLOR)
+    if result.do_reset and args.display_reset_memory:
+        cv2.putText(img, "RESET MEMORY", (10, 20), FONT, 0.4, COLOR)
+    return img
+
+
+class Classifier(object):
+    """A loaded model with the state it keeps along a stream and its score outputs
+
+    Args:
+        name (str): name of the model, used to label its outputs
+        model (torch.jit.ScriptModule): the classifier
+        model_json (dict): the model description
+        args: parsed arguments of the inference script
+        score_sinks (list): ScoreSink objects, written with the scores of every frame
+        gate (ActivityGate): optional gate skipping the model on idle timeslices
+        keep_tensor (boolean): if True, the results keep the input tensor for the visualization
+        recorder (LatencyRecorder): optional recorder of the forward and postprocess durations
+        state_checkpoint (str): hidden state file of an RNN model, loaded if it exists and saved on close
+        first_frame (int): index of the first frame, the frame of the state checkpoint when resuming
+    """
+
+    def __init__(self, name, model, model_json, args, score_sinks=(), gate=None, keep_tensor=False,
+                 recorder=None, state_checkpoint="", first_frame=0):
+        self.name = name
+        self.model = model
+        self.model_json = model_json
+        self.args = args
+        self.score_sinks = list(score_sinks)
+        self.gate = gate
+        self.keep_tensor = keep_tensor
+        self.recorder = recorder
+        # scores of the first idle timeslice of the current idle period, reused while the gate skips the model
+        self.background = None
+        self.nb_consecutive_low_activity_frames = 0
+        self.frame_index = first_frame
+        if args.use_FF_model:
+            self.Q = deque(maxlen=args.max_rolling_window)
+        self.channels_last = is_channels_last(model_json)
+        self.state_checkpoint = state_checkpoint if is_stateful(model) and isinstance(model, torch.nn.Module) else ""
+        self.end_ts = None
+        if self.state_checkpoint and os.path.isfile(self.state_checkpoint):
+            checkpoint = load_state_checkpoint(self.state_checkpoint, next(model.parameters()).device)
+            set_state(model, checkpoint["state"])
+            print(f"{name}: hidden state restored from {self.state_checkpoint} "
+                  f"(saved at {checkpoint['metadata'].get('end_ts')}us)")
+
+    @torch.no_grad()
+    def step(self, tensor, start_ts=None, end_ts=None):
+        """Classifies one timeslice and updates the low activity and rolling average states
+
+        With a gate, the model is only called on the first idle timeslice of an idle period (and after a
+        reset), the next idle timeslices reuse its scores.
+
+        Returns:
+            FrameResult: the scores of the frame and, if keep_tensor is set, the tensor used for visualization
+        """
+        args = self.args
         do_reset = False
         if not args.use_FF_model:
             tensor = tensor[None]
-        out = torch.squeeze(cls_model(tensor))
-        yhat = torch.nn.functional.softmax(out, dim=-1).cpu().numpy()
-        
+        idle = self.gate is not None and self.gate.is_idle(tensor)
+        skipped = idle and self.background is not None
+        if skipped:
+            yhat = self.background
+            self.gate.record(True)
+            postprocess_start = time.perf_counter()
+        else:
+            start = time.perf_counter()
+            out = torch.squeeze(self.model(to_channels_last(tensor) if self.channels_last else tensor))
+            if self.recorder is not None:
+                synchronize(out.device)
+            postprocess_start = time.perf_counter()
+            if self.recorder is not None:
+                self.recorder.record("forward", postprocess_start - start)
+            yhat = torch.nn.functional.softmax(out, dim=-1).cpu().numpy()
+            if self.gate is not None:
+                self.gate.record(False, time.perf_counter() - start)
+                self.background = yhat if idle else None
 
         if tensor.max() < args.max_low_activity_tensor:
-            nb_consecutive_low_activity_frames += 1
+            self.nb_consecutive_low_activity_frames += 1
         else:
-            nb_consecutive_low_activity_frames = 0
+            self.nb_consecutive_low_activity_frames = 0
 
-        if nb_consecutive_low_activity_frames >= args.max_low_activity_nb_frames and args.display_reset_memory:
+        if self.nb_consecutive_low_activity_frames >= args.max_low_activity_nb_frames and args.display_reset_memory:
             do_reset = True
-            cls_model.reset_all()
-            nb_consecutive_low_activity_frames = 0
+            self.model.reset_all()
+            self.nb_consecutive_low_activity_frames = 0
+            # the scores of an idle timeslice change with the state of the model
+            self.background = None
 
         if args.use_FF_model:
             tensor = tensor[None]
-        tensor = tensor.detach()[0, 0].cpu().numpy()
-        img = viz_histo_filtered(tensor)
-        if args.use_FF_model:
-            Q.append(yhat)
-            q_mean = np.array(Q).mean(axis=0)
+            self.Q.append(yhat)
+            q_mean = np.array(self.Q).mean(axis=0)
             yhat_indice = np.argmax(q_mean, axis=-1)
         else:
             yhat_indice = np.argmax(yhat, axis=-1)
-        yhat_cls = model_json["label_map"][yhat_indice]
-
-        # RNN model
-        try:
-            model_predictions = f"[Background : {yhat[0]:.2f}] [Left : {yhat[1]:.2f}] [Center :  {yhat[2]:.2f}] [Right :  {yhat[3]:.2f}]"
-
-        except:
-        # FFN model 
-            model_predictions = f"[Left : {yhat[0]:.2f}] [Background : {yhat[1]:.2f}] [Right :  {yhat[2]:.2f}]"
-
-        #print("Background : ", yhat[0], " Paper : ", yhat[1], " Rock : ", yhat[2], " Scissor : ", yhat[3])
-        print(model_predictions)
-
-
-        # Save classification scores for this frame into the results list.
-        # Adjust the dictionary keys if your label order is different.
-        results.append({
-            "frame": frame_index,
-            "background": float(yhat[0]),
-            "left": float(yhat[1]),
-            "center": float(yhat[2]),
-            "right": float(yhat[3]),
-        })
-        frame_index += 1
-
-
-        # filter out background and predictions with low confidence value
-        if yhat[yhat_indice] >= args.cls_threshold and yhat_indice != 0:
-            cv2.putText(img, yhat_cls, (10, img.shape[0] - 60), FONT, 0.5, COLOR)
-            cv2.putText(img, "Score: {:.2f}".format(yhat[yhat_indice]), (10, img.shape[0] - 20), FONT, 0.5, COLOR)
-        if do_reset and args.display_reset_memory:
-            cv2.putText(img, "RESET MEMORY", (10, 20), FONT, 0.4, COLOR)
-        
-        if args.display:
-            cv2.imshow(WINDOW_NAME, img[..., ::-1])
-            key = cv2.waitKey(1)
-            if key == 27 or key == ord("q"):
-                break
-
-        if video_process is not None:
-            video_process.writeFrame(img)
-
-        if h5writer is not None:
-            h5writer.write(yhat)
-    # After processing all frames, save the results if an output CSV path was provided.
-    if args.output_csv:
-        _save_results_csv(results, args.output_csv)
-        
-def _save_results_csv(results, csv_path):
-    """Save the results list to a CSV file."""
-    import csv
-    fieldnames = ["frame", "background", "left", "center", "right"]
-    # Create the output directory if it doesn't exist
-    os.makedirs(os.path.dirname(csv_path), exist_ok=True)
-    with open(csv_path, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for res in results:
-            writer.writerow(res)
+
+        result = FrameResult(self.frame_index, tensor.detach()[0, 0] if self.keep_tensor else None, yhat,
+                             yhat_indice, do_reset, skipped, start_ts, end_ts)
+        self.frame_index += 1
+        self.end_ts = end_ts
+        if self.state_checkpoint and args.state_checkpoint_every > 0 and \
+                self.frame_index % args.state_checkpoint_every == 0:
+            self.save_state()
+        if self.recorder is not None:
+            self.recorder.record("postprocess", time.perf_counter() - postprocess_start)
+        return result
+
+    def save_state(self):
+        save_state_checkpoint(self.state_checkpoint, get_state(self.model), model=self.name, end_ts=self.end_ts,
+                              frame_index=self.frame_index, delta_t=self.args.delta_t, path=self.args.path)
+
+    def close(self):
+        for sink in self.score_sinks:
+            sink.close()
+        # a resumed run which processed no frame keeps its checkpoint
+        if self.state_checkpoint and self.end_ts is not None:
+            self.save_state()
+
+
+def model_state_checkpoint(state_checkpoint, suffix=""):
+    """State checkpoint file of one model, the suffix naming the model in a sweep"""
+    if not state_checkpoint:
+        return ""
+    return os.path.splitext(state_checkpoint)[0] + suffix + os.path.splitext(state_checkpoint)[1]
+
+
+def _timestamped(preprocessor, delta_t, start_ts=0, skip_until=0):
+    """Yields (tensor, start_ts, end_ts) for each timeslice
+
+    The timestamps come from the iterator when it tracks the time of the events (CDProcessorIterator, or a
+    CachedTensorIterator which stored them), else they are counted from `start_ts`. The timeslices ending before
+    `skip_until` are skipped, for the iterators which can't start at a given timestamp (HDF5 files).
+    """
+    get_time = getattr(preprocessor, "get_time", None)
+    for i, tensor in enumerate(preprocessor):
+        end_ts = get_time() if get_time is not None else None
+        end_ts = int(end_ts) if end_ts is not None else start_ts + (i + 1) * delta_t
+        if end_ts <= skip_until:
+            continue
+        yield tensor, end_ts - delta_t, end_ts
+
+
+def _timed(fn, recorder, stage):
+    """Wraps the function of a stage so that the duration of each call is recorded"""
+    if recorder is None:
+        return fn
+
+    def timed(item):
+        start = time.perf_counter()
+        ret = fn(item)
+        recorder.record(stage, time.perf_counter() - start)
+        return ret
+    return timed
+
+
+def _proc(
+        preprocessor,
+        classifiers,
+        args,
+        video_process=None,
+        roi=None,
+        recorder=None,
+):
+    """Sub function performing preprocessing, inference and visualization.
+
+    Each step runs in its own thread, connected to the next ones by bounded queues:
+
+        producer -> model -> console, score files (csv, h5, parquet, arrow)
+                          -> viz -> display, video
+
+    With several classifiers, the producer sends each tensor to one model stage per classifier, each with its
+    own console and score file sinks. Only the first classifier is visualized.
+    The visualization branch drops frames when it can't keep up, so that a slow display or video encoding
+    never stalls the classifier (use --lossless-video to block instead). The queue depth and latency of each
+    stage are printed at the end of the run.
+
+    Args:
+        preprocessor: iterator of input tensors
+        classifiers (list): list of Classifier
+        args: parsed arguments of the inference script
+        video_process (FFmpegWriter): optional video writer
+        roi (Roi): optional region of interest cropped from each tensor before the model
+        recorder (LatencyRecorder): optional recorder of the per-frame durations of the first classifier
+    """
+    stop_event = threading.Event()
+    visual = args.display or video_process is not None
+    sweep = len(classifiers) > 1
+
+    display_stage = None
+    video_stage = None
+    model_stages = []
+    all_stages = []
+    for i, classifier in enumerate(classifiers):
+        suffix = f"[{classifier.name}]" if sweep else ""
+        sink_recorder = recorder if i == 0 else None
+        sinks = []
+        if not args.quiet:
+            prefix = classifier.name + " " if sweep else ""
+
+            def console(result, prefix=prefix):
+                print(prefix + _format_predictions(result.yhat))
+            sinks.append(Stage("console" + suffix, _timed(console, sink_recorder, "sinks"), stop_event,
+                               maxsize=args.queue_size))
+        for sink in classifier.score_sinks:
+            def write_scores(result, sink=sink):
+                sink.write(result.index, result.start_ts, result.end_ts, result.yhat)
+            sink_name = os.path.splitext(sink.path)[1][1:] + suffix
+            sinks.append(Stage(sink_name, _timed(write_scores, sink_recorder, "sinks"), stop_event,
+                               maxsize=args.queue_size))
+
+        # the tensors are only kept and rendered for the visualized classifier, when a display or video consumes them
+        classifier.keep_tensor = visual and i == 0
+        if visual and i == 0:
+            visual_sinks = []
+            if args.display:
+                WINDOW_NAME = "Gesture Recognition"
+                cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
+
+                def show(img):
+                    if stop_event.is_set():
+                        return
+                    cv2.imshow(WINDOW_NAME, img[..., ::-1])
+                    key = cv2.waitKey(1)
+                    if key == 27 or key == ord("q"):
+                        return False
+                display_stage = Stage("display", show, stop_event, maxsize=args.queue_size, drop_when_full=True)
+                visual_sinks.append(display_stage)
+            if video_process is not None:
+                video_stage = Stage("video", video_process.writeFrame, stop_event, maxsize=args.queue_size,
+                                    drop_when_full=not args.lossless_video)
+                visual_sinks.append(video_stage)
+
+            # an image can be queued in the display and video stages, or being shown and encoded
+            renderer = HistoRenderer(num_buffers=2 * args.queue_size + 3)
+
+            def render(result, model_json=classifier.model_json, visual_sinks=visual_sinks, renderer=renderer):
+                img = _render_frame(result, model_json, args, renderer)
+                for stage in visual_sinks:
+                    stage.put(img)
+            sinks.append(Stage("viz", render, stop_event, maxsize=args.queue_size,
+                               drop_when_full=not args.lossless_video, downstream=visual_sinks))
+
+        def classify(item, classifier=classifier, sinks=sinks, print_stats=(i == 0)):
+            tensor, start_ts, end_ts, produced = item
+            result = classifier.step(tensor, start_ts, end_ts)
+            for stage in sinks:
+                stage.put(result)
+            if print_stats and recorder is not None:
+                recorder.record("pipeline", time.perf_counter() - produced)
+            if print_stats and args.stats_every > 0 and classifier.frame_index % args.stats_every == 0:
+                print(format_stats(all_stats))
+
+        model_stage = Stage("model" + suffix, classify, stop_event, maxsize=args.queue_size, downstream=sinks)
+        model_stages.append(model_stage)
+        all_stages += [model_stage] + sinks
+
+    all_stages += [stage for stage in (display_stage, video_stage) if stage is not None]
+    # the iterators may reuse their output buffer, so each tensor is copied before being queued
+    copy = torch.clone if roi is None else (lambda tensor: roi(tensor).clone())
+    # the HDF5 files start at 0, the timeslices before --start-ts (or the resumed timestamp) are skipped
+    start_ts = 0 if args.path.endswith('h5') else args.start_ts
+    producer = Source("producer", _timestamped(preprocessor, args.delta_t, start_ts, skip_until=args.start_ts),
+                      model_stages, stop_event,
+                      transform=lambda item: (copy(item[0]),) + item[1:] + (time.perf_counter(),))
+    all_stats = [producer.stats] + [stage.stats for stage in all_stages]
+    for stage in all_stages:
+        if stage is not display_stage:
+            stage.start()
+    producer.start()
+    if display_stage is not None:
+        # OpenCV windows must be handled by the main thread
+        display_stage.run()
+
+    producer.join()
+    for stage in all_stages:
+        stage.join()
+    print(format_stats(all_stats))
+    for classifier in classifiers:
+        if classifier.gate is not None:
+            print(classifier.gate.format_summary(classifier.name + " " if sweep else ""))
+
 
 def main():
     args = inference_parser().parse_args()
     run(args)
 
-def run(args):
-    # Load the network
-    model_file = glob.glob(os.path.join(args.torchscript_dir, "*.ptjit"))
-    assert len(model_file) == 1, "more than one torchjit models is ambiguous"
-    model = torch.jit.load(model_file[0])
-    json_file = glob.glob(os.path.join(args.torchscript_dir, "*.json"))
+def load_model(torchscript_dir, backend="torchscript", num_threads=None):
+    """Loads the torchscript model and its json description from an export directory
+
+    Args:
+        torchscript_dir (str): directory produced by export_classifier.py
+        backend (str): torchscript, or onnxruntime to run the ONNX graph of the directory on CPU
+        num_threads (int): number of threads of an ONNX Runtime session, its default if None
+
+    Returns:
+        model (torch.jit.ScriptModule): the classifier (an OnnxClassifier with onnxruntime)
+        model_json (dict): the model description
+    """
+    assert backend in BACKENDS, f"backend should be one of {BACKENDS}"
+    json_file = glob.glob(os.path.join(torchscript_dir, "*.json"))
     assert len(json_file) == 1, "more than one json files is ambiguous"
     json_file = json_file[0]
     with open(json_file, "r") as jfile:
         model_json = json.load(jfile)
+    if backend == "onnxruntime":
+        return load_onnx_model(torchscript_dir, model_json, num_threads=num_threads), model_json
+    model_file = glob.glob(os.path.join(torchscript_dir, "*.ptjit"))
+    assert len(model_file) == 1, "more than one torchjit models is ambiguous"
+    model = torch.jit.load(model_file[0])
+    # quantized models run with the kernels they were exported for
+    quantization = model_json.get("quantization")
+    if quantization and quantization["engine"] in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = quantization["engine"]
+    return model, model_json
+
+
+def cls_h5_attrs(model_json, args, height, width, torchscript_dir=None):
+    """Attributes of the "cls" dataset written in the HDF5 output"""
+    torchscript_dir = args.torchscript_dir if torchscript_dir is None else torchscript_dir
+    return {"events_to_tensor": np.string_(model_json["preprocess"]),
+            'checkpoint_path': os.path.basename(os.path.normpath(torchscript_dir)),
+            'input_file_name': os.path.basename(args.path),
+            "delta_t": np.uint32(args.delta_t),
+            'model_input_height': height,
+            "model_input_width": width}
+
+
+def get_sweep_dirs(sweep):
+    """Returns the model directories given as paths or glob patterns, in a stable order"""
+    dirs = []
+    for pattern in sweep:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if os.path.isdir(path) and path not in dirs:
+                dirs.append(path)
+    return dirs
+
+
+def run(args, model=None, model_json=None):
+    """Runs the inference on the file or camera given by `args.path`
+
+    Args:
+        args: parsed arguments of the inference script
+        model (torch.jit.ScriptModule): already loaded classifier, loaded from `args.torchscript_dir` if None
+        model_json (dict): description of the already loaded classifier
+    """
+    # Load the network
+    if model is None:
+        model, model_json = load_model(args.torchscript_dir, args.backend)
 
     # Get delta t
     if model_json['delta_t'] != args.delta_t:
@@ -226,9 +624,7 @@ def run(args):
 
     # Prepare H5 output path
     if args.save_h5:
-        h5_dirname = os.path.dirname(args.save_h5)
-        if not os.path.exists(h5_dirname):
-            os.makedirs(h5_dirname)
+        os.makedirs(args.save_h5, exist_ok=True)
 
     # Get height, width
     if args.hw:
@@ -237,10 +633,43 @@ def run(args):
         height = model_json["height"]
         width = model_json["width"]
 
-    # Initialize the device
+    # Initialize the device, quantized models and ONNX Runtime only run on CPU
+    if model_json.get("quantization") and not args.cpu:
+        print(f"Model quantized in {model_json['quantization']['mode']} INT8, running on CPU")
+        args.cpu = True
+    if args.backend == "onnxruntime":
+        args.cpu = True
+    if model_json.get("optimization") and not args.cpu:
+        print("Warning: the model was optimized for CPU inference, --cpu is advised")
     device = torch.device('cpu') if args.cpu else torch.device('cuda')
     model.to(device)
 
+    # Load the models of the sweep, they must share the preprocessing of the main model
+    models = [(args.torchscript_dir, model, model_json)]
+    for torchscript_dir in get_sweep_dirs(args.sweep):
+        if os.path.normpath(torchscript_dir) == os.path.normpath(args.torchscript_dir):
+            continue
+        sweep_model, sweep_model_json = load_model(torchscript_dir, args.backend)
+        for key in SHARED_PREPROCESSING_KEYS:
+            assert sweep_model_json.get(key) == model_json.get(key), \
+                f"{torchscript_dir} doesn't share the preprocessing of {args.torchscript_dir}: " \
+                f"{key} is {sweep_model_json.get(key)} instead of {model_json.get(key)}"
+        models.append((torchscript_dir, sweep_model, sweep_model_json))
+
+    roi = get_roi(args, model_json)
+    if roi is not None:
+        print(f"Input cropped to {roi}, the model is fed with {roi.output_size[0]}x{roi.output_size[1]} tensors")
+
+    if args.offline:
+        assert len(models) == 1, "the sweep mode is not available offline"
+        assert not args.synthetic, "synthetic streams are not available offline"
+        assert not args.resume, "the offline mode can't resume from a state checkpoint"
+        assert args.backend == "torchscript", "the offline mode runs TorchScript models"
+        model.eval()
+        run_offline(args, model, model_json, device, height, width, cls_h5_attrs(model_json, args, height, width),
+                    roi=roi)
+        return
+
     preprocess_kwargs = model_json["preprocess_kwargs"]
     if not "quantized" in model_json["preprocess"]:
         # Get max_incr_per_pixel
@@ -248,18 +677,69 @@ def run(args):
             else args.max_incr_per_pixel
         preprocess_kwargs.update({'max_incr_per_pixel': max_incr_per_pixel})
     
+    # with HDF5 inputs or cached tensors, the ingest, preprocess and h2d stages are not timed
+    recorder = LatencyRecorder() if args.latency_json else None
+
+    # the outputs of the models of a sweep are suffixed with the name of their directory
+    sweep = len(models) > 1
+    suffixes = ["_" + os.path.basename(os.path.normpath(torchscript_dir)) if sweep else ""
+                for torchscript_dir, _, _ in models]
+
+    resume_frame = None
+    if args.resume:
+        assert args.state_checkpoint, "--resume needs a --state-checkpoint"
+        metadata = []
+        for suffix in suffixes:
+            path = model_state_checkpoint(args.state_checkpoint, suffix)
+            assert os.path.isfile(path), f"--resume needs the state checkpoint {path}"
+            metadata.append(load_state_checkpoint(path)["metadata"])
+            assert "frame_index" in metadata[-1], f"{path} has no frame index, the score files can't be resumed"
+        # the models of a sweep save their state independently, the stream restarts after the earliest one
+        earliest = min(metadata, key=lambda m: m["frame_index"])
+        if any(m["frame_index"] != earliest["frame_index"] for m in metadata):
+            print("Warning: the state checkpoints of the sweep were saved at different frames, the models saved "
+                  "later see the frames after the earliest one twice")
+        resume_frame = earliest["frame_index"]
+        if earliest.get("end_ts") is not None:
+            print(f"Resuming at {earliest['end_ts']}us, frame {resume_frame}")
+            args.start_ts = earliest["end_ts"]
+
     # Process the events
-    if args.path.endswith('h5'):
-        preprocessor = HDF5Iterator(args.path, device=device, height=height, width=width)
+    if args.synthetic:
+        events_iterator = SyntheticEventsIterator(
+            args.synthetic, delta_t=args.delta_t, start_ts=args.start_ts,
+            duration=args.start_ts + (args.max_duration or 10000000),
+            event_rate=args.synthetic_rate * 1e6, noise_rate=args.synthetic_noise, height=args.synthetic_size[0],
+            width=args.synthetic_size[1])
+        preprocessor = InstrumentedCDProcessorIterator(
+            None, model_json["preprocess"], args.delta_t, recorder, device=device, height=height, width=width,
+            preprocess_kwargs=preprocess_kwargs, events_iterator=events_iterator)
+    elif args.path.endswith('h5'):
+        preprocessor = make_hdf5_iterator(args.path, device=device, height=height, width=width)
         preprocessor.checks(model_json["preprocess"], delta_t=args.delta_t)
     else:
-        preprocessor = CDProcessorIterator(
-            args.path, model_json["preprocess"],
-            delta_t=args.delta_t, max_duration=args.max_duration, device=device, height=height, width=width,
-            start_ts=args.start_ts, preprocess_kwargs=preprocess_kwargs)
+        def make_preprocessor():
+            if recorder is not None:
+                return InstrumentedCDProcessorIterator(
+                    args.path, model_json["preprocess"], args.delta_t, recorder, device=device, height=height,
+                    width=width, start_ts=args.start_ts, max_duration=args.max_duration,
+                    preprocess_kwargs=preprocess_kwargs)
+            return CDProcessorIterator(
+                args.path, model_json["preprocess"],
+                delta_t=args.delta_t, max_duration=args.max_duration, device=device, height=height, width=width,
+                start_ts=args.start_ts, preprocess_kwargs=preprocess_kwargs)
+
+        if args.tensor_cache and args.path:
+            cache = TensorCache(args.tensor_cache, int(args.tensor_cache_size_gb * 2**30))
+            key = cache.key(args.path, model_json["preprocess"], preprocess_kwargs, args.delta_t, height, width,
+                            start_ts=args.start_ts, max_duration=args.max_duration)
+            preprocessor = CachedTensorIterator(cache, key, make_preprocessor, device)
+        else:
+            preprocessor = make_preprocessor()
 
     # Initialize video outputs
-    filename = os.path.splitext(os.path.basename(args.path))[0] if args.path != "" \
+    filename = f"synthetic_{args.synthetic}" if args.synthetic \
+        else os.path.splitext(os.path.basename(args.path))[0] if args.path != "" \
         else datetime.now().strftime("chifoumi_inference_%Y%m%d_%H%M%S")
     if args.write_video:
         video_path = os.path.join(args.write_video, filename + '.mp4')
@@ -267,46 +747,57 @@ def run(args):
     else:
         process = None
 
-    # Initialize H5 output
-    if args.save_h5:
-        h5_file = os.path.join(args.save_h5, filename + '_cls.h5')
-        shape = [len(model_json["label_map"])]
-        h5w = HDF5Writer(
-            h5_file, "cls", shape, dtype=np.float16,
-            attrs={"events_to_tensor": np.string_(model_json["preprocess"]),
-                   'checkpoint_path': os.path.basename(args.torchscript_dir),
-                   'input_file_name': os.path.basename(args.path),
-                   "delta_t": np.uint32(args.delta_t),
-                   'model_input_height': height,
-                   "model_input_width": width})
-        h5w.dataset_size_increment = 100
-    else:
-        h5w = None
-
-    model.eval()
-
-    _proc(
-        preprocessor,
-        model,
-        model_json,
-        args=args,
-        video_process=process,
-        h5writer=h5w
-    )
-
-    # close everything
-    if args.write_video:
-        process.close()
-    if args.save_h5:
-        h5w.close()
-        # Update hdf5
-        cls_h5 = h5py.File(h5_file, "r+")
-        T, _ = cls_h5["cls"].shape
-        cls_start_ts_np = np.arange(0, T * args.delta_t, args.delta_t)
-        cls_end_ts_np = np.arange(args.delta_t, T * args.delta_t + 1, args.delta_t)
-        cls_h5.create_dataset("cls_start_ts", data=cls_start_ts_np, compression="gzip")
-        cls_h5.create_dataset("cls_end_ts", data=cls_end_ts_np, compression="gzip")
-        cls_h5.close()
+    gate_threshold = args.gate_threshold
+    if args.gate and gate_threshold is None:
+        assert args.gate == "max", "--gate-threshold is required with the count, nonzero and energy statistics"
+        gate_threshold = args.max_low_activity_tensor
+
+    # Initialize one classifier per model, each with its own outputs
+    classifiers = []
+    for (torchscript_dir, cls_model, cls_model_json), suffix in zip(models, suffixes):
+        name = os.path.basename(os.path.normpath(torchscript_dir))
+        score_paths = list(args.output_scores)
+        if args.output_csv:
+            score_paths.append(args.output_csv)
+        if sweep:
+            score_paths = [os.path.splitext(path)[0] + suffix + os.path.splitext(path)[1] for path in score_paths]
+        if args.save_h5:
+            score_paths.append(os.path.join(args.save_h5, filename + suffix + '_cls.h5'))
+        label_map = cls_model_json["label_map"]
+        attrs = cls_h5_attrs(cls_model_json, args, height, width, torchscript_dir)
+        score_sinks = [make_score_sink(path, label_map, batch_size=args.flush_every, attrs=attrs,
+                                       resume_frame=resume_frame) for path in score_paths]
+        cls_model.to(device)
+        cls_model.eval()
+        gate = ActivityGate(args.gate, gate_threshold, roi=args.gate_roi) if args.gate else None
+        classifiers.append(Classifier(name, cls_model, cls_model_json, args, score_sinks=score_sinks, gate=gate,
+                                      recorder=recorder if not classifiers else None,
+                                      state_checkpoint=model_state_checkpoint(args.state_checkpoint, suffix),
+                                      first_frame=resume_frame or 0))
+
+    try:
+        _proc(
+            preprocessor,
+            classifiers,
+            args=args,
+            video_process=process,
+            roi=roi,
+            recorder=recorder,
+        )
+    finally:
+        # close everything, the score files keep what was computed if the inference failed
+        for classifier in classifiers:
+            classifier.close()
+        if args.write_video:
+            process.close()
+
+    if recorder is not None:
+        print(recorder.format())
+        recorder.save(args.latency_json, metadata={
+            "path": args.path, "model": args.torchscript_dir, "preprocess": model_json["preprocess"],
+            "delta_t": args.delta_t, "height": height, "width": width, "device": str(device),
+            "num_frames": classifiers[0].frame_index, "roi": roi.to_dict() if roi is not None else None,
+            "gate": args.gate, "torch_threads": torch.get_num_threads()})
 
     if args.display:
         cv2.destroyAllWindows()
@@ -0,0 +1,162 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Knowledge distillation of a trained teacher classifier into a smaller student
+
+The student is trained with the loss of its model class on the labels, mixed with the KL divergence between its
+softened scores and those of the teacher on the same inputs:
+
+    loss = (1 - alpha) * hard_loss + alpha * T^2 * KL(softmax(teacher / T) || softmax(student / T))
+
+The KL divergence is averaged over the frames the hard loss is computed on: the labeled frames of the RNN
+batches ("frame_is_labeled"), the frames whose label isn't ignored (255) for the feedforward ones.
+
+The teacher sees the inputs of the student, upsampled to its resolution when the student is trained with a
+smaller --height_width, and its recurrent state is reset along with the one of the student. It isn't part of the
+student checkpoint, which exports with export_classifier like any other.
+"""
+
+import argparse
+
+import torch
+import torch.nn.functional as F
+from metavision_ml.classification import get_model_class, is_rnn
+
+IGNORE_LABEL = 255
+
+
+def load_teacher(checkpoint_path):
+    """Loads the network of a trained classifier and its hyperparameters"""
+    checkpoint = torch.load(checkpoint_path, map_location=torch.device('cpu'))
+    hparams = argparse.Namespace(**checkpoint['hyper_parameters'])
+    if not hasattr(hparams, "preprocess_channels"):
+        hparams.preprocess_channels = hparams.in_channels
+    model = get_model_class(hparams.models)(hparams)
+    model.load_state_dict(checkpoint['state_dict'])
+    net = model.net.eval()
+    for p in net.parameters():
+        p.requires_grad = False
+    return net, hparams
+
+
+def check_teacher(params, teacher_hparams):
+    """The teacher must classify the same classes from the same input representation as the student"""
+    for key in ("preprocess", "preprocess_channels", "classes"):
+        assert getattr(teacher_hparams, key, None) == getattr(params, key, None), \
+            f"the teacher has {key}={getattr(teacher_hparams, key, None)} but the student " \
+            f"{getattr(params, key, None)}"
+    assert is_rnn(teacher_hparams.models) == is_rnn(params.models), \
+        "the teacher and the student must both be RNN or feedforward models"
+
+
+def label_mask(batch, logits):
+    """Frames of a batch on which the hard loss is computed, None if the batch doesn't tell
+
+    Returns:
+        torch.Tensor: boolean mask of the shape of the logits without their class dimension
+    """
+    if not isinstance(batch, dict):
+        return None
+    if "frame_is_labeled" in batch:
+        mask = batch["frame_is_labeled"].bool()
+    elif "labels" in batch:
+        mask = batch["labels"] != IGNORE_LABEL
+    else:
+        return None
+    assert mask.numel() == logits[..., 0].numel(), \
+        f"the label mask has {mask.numel()} frames but the student outputs {logits[..., 0].numel()}"
+    return mask.reshape(logits.shape[:-1]).to(logits.device)
+
+
+def distillation_loss(student_logits, teacher_logits, temperature, mask=None):
+    """KL divergence between the softened teacher and student scores, scaled by T^2 to keep the gradient scale
+
+    Only the frames selected by mask, if given, are averaged.
+    """
+    if mask is not None:
+        student_logits, teacher_logits = student_logits[mask], teacher_logits[mask]
+        if not len(student_logits):
+            # no labeled frame, the loss is zero but stays in the graph
+            return student_logits.sum()
+    student_logits = student_logits.reshape(-1, student_logits.shape[-1])
+    teacher_logits = teacher_logits.reshape(-1, teacher_logits.shape[-1])
+    return F.kl_div(F.log_softmax(student_logits / temperature, dim=-1),
+                    F.softmax(teacher_logits / temperature, dim=-1), reduction="batchmean") * temperature ** 2
+
+
+def distillation_class(model_class):
+    """Returns a subclass of a lightning classification model trained with the soft targets of a teacher
+
+    The model hyperparameters must hold `teacher` (checkpoint path), `distill_temperature` and `distill_alpha`.
+    """
+
+    class DistillationModel(model_class):
+
+        def __init__(self, hparams, *args, **kwargs):
+            super().__init__(hparams, *args, **kwargs)
+            teacher, teacher_hparams = load_teacher(hparams.teacher)
+            check_teacher(hparams, teacher_hparams)
+            # kept out of the submodules, so that the teacher isn't trained nor saved with the student
+            self._teacher = [teacher]
+            self.teacher_size = (teacher_hparams.height, teacher_hparams.width)
+            self._student_io = None
+            self.net.register_forward_hook(self._record_student_io)
+            self._mirror_resets()
+
+        @property
+        def teacher(self):
+            return self._teacher[0]
+
+        def _record_student_io(self, module, inputs, output):
+            if self.training:
+                self._student_io = (inputs[0], output)
+
+        def _mirror_resets(self):
+            """Resets the state of the teacher with the one of the student during training"""
+            if not hasattr(self.net, "reset"):
+                return
+            student_reset = self.net.reset
+
+            def reset(mask, *args, **kwargs):
+                if self.training:
+                    self.teacher.reset(mask, *args, **kwargs)
+                return student_reset(mask, *args, **kwargs)
+            self.net.reset = reset
+
+        def on_fit_start(self):
+            self.teacher.to(self.device)
+            super().on_fit_start()
+
+        def on_train_epoch_start(self):
+            if hasattr(self.teacher, "reset_all"):
+                self.teacher.reset_all()
+            super().on_train_epoch_start()
+
+        def training_step(self, batch, batch_nb):
+            self._student_io = None
+            output = super().training_step(batch, batch_nb)
+            assert self._student_io is not None, "the forward of the student wasn't called in the training step"
+            x, student_logits = self._student_io
+            self._student_io = None
+            with torch.no_grad():
+                teacher_x = x
+                if tuple(x.shape[-2:]) != self.teacher_size:
+                    teacher_x = F.interpolate(x.reshape(-1, *x.shape[-3:]).float(), size=self.teacher_size,
+                                              mode="bilinear", align_corners=False)
+                    teacher_x = teacher_x.reshape(*x.shape[:-2], *self.teacher_size).to(x.dtype)
+                teacher_logits = self.teacher(teacher_x)
+            soft_loss = distillation_loss(student_logits.float(), teacher_logits.float(),
+                                          self.hparams.distill_temperature, mask=label_mask(batch, student_logits))
+            alpha = self.hparams.distill_alpha
+            self.log("distill_loss", soft_loss)
+            if isinstance(output, dict):
+                output["loss"] = (1 - alpha) * output["loss"] + alpha * soft_loss
+                return output
+            return (1 - alpha) * output + alpha * soft_loss
+
+    DistillationModel.__name__ = "Distilled" + model_class.__name__
+    return DistillationModel
@@ -0,0 +1,159 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Run the classification inference on many recordings in parallel and merge the results
+
+Example:
+python3 evaluate_recordings.py test_recording/ Model_trained_EVK_4_LCR -o results/ -j 8 --torch-threads 2 \
+    -- --cpu --delta-t 10000
+
+Arguments after "--" are forwarded to classification_inference.py for every recording.
+"""
+
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch
+
+from classification_inference import inference_parser, load_model, run
+
+RECORDING_EXTENSIONS = (".raw", ".dat", ".h5")
+
+# model loaded once by each worker process
+_WORKER = {}
+
+
+def evaluation_parser():
+    parser = argparse.ArgumentParser(description='Evaluate a classification model on a set of recordings, '
+                                                 'spread over a pool of processes',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('recordings', type=str,
+                        help='directory containing the recordings or glob pattern (e.g. "test/*.raw")')
+    parser.add_argument('torchscript_dir', type=str, help='path to the torchscript model and the json file '
+                                                          'with model description.')
+    parser.add_argument('-o', '--output-dir', type=str, required=True,
+                        help='directory where the per-recording _cls.h5 and CSV files and the summary are written')
+    parser.add_argument('-j', '--num-workers', type=int, default=None,
+                        help='number of worker processes, defaults to the number of cores divided by '
+                             '--torch-threads')
+    parser.add_argument('--torch-threads', type=int, default=1, help='number of torch threads of each worker')
+    return parser
+
+
+def get_recordings(recordings):
+    """Returns the recordings given as a directory or a glob pattern"""
+    if os.path.isdir(recordings):
+        paths = [path for ext in RECORDING_EXTENSIONS for path in glob.glob(os.path.join(recordings, "*" + ext))]
+    else:
+        paths = glob.glob(recordings)
+    return sorted(path for path in paths if path.endswith(RECORDING_EXTENSIONS))
+
+
+def _init_worker(torchscript_dir, torch_threads, backend):
+    torch.set_num_threads(torch_threads)
+    # the ONNX Runtime sessions get the same thread budget as torch
+    model, model_json = load_model(torchscript_dir, backend, num_threads=torch_threads)
+    _WORKER["model"] = model
+    _WORKER["model_json"] = model_json
+
+
+def _evaluate_recording(path, torchscript_dir, output_dir, inference_args):
+    """Runs the inference on one recording in a worker and summarizes its scores"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    csv_path = os.path.join(output_dir, name + ".csv")
+    args = inference_parser().parse_args(
+        [torchscript_dir, "--path", path, "--save", output_dir, "--output-csv", csv_path, "--no-display",
+         "--quiet"] + inference_args)
+    model, model_json = _WORKER["model"], _WORKER["model_json"]
+    if hasattr(model, "reset_all"):
+        model.reset_all()
+
+    start = time.perf_counter()
+    run(args, model, model_json)
+    wall_time = time.perf_counter() - start
+
+    label_map = model_json["label_map"]
+    with open(csv_path, newline='') as csvfile:
+        scores = np.array([[float(row[label]) for label in label_map] for row in csv.DictReader(csvfile)])
+    summary = {"recording": os.path.basename(path), "num_frames": len(scores), "wall_time_s": round(wall_time, 3),
+               "fps": round(len(scores) / wall_time, 1) if wall_time > 0 else 0.}
+    predictions = scores.argmax(axis=1) if len(scores) else np.zeros(0, dtype=np.int64)
+    for i, label in enumerate(label_map):
+        summary[f"mean_{label}"] = float(scores[:, i].mean()) if len(scores) else 0.
+        summary[f"frames_{label}"] = int((predictions == i).sum())
+    return summary
+
+
+def evaluate_recordings(recordings, torchscript_dir, output_dir, num_workers=None, torch_threads=1,
+                        inference_args=()):
+    """Evaluates a model on several recordings with a pool of processes
+
+    Each worker loads its own instance of the model, with the --backend of the inference arguments, and runs
+    classification_inference.run on the recordings it is given. The scores of each recording are written in
+    `output_dir` as `<name>_cls.h5` and `<name>.csv`, and a merged `summary.csv` gives the number of frames, the
+    timing and the per-class statistics of every recording.
+
+    Args:
+        recordings (list): paths of the recordings
+        torchscript_dir (str): directory of the exported model
+        output_dir (str): output directory
+        num_workers (int): number of processes, defaults to the number of cores divided by `torch_threads`
+        torch_threads (int): number of torch threads of each process
+        inference_args (list): additional arguments of classification_inference.py
+
+    Returns:
+        summaries (list): one dictionary per recording
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if num_workers is None:
+        num_workers = max(1, (os.cpu_count() or 1) // torch_threads)
+    num_workers = min(num_workers, len(recordings))
+    # the workers load the model with the backend of the inference arguments, as the inference script does
+    backend = inference_parser().parse_args([torchscript_dir] + list(inference_args)).backend
+
+    summaries = []
+    start = time.perf_counter()
+    # spawn avoids sharing torch (and CUDA) state with the parent process
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker,
+                             initargs=(torchscript_dir, torch_threads, backend)) as executor:
+        futures = {executor.submit(_evaluate_recording, path, torchscript_dir, output_dir, list(inference_args)):
+                   path for path in recordings}
+        for future in as_completed(futures):
+            summary = future.result()
+            print(f"{summary['recording']}: {summary['num_frames']} frames in {summary['wall_time_s']:.1f}s")
+            summaries.append(summary)
+    total_time = time.perf_counter() - start
+
+    summaries.sort(key=lambda summary: summary["recording"])
+    summary_path = os.path.join(output_dir, "summary.csv")
+    with open(summary_path, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=list(summaries[0].keys()))
+        writer.writeheader()
+        writer.writerows(summaries)
+    print(f"{len(summaries)} recordings evaluated in {total_time:.1f}s with {num_workers} workers, "
+          f"summary written in {summary_path}")
+    return summaries
+
+
+def main():
+    args, inference_args = evaluation_parser().parse_known_args()
+    inference_args = [arg for arg in inference_args if arg != "--"]
+    recordings = get_recordings(args.recordings)
+    assert len(recordings) > 0, f"no recording found in {args.recordings}"
+    evaluate_recordings(recordings, args.torchscript_dir, args.output_dir, num_workers=args.num_workers,
+                        torch_threads=args.torch_threads, inference_args=inference_args)
+
+
+if __name__ == "__main__":
+    main()
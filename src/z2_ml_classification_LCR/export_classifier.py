@@ -9,12 +9,20 @@ Main script for export classification model to Torch.Jit.
 
 import os
 import argparse
+import copy
 import torch
 
 from metavision_ml.classification import get_model_class, is_rnn
 import json
 import numpy as np
 
+from jit_optimization import check_optimized, format_latency_table, latency_table, optimize_jit_model, \
+    to_channels_last
+from onnx_backend import check_onnx, export_onnx
+from quantization import QUANTIZATION_MODES, compare_models, feature_files, model_inputs, quantized_engine, \
+    quantize_dynamic_classifier, quantize_static_classifier
+from roi import Roi, roi_from_bbox_labels
+
 PARAMS_TO_EXPORT = ["delta_t", "label_delta_t", "use_label_freq", "models", "preprocess_channels", "height", "width",
                     "preprocess", "preprocess_kwargs"]
 
@@ -23,7 +31,56 @@ def to_numpy(tensor):
     return tensor.detach().cpu().numpy() if tensor.requires_grad else tensor.cpu().numpy()
 
 
-def export_classifier(lightning_model, out_directory, tseq, batch_size, precision=32):
+def quantize_classifier(classifier, params, quantize, dataset_path, calibration_files=8, validation_files=4,
+                        tolerance=0.05, roi=None):
+    """Quantizes a float classifier and checks its predictions on held-out feature files
+
+    Args:
+        classifier (torch.nn.Module): float classifier, in eval mode on CPU
+        params: hyperparameters of the model
+        quantize (str): dynamic or static
+        dataset_path (str): dataset with train, val and/or test folders of feature files
+        calibration_files (int): number of train files used to calibrate the static quantization
+        validation_files (int): number of val (or test) files on which the models are compared
+        tolerance (float): maximum fraction of the timeslices on which the quantized and float predictions differ
+        roi (Roi): region of the input tensor the model is fed with
+
+    Returns:
+        quantized_model (torch.nn.Module): the quantized classifier
+        quantization (dict): description of the quantization written in the json
+    """
+    assert quantize in QUANTIZATION_MODES, f"quantize should be one of {QUANTIZATION_MODES}"
+    rnn = is_rnn(params.models)
+    engine = quantized_engine()
+    torch.backends.quantized.engine = engine
+    if quantize == "dynamic":
+        quantized_model = quantize_dynamic_classifier(classifier)
+    else:
+        assert not rnn, "static quantization can't trace recurrent models, use dynamic quantization"
+        calibration = list(model_inputs(feature_files(dataset_path, "train", calibration_files), params, rnn,
+                                        roi=roi))
+        quantized_model = quantize_static_classifier(copy.deepcopy(classifier), calibration, calibration[0])
+    quantized_model.eval()
+
+    split = "val" if os.path.isdir(os.path.join(dataset_path, "val")) else "test"
+    metrics = compare_models(classifier, quantized_model,
+                             model_inputs(feature_files(dataset_path, split, validation_files), params, rnn, roi=roi))
+    print(f"{quantize} quantization on {metrics['num_inputs']} {split} inputs: "
+          f"{100 * metrics['agreement']:.2f}% of the float predictions kept, "
+          f"max score difference {metrics['max_score_diff']:.4f}")
+    assert metrics["agreement"] >= 1 - tolerance, \
+        f"the quantized model differs from the float model on {100 * (1 - metrics['agreement']):.2f}% of the " \
+        f"inputs, more than the {100 * tolerance:.2f}% tolerance"
+    if rnn:
+        classifier.reset_all()
+        quantized_model.reset_all()
+    return quantized_model, {"mode": quantize, "dtype": "qint8", "engine": engine, "tolerance": tolerance,
+                             "validation_split": split, **metrics}
+
+
+def export_classifier(lightning_model, out_directory, tseq, batch_size, precision=32, roi=None, quantize="",
+                      dataset_path=None, calibration_files=8, validation_files=4, quant_tolerance=0.05, onnx=False,
+                      optimize=False, channels_last=False):
     """Exports Jitted classifier
     & json parameter files
     Args:
@@ -32,8 +89,21 @@ def export_classifier(lightning_model, out_directory, tseq, batch_size, precisio
         tseq (int): time sequence of one random input tensor
         batch_size (int): batch size of one random input tensor
         precision (int): set to 16 to export in half precision (float16)  
+        roi (Roi): region of the input tensor the model is fed with, recorded in the json
+        quantize (str): if set, dynamic or static INT8 quantization of the model (CPU only)
+        dataset_path (str): dataset of the calibration and validation files, defaults to the training dataset
+        calibration_files (int): number of train feature files calibrating the static quantization
+        validation_files (int): number of held-out feature files on which the quantized model is validated
+        quant_tolerance (float): maximum fraction of predictions changed by the quantization
+        onnx (boolean): if True, the model is also exported as an ONNX graph
+        optimize (boolean): if True, the TorchScript model is frozen and optimized for CPU inference, and a latency
+            table is printed
+        channels_last (boolean): with optimize, converts the convolutions to the channels last layout
     """
     assert precision in (16,32), "only 16 and 32 precision (float) are supported"
+    assert not (quantize and precision == 16), "quantized models are exported from float32 models"
+    assert not (onnx and (quantize or precision == 16)), "the ONNX graph is exported from the float32 model"
+    assert not (optimize and precision == 16), "the optimization targets CPU inference in float32"
 
     classifier = lightning_model.net.cpu()
     classifier.eval()
@@ -43,10 +113,17 @@ def export_classifier(lightning_model, out_directory, tseq, batch_size, precisio
     else:
         label_map = params['classes']
 
+    quantization = None
+    if quantize:
+        classifier, quantization = quantize_classifier(
+            classifier, params, quantize, dataset_path or params["dataset_path"], calibration_files=calibration_files,
+            validation_files=validation_files, tolerance=quant_tolerance, roi=roi)
+
     jit_model = torch.jit.script(classifier)
     if precision == 16:
         jit_model.half()
-    jit_model.save(os.path.join(out_directory, "model_classifier.ptjit"))
+    model_path = os.path.join(out_directory, "model_classifier.ptjit")
+    jit_model.save(model_path)
 
     #for compatibility with old rnn models
     if not "preprocess_kwargs" in params:
@@ -58,6 +135,22 @@ def export_classifier(lightning_model, out_directory, tseq, batch_size, precisio
                 PARAMS_TO_EXPORT}
     dic_json["label_map"] = label_map
     dic_json["num_classes"] = len(label_map)
+    dic_json["roi"] = roi.to_dict() if roi is not None else None
+    dic_json["quantization"] = quantization
+    dic_json["optimization"] = {"freeze": True, "optimize_for_inference": True, "channels_last": channels_last} \
+        if optimize else None
+
+    # one timeslice at the real input shape
+    height, width = roi.output_size if roi is not None else (params['height'], params['width'])
+    if is_rnn(params.models):
+        single_x = torch.rand((1, 1, params['preprocess_channels'], height, width))
+    else:
+        single_x = torch.rand((1, params['preprocess_channels'] * params['num_ev_reps'], height, width))
+    if onnx:
+        dic_json["onnx"] = export_onnx(classifier, single_x, out_directory)
+        check_onnx(classifier, out_directory, dic_json["onnx"], single_x)
+    else:
+        dic_json["onnx"] = None
 
     for key in dic_json["preprocess_kwargs"]:
         if key == "preprocess_dtype":
@@ -70,10 +163,9 @@ def export_classifier(lightning_model, out_directory, tseq, batch_size, precisio
 
     # sanity check
     if is_rnn(params.models):
-        x = torch.rand((tseq, batch_size, params['preprocess_channels'], params['height'], params['width']))
+        x = torch.rand((tseq, batch_size, params['preprocess_channels'], height, width))
     else:
-        x = torch.rand((batch_size, params['preprocess_channels'] * params['num_ev_reps'],
-                        params['height'], params['width']))
+        x = torch.rand((batch_size, params['preprocess_channels'] * params['num_ev_reps'], height, width))
     if precision == 16:
         if not torch.cuda.is_available():
             print("Warning: Model exported with half precision, but no GPU available! Tests will be skipped")
@@ -86,6 +178,8 @@ def export_classifier(lightning_model, out_directory, tseq, batch_size, precisio
     # for test we need to disable jit optimizations 
     # otherwise there will be some difference in the results (especially for half precision)
     # see https://github.com/pytorch/pytorch/issues/74534
+    can_fuse_on_gpu, can_fuse_on_cpu = torch._C._jit_can_fuse_on_gpu(), torch._C._jit_can_fuse_on_cpu()
+    nvfuser_enabled = torch._C._jit_nvfuser_enabled()
     torch._C._jit_override_can_fuse_on_gpu(False)
     torch._C._jit_override_can_fuse_on_cpu(False)
     torch._C._jit_set_nvfuser_enabled(False)
@@ -95,13 +189,40 @@ def export_classifier(lightning_model, out_directory, tseq, batch_size, precisio
     np.testing.assert_allclose(to_numpy(ckpt_out), to_numpy(jit_out), rtol=1e-6, atol=1e-6)
     print("torchjit result has been tested, OK")
 
+    if optimize:
+        # the optimized model is checked and timed with the fusions it will run with
+        torch._C._jit_override_can_fuse_on_gpu(can_fuse_on_gpu)
+        torch._C._jit_override_can_fuse_on_cpu(can_fuse_on_cpu)
+        torch._C._jit_set_nvfuser_enabled(nvfuser_enabled)
+        rnn = is_rnn(params.models)
+        if rnn:
+            jit_model.reset_all()
+        optimized = optimize_jit_model(jit_model, rnn, channels_last=channels_last)
+        # the inference feeds a channels last model with channels last inputs, it is checked and timed with them
+        optimized_x = to_channels_last(single_x) if channels_last else single_x
+        check_optimized(classifier, optimized, single_x, rnn, optimized_x=optimized_x)
+        optimized.save(model_path)
+        print(format_latency_table(latency_table({"scripted": jit_model, "optimized": optimized}, single_x,
+                                                 inputs={"optimized": optimized_x})))
+
 
 def main(
         checkpoint_path,
         out_directory,
         tseq=1,
         batch_size=12,
-        precision=32):
+        precision=32,
+        roi=None,
+        roi_labels="",
+        roi_bin=1,
+        quantize="",
+        dataset_path=None,
+        calibration_files=8,
+        validation_files=4,
+        quant_tolerance=0.05,
+        onnx=False,
+        optimize=False,
+        channels_last=False):
     """
     Performs the export of a model
 
@@ -111,6 +232,21 @@ def main(
         tseq (int): time sequence of one random input tensor
         batch_size (int): batch size of one random input tensor
         precision (int): set to 16 to export in half precision (float16)  
+        roi (list): region of interest [x, y, width, height] in the model input resolution, recorded in the json
+            and cropped from the input tensors by classification_inference.py
+        roi_labels (str): if roi is not set, glob pattern of *_bbox.npy label files from which the ROI is computed
+        roi_bin (int): binning factor of the ROI
+        quantize (str): if set, "dynamic" or "static" post-training INT8 quantization, see quantization.py
+        dataset_path (str): dataset of the calibration and validation feature files, defaults to the one the model
+            was trained on
+        calibration_files (int): number of train/*.h5 files calibrating the static quantization
+        validation_files (int): number of val/*.h5 (or test/*.h5) files on which the quantized model is validated
+        quant_tolerance (float): maximum fraction of the validation predictions changed by the quantization
+        onnx (boolean): if True, the model is also exported as an ONNX graph (model_classifier.onnx), with the
+            hidden state of RNN models as explicit inputs and outputs, to be run with --backend onnxruntime
+        optimize (boolean): if True, the TorchScript model is frozen (batch norms folded in the convolutions) and
+            optimized for CPU inference, checked against the checkpoint and timed at 1, 2, 4 and all threads
+        channels_last (boolean): with optimize, converts the convolutions to the channels last layout
     """
     # 1. create directory
     if not os.path.exists(out_directory):
@@ -129,8 +265,19 @@ def main(
     model = model_class(hparams)
     model.load_state_dict(checkpoint['state_dict'])
 
+    if roi:
+        roi = Roi(*roi, bin=roi_bin)
+    elif roi_labels:
+        roi = roi_from_bbox_labels(roi_labels, hparams.height, hparams.width, bin=roi_bin)
+        print(f"ROI computed from the labels: {roi}")
+    else:
+        roi = None
+
     # 3. export
-    export_classifier(model, out_directory, tseq, batch_size, precision)
+    export_classifier(model, out_directory, tseq, batch_size, precision, roi=roi, quantize=quantize,
+                      dataset_path=dataset_path, calibration_files=calibration_files,
+                      validation_files=validation_files, quant_tolerance=quant_tolerance, onnx=onnx,
+                      optimize=optimize, channels_last=channels_last)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,236 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Threaded stages with bounded queues used to decouple preprocessing, inference and output sinks
+"""
+
+import queue
+import threading
+import time
+
+
+_STOP = object()
+_POLL_PERIOD_S = 0.1
+
+
+class StageStats(object):
+    """Thread-safe counters of a pipeline stage
+
+    Args:
+        name (str): name of the stage, used in the summary
+        maxsize (int): capacity of the input queue of the stage (0 if the stage has no queue)
+    """
+
+    def __init__(self, name, maxsize=0):
+        self.name = name
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.count = 0
+        self.dropped = 0
+        self.total_latency = 0.
+        self.max_latency = 0.
+        self.total_depth = 0
+        self.max_depth = 0
+        self.depth_samples = 0
+
+    def record_depth(self, depth):
+        """Records the number of items waiting in the input queue"""
+        with self._lock:
+            self.total_depth += depth
+            self.max_depth = max(self.max_depth, depth)
+            self.depth_samples += 1
+
+    def record_latency(self, seconds):
+        """Records the time spent processing one item"""
+        with self._lock:
+            self.count += 1
+            self.total_latency += seconds
+            self.max_latency = max(self.max_latency, seconds)
+
+    def record_drop(self):
+        """Records an item dropped because the input queue was full"""
+        with self._lock:
+            self.dropped += 1
+
+    def summary(self):
+        """Returns a dictionary of the counters (latencies in ms)"""
+        with self._lock:
+            return {
+                "stage": self.name,
+                "count": self.count,
+                "dropped": self.dropped,
+                "mean_latency_ms": 1000. * self.total_latency / self.count if self.count else 0.,
+                "max_latency_ms": 1000. * self.max_latency,
+                "mean_queue_depth": self.total_depth / self.depth_samples if self.depth_samples else 0.,
+                "max_queue_depth": self.max_depth,
+                "queue_size": self.maxsize,
+            }
+
+
+def format_stats(stats_list):
+    """Formats the summary of several stages as a table
+
+    Args:
+        stats_list (list): list of StageStats
+
+    Returns:
+        str: one line per stage
+    """
+    header = "{:<12} {:>8} {:>8} {:>10} {:>10} {:>11} {:>10}".format(
+        "stage", "count", "dropped", "mean(ms)", "max(ms)", "mean depth", "max depth")
+    lines = [header]
+    for stats in stats_list:
+        s = stats.summary()
+        lines.append("{:<12} {:>8d} {:>8d} {:>10.2f} {:>10.2f} {:>11.2f} {:>6d}/{:<3d}".format(
+            s["stage"], s["count"], s["dropped"], s["mean_latency_ms"], s["max_latency_ms"],
+            s["mean_queue_depth"], s["max_queue_depth"], s["queue_size"]))
+    return "\n".join(lines)
+
+
+class Stage(object):
+    """Consumes items from a bounded queue and applies a function to each of them
+
+    The stage usually runs in its own thread (see `start`), but it can also be run in the calling thread
+    (see `run`), which is required for OpenCV display windows.
+    When the end of stream is received, it is forwarded to the downstream stages.
+
+    Args:
+        name (str): name of the stage
+        fn (function): function called on each item. If it returns False, the shared stop event is set
+        stop_event (threading.Event): event shared by all the stages of a pipeline, set to request an early stop
+        maxsize (int): capacity of the input queue
+        drop_when_full (boolean): if True, items are dropped instead of blocking the caller when the queue is full
+        downstream (list): stages that receive the end of stream after this one
+    """
+
+    def __init__(self, name, fn, stop_event, maxsize=8, drop_when_full=False, downstream=()):
+        self.name = name
+        self.fn = fn
+        self.stop_event = stop_event
+        self.drop_when_full = drop_when_full
+        self.downstream = list(downstream)
+        self.queue = queue.Queue(maxsize)
+        self.stats = StageStats(name, maxsize)
+        self.error = None
+        self._thread = None
+
+    def put(self, item):
+        """Sends an item to the stage
+
+        Returns:
+            boolean: False if the item was dropped or the pipeline is stopping
+        """
+        self.stats.record_depth(self.queue.qsize())
+        if self.drop_when_full:
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except queue.Full:
+                self.stats.record_drop()
+                return False
+        return self._blocking_put(item)
+
+    def finish(self):
+        """Signals the end of stream, this call blocks until there is room in the queue"""
+        self._blocking_put(_STOP, force=True)
+
+    def _blocking_put(self, item, force=False):
+        while True:
+            try:
+                self.queue.put(item, timeout=_POLL_PERIOD_S)
+                return True
+            except queue.Full:
+                # a dead consumer keeps draining its queue, so only give up on regular items
+                if self.stop_event.is_set() and not force:
+                    return False
+
+    def start(self):
+        """Runs the stage in a background thread"""
+        self._thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def run(self):
+        """Consumes the queue until the end of stream is received"""
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            if self.error is not None:
+                continue
+            start = time.perf_counter()
+            try:
+                keep_going = self.fn(item)
+            except Exception as e:  # forwarded to the main thread by `join`
+                self.error = e
+                self.stop_event.set()
+                continue
+            self.stats.record_latency(time.perf_counter() - start)
+            if keep_going is False:
+                self.stop_event.set()
+        for stage in self.downstream:
+            stage.finish()
+
+    def join(self):
+        """Waits for the thread to finish and raises the error it met, if any"""
+        if self._thread is not None:
+            self._thread.join()
+        if self.error is not None:
+            raise RuntimeError(f"pipeline stage '{self.name}' failed") from self.error
+
+
+class Source(object):
+    """Pushes the items of an iterable into stages from a background thread, then signals the end of stream
+
+    Args:
+        name (str): name of the source
+        iterable: source of items (typically a CDProcessorIterator)
+        stages (list): stages receiving each item, a single Stage is also accepted
+        stop_event (threading.Event): stops the iteration when set
+        transform (function): optional function applied on each item before sending it
+    """
+
+    def __init__(self, name, iterable, stages, stop_event, transform=None):
+        self.name = name
+        self.iterable = iterable
+        self.stages = [stages] if isinstance(stages, Stage) else list(stages)
+        self.stop_event = stop_event
+        self.transform = transform
+        self.stats = StageStats(name)
+        self.error = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def run(self):
+        try:
+            iterator = iter(self.iterable)
+            while not self.stop_event.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                if self.transform is not None:
+                    item = self.transform(item)
+                self.stats.record_latency(time.perf_counter() - start)
+                if not all([stage.put(item) for stage in self.stages]) and self.stop_event.is_set():
+                    break
+        except Exception as e:  # forwarded to the main thread by `join`
+            self.error = e
+            self.stop_event.set()
+        finally:
+            for stage in self.stages:
+                stage.finish()
+
+    def join(self):
+        """Waits for the thread to finish and raises the error it met, if any"""
+        if self._thread is not None:
+            self._thread.join()
+        if self.error is not None:
+            raise RuntimeError(f"pipeline source '{self.name}' failed") from self.error
@@ -0,0 +1,121 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Inference optimization of the exported TorchScript classifiers and CPU latency report
+
+torch.jit.freeze inlines the parameters and the submodules as constants and folds the batch norms into the
+preceding convolutions, torch.jit.optimize_for_inference then applies the CPU graph rewrites (conv-add/mul
+folding, MKLDNN layouts where they pay off). The state of the RNN cells is modified by forward, so it stays an
+attribute of the frozen module, and reset_all/reset are preserved.
+
+A model exported with channels_last expects its inputs in the NHWC layout as well, otherwise every convolution
+converts them: the inference scripts convert the tensors with to_channels_last when the model json records it.
+"""
+
+import os
+import time
+
+import numpy as np
+import torch
+
+
+def optimize_jit_model(jit_model, rnn, channels_last=False):
+    """Returns the frozen and optimized copy of a scripted classifier, in eval mode on CPU
+
+    Args:
+        jit_model (torch.jit.ScriptModule): scripted classifier
+        rnn (boolean): True for RNN models, whose reset methods must be kept
+        channels_last (boolean): if True, the weights of the convolutions are converted to the NHWC layout
+    """
+    jit_model = jit_model.eval()
+    if channels_last:
+        jit_model = jit_model.to(memory_format=torch.channels_last)
+    preserved_attrs = ["reset_all", "reset"] if rnn else []
+    frozen = torch.jit.freeze(jit_model, preserved_attrs=preserved_attrs)
+    return torch.jit.optimize_for_inference(frozen, other_methods=preserved_attrs)
+
+
+def to_channels_last(x):
+    """Returns x in the channels last layout
+
+    The (T, N, C, H, W) inputs of the RNN models are laid out so that their frames are channels last once the
+    model flattens T and N.
+    """
+    if x.dim() == 4:
+        return x.contiguous(memory_format=torch.channels_last)
+    assert x.dim() == 5, "expected a tensor of shape (N, C, H, W) or (T, N, C, H, W)"
+    return x.permute(0, 1, 3, 4, 2).contiguous().permute(0, 1, 4, 2, 3)
+
+
+def is_channels_last(model_json):
+    """True if the model json records a model optimized for channels last inputs"""
+    return bool((model_json.get("optimization") or {}).get("channels_last"))
+
+
+@torch.no_grad()
+def check_optimized(reference, optimized, x, rnn, num_steps=3, rtol=1e-4, atol=1e-4, optimized_x=None):
+    """Checks that the optimized model gives the outputs of the reference over a few steps
+
+    The folded operations change the rounding of the results, hence a larger tolerance than for the plain
+    scripted model. optimized_x is the input of the optimized model if it differs from x, e.g. channels last.
+    """
+    optimized_x = x if optimized_x is None else optimized_x
+    if rnn:
+        reference.reset_all()
+        optimized.reset_all()
+    for _ in range(num_steps if rnn else 1):
+        np.testing.assert_allclose(reference(x).cpu().numpy(), optimized(optimized_x).cpu().numpy(), rtol=rtol,
+                                   atol=atol)
+    if rnn:
+        reference.reset_all()
+        optimized.reset_all()
+    print("optimized torchjit result has been tested, OK")
+
+
+def default_threads():
+    """1, 2, 4 and all the cores of the machine"""
+    return sorted({n for n in (1, 2, 4) if n <= os.cpu_count()} | {os.cpu_count()})
+
+
+@torch.no_grad()
+def latency_table(models, x, threads=None, num_iters=100, warmup=10, inputs=None):
+    """Measures the latency of one forward call of each model at several numbers of threads
+
+    Args:
+        models (dict): name -> model
+        x (torch.Tensor): input at the real shape of a timeslice
+        threads (list): numbers of torch threads, see default_threads
+        inputs (dict): name -> input of the models which aren't fed with x
+
+    Returns:
+        rows (list): one dictionary per (model, number of threads)
+    """
+    initial_threads = torch.get_num_threads()
+    rows = []
+    for num_threads in threads or default_threads():
+        torch.set_num_threads(num_threads)
+        for name, model in models.items():
+            model_x = (inputs or {}).get(name, x)
+            latencies = []
+            for i in range(warmup + num_iters):
+                start = time.perf_counter()
+                model(model_x)
+                if i >= warmup:
+                    latencies.append(1000 * (time.perf_counter() - start))
+            rows.append({"model": name, "threads": num_threads, "p50_ms": float(np.percentile(latencies, 50)),
+                         "p95_ms": float(np.percentile(latencies, 95)),
+                         "fps": 1000 / float(np.mean(latencies))})
+    torch.set_num_threads(initial_threads)
+    return rows
+
+
+def format_latency_table(rows):
+    header = f"{'model':<12}{'threads':>8}{'p50 ms':>10}{'p95 ms':>10}{'frames/s':>10}"
+    lines = [header, "-" * len(header)]
+    for r in rows:
+        lines.append(f"{r['model']:<12}{r['threads']:>8}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}{r['fps']:>10.1f}")
+    return "\n".join(lines)
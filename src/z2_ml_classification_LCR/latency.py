@@ -0,0 +1,170 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Per-frame latency instrumentation of the inference
+"""
+
+import contextlib
+import json
+import math
+import threading
+import time
+
+import numpy as np
+import torch
+
+from metavision_core.event_io import EventsIterator
+from metavision_ml.preprocessing import CDProcessor
+
+# stages timed for each frame, in the order of the pipeline
+STAGES = ["ingest", "preprocess", "h2d", "forward", "postprocess", "sinks", "pipeline"]
+STAGE_HELP = {"ingest": "decoding of the events of the timeslice",
+              "preprocess": "computation of the tensor from the events",
+              "h2d": "copy of the tensor to the device",
+              "forward": "model forward call",
+              "postprocess": "softmax, low activity and reset logic, rolling average",
+              "sinks": "one call of a console or score file sink",
+              "pipeline": "from the tensor being produced to its scores being available, queues included"}
+
+
+def synchronize(device):
+    """Waits for the kernels queued on a CUDA device, so that they are included in the timings"""
+    if device is not None and torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+class LatencyRecorder(object):
+    """Thread-safe record of the duration of each stage for every frame
+
+    Args:
+        histogram_bins (int): number of log-spaced bins of the histograms exported with the percentiles
+    """
+
+    def __init__(self, histogram_bins=30):
+        self._lock = threading.Lock()
+        self.histogram_bins = histogram_bins
+        self.durations = {stage: [] for stage in STAGES}
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.durations.setdefault(stage, []).append(seconds)
+
+    def timer(self, stage, device=None):
+        """Context manager recording the duration of its block"""
+        return _Timer(self, stage, device)
+
+    def summary(self):
+        """Returns, for each stage with measures, its statistics and histogram in milliseconds"""
+        with self._lock:
+            durations = {stage: np.array(values) * 1000 for stage, values in self.durations.items() if values}
+        summary = {}
+        for stage, ms in durations.items():
+            lo, hi = max(ms.min(), 1e-3), max(ms.max(), 1e-3)
+            edges = np.logspace(math.log10(lo), math.log10(hi) + 1e-9, self.histogram_bins + 1)
+            counts, _ = np.histogram(np.clip(ms, lo, hi), bins=edges)
+            summary[stage] = {"count": int(len(ms)),
+                              "mean_ms": float(ms.mean()),
+                              "p50_ms": float(np.percentile(ms, 50)),
+                              "p95_ms": float(np.percentile(ms, 95)),
+                              "p99_ms": float(np.percentile(ms, 99)),
+                              "max_ms": float(ms.max()),
+                              "histogram": {"edges_ms": edges.tolist(), "counts": counts.tolist()}}
+        return summary
+
+    def save(self, path, metadata=None):
+        """Writes the summary in a JSON file, with the parameters of the run in `metadata`"""
+        with open(path, "w") as f:
+            json.dump({"metadata": metadata or {}, "stages": self.summary(), "stage_help": STAGE_HELP}, f,
+                      indent=4, default=str)
+
+    def format(self):
+        lines = [f"{'stage':<12}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        for stage, s in self.summary().items():
+            lines.append(f"{stage:<12}{s['count']:>8}{s['mean_ms']:>10.3f}{s['p50_ms']:>10.3f}{s['p95_ms']:>10.3f}"
+                         f"{s['p99_ms']:>10.3f}{s['max_ms']:>10.3f}")
+        return "\n".join(lines)
+
+
+class _NullRecorder(object):
+    """Recorder ignoring the durations, used when the iterator isn't instrumented"""
+
+    def record(self, stage, seconds):
+        pass
+
+    def timer(self, stage, device=None):
+        return contextlib.nullcontext()
+
+
+class _Timer(object):
+
+    def __init__(self, recorder, stage, device):
+        self.recorder = recorder
+        self.stage = stage
+        self.device = device
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        synchronize(self.device)
+        self.recorder.record(self.stage, time.perf_counter() - self.start)
+
+
+class InstrumentedCDProcessorIterator(object):
+    """Equivalent of CDProcessorIterator timing the ingest, preprocess and h2d stages of every timeslice
+
+    It can also compute the tensors of any iterator of event arrays, e.g. a SyntheticEventsIterator.
+
+    Args:
+        path (str): RAW or DAT file, or "" for a live camera
+        preprocess (str): name of the preprocessing function
+        delta_t (int): duration of a timeslice in us
+        recorder (LatencyRecorder): where the durations are recorded, if None nothing is timed
+        device (torch.device): device of the tensors
+        height (int): output height, if None the sensor resolution is used
+        width (int): output width, if None the sensor resolution is used
+        start_ts (int): timestamp in us from which the computation begins
+        max_duration (int): maximum duration in us
+        preprocess_kwargs (dict): parameters of the preprocessing function
+        events_iterator (iterable): optional iterator of event arrays used instead of an EventsIterator on path,
+            it must provide get_size() and get_current_time()
+    """
+
+    def __init__(self, path, preprocess, delta_t, recorder, device=torch.device("cpu"), height=None, width=None,
+                 start_ts=0, max_duration=None, preprocess_kwargs={}, events_iterator=None):
+        self.mv_it = events_iterator if events_iterator is not None else \
+            EventsIterator(path, start_ts=start_ts, delta_t=delta_t, max_duration=max_duration)
+        sensor_height, sensor_width = self.mv_it.get_size()
+        downsampling_factor = 0
+        if height is not None and height != sensor_height:
+            downsampling_factor = int(round(math.log2(sensor_height / height)))
+        self.processor = CDProcessor(sensor_height, sensor_width, num_tbins=1, preprocessing=preprocess,
+                                     downsampling_factor=downsampling_factor, preprocess_kwargs=preprocess_kwargs)
+        self.delta_t = delta_t
+        self.recorder = recorder if recorder is not None else _NullRecorder()
+        self.device = device
+
+    def get_time(self):
+        return self.mv_it.get_current_time()
+
+    def __iter__(self):
+        frame = self.processor.init_output_tensor()
+        events_it = iter(self.mv_it)
+        while True:
+            start = time.perf_counter()
+            try:
+                events = next(events_it)
+            except StopIteration:
+                return
+            self.recorder.record("ingest", time.perf_counter() - start)
+            with self.recorder.timer("preprocess"):
+                frame[...] = 0
+                self.processor.process_events(self.mv_it.get_current_time() - self.delta_t, events, frame)
+            with self.recorder.timer("h2d", self.device):
+                tensor = torch.from_numpy(frame).to(self.device)
+            yield tensor
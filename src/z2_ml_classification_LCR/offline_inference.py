@@ -0,0 +1,247 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Batched offline inference on precomputed HDF5 tensor files
+"""
+
+import os
+import glob
+import numpy as np
+import torch
+
+from jit_optimization import is_channels_last, to_channels_last
+from score_writers import save_cls_h5, save_results_csv, scores_to_rows
+from sparse_hdf5 import make_hdf5_iterator
+
+
+@torch.no_grad()
+def infer_ff_batched(path, cls_model, model_json, batch_size, delta_t, device, height, width, roi=None):
+    """Runs a feed forward model on a precomputed HDF5 file, `batch_size` timeslices at a time
+
+    The timeslices are read as large contiguous chunks of the "data" dataset and each chunk is
+    classified in a single forward call.
+
+    Args:
+        path (str): path to the precomputed HDF5 file
+        cls_model (torch.jit.ScriptModule): feed forward classifier
+        model_json (dict): model description
+        batch_size (int): number of timeslices per forward call
+        delta_t (int): duration of a timeslice in us
+        device (torch.device): device on which the model runs
+        height (int): input height of the model
+        width (int): input width of the model
+        roi (Roi): optional region of interest cropped from the timeslices
+
+    Returns:
+        scores (np.ndarray): softmax scores of shape (num_frames, num_classes)
+    """
+    preprocessor = make_hdf5_iterator(path, num_tbins=batch_size, device=device, height=height, width=width)
+    preprocessor.checks(model_json["preprocess"], delta_t=delta_t)
+    num_classes = len(model_json["label_map"])
+    scores = []
+    for batch in preprocessor:
+        if roi is not None:
+            batch = roi(batch)
+        if is_channels_last(model_json):
+            batch = to_channels_last(batch)
+        out = cls_model(batch).reshape(-1, num_classes)
+        scores.append(torch.nn.functional.softmax(out, dim=-1).cpu().numpy())
+    return np.concatenate(scores) if scores else np.zeros((0, num_classes), dtype=np.float32)
+
+
+class _RecordingStream(object):
+    """Reads the timeslices of a precomputed HDF5 file and keeps the state of the low activity logic"""
+
+    def __init__(self, path, chunk_size, model_json, delta_t, device, height, width, roi=None):
+        self.path = path
+        self.roi = roi
+        preprocessor = make_hdf5_iterator(path, num_tbins=chunk_size, device=device, height=height, width=width)
+        preprocessor.checks(model_json["preprocess"], delta_t=delta_t)
+        self.iterator = iter(preprocessor)
+        self.buffer = None
+        self.exhausted = False
+        self.nb_consecutive_low_activity_frames = 0
+        self.scores = []
+
+    def peek(self, n):
+        """Returns up to n timeslices, without consuming them"""
+        while not self.exhausted and (self.buffer is None or len(self.buffer) < n):
+            try:
+                chunk = next(self.iterator)
+            except StopIteration:
+                self.exhausted = True
+                break
+            if self.roi is not None:
+                chunk = self.roi(chunk)
+            self.buffer = chunk if self.buffer is None else torch.cat((self.buffer, chunk))
+        return self.buffer[:n] if self.buffer is not None else None
+
+    def consume(self, n):
+        self.buffer = self.buffer[n:] if self.buffer is not None else None
+
+    @property
+    def done(self):
+        return self.exhausted and (self.buffer is None or not len(self.buffer))
+
+
+def _first_reset(low_activity, nb_consecutive_low_activity_frames, max_low_activity_nb_frames):
+    """Returns the index of the frame after which the state is reset, or None"""
+    for i, is_low in enumerate(low_activity):
+        nb_consecutive_low_activity_frames = nb_consecutive_low_activity_frames + 1 if is_low else 0
+        if nb_consecutive_low_activity_frames >= max_low_activity_nb_frames:
+            return i
+    return None
+
+
+@torch.no_grad()
+def infer_rnn_sequences(paths, cls_model, model_json, seq_len, batch_size, delta_t, device, height, width,
+                        max_low_activity_tensor, max_low_activity_nb_frames, reset_memory=True, roi=None):
+    """Runs a recurrent model on several precomputed HDF5 files at once
+
+    The recordings are spread over `batch_size` slots along the batch dimension of the model and each
+    forward call processes up to `seq_len` consecutive timeslices. Each slot has its own hidden state, which
+    is reset when a new recording starts in it or when its recording has `max_low_activity_nb_frames`
+    consecutive low activity frames. Since a reset can only happen between two forward calls, a window is
+    shortened to end on the first frame triggering a reset in any slot: the scores are the same as
+    when the recordings are processed one frame at a time.
+
+    Args:
+        paths (list): paths to the precomputed HDF5 files
+        cls_model (torch.jit.ScriptModule): recurrent classifier taking [T, B, C, H, W] tensors
+        model_json (dict): model description
+        seq_len (int): maximum number of timeslices per forward call (T)
+        batch_size (int): number of recordings processed in parallel (B)
+        delta_t (int): duration of a timeslice in us
+        device (torch.device): device on which the model runs
+        height (int): input height of the model
+        width (int): input width of the model
+        max_low_activity_tensor (float): maximum tensor value for a frame to be considered as low activity
+        max_low_activity_nb_frames (int): number of low activity frames before the state is reset
+        reset_memory (boolean): if False, the state is only reset when a new recording starts
+        roi (Roi): optional region of interest cropped from the timeslices
+
+    Returns:
+        scores (dict): softmax scores of shape (num_frames, num_classes) for each path
+    """
+    num_classes = len(model_json["label_map"])
+    pending = list(paths)
+    batch_size = min(batch_size, len(pending))
+    results = {}
+
+    def next_stream():
+        return _RecordingStream(pending.pop(0), seq_len, model_json, delta_t, device, height, width, roi) \
+            if pending else None
+
+    def finish(stream):
+        results[stream.path] = np.concatenate(stream.scores) if stream.scores \
+            else np.zeros((0, num_classes), dtype=np.float32)
+        print(f"{os.path.basename(stream.path)}: {len(results[stream.path])} frames classified")
+
+    slots = [next_stream() for _ in range(batch_size)]
+    cls_model.reset_all()
+    while any(stream is not None for stream in slots):
+        windows = [stream.peek(seq_len) if stream is not None else None for stream in slots]
+        lows = [(window.flatten(1).max(dim=1)[0] < max_low_activity_tensor).tolist()
+                if window is not None else [] for window in windows]
+
+        # shorten the window so that it ends on the first reset of any slot
+        length = max(len(low) for low in lows)
+        if reset_memory:
+            for stream, low in zip(slots, lows):
+                if stream is not None:
+                    reset_index = _first_reset(low, stream.nb_consecutive_low_activity_frames,
+                                               max_low_activity_nb_frames)
+                    if reset_index is not None:
+                        length = min(length, reset_index + 1)
+
+        if length > 0:
+            # finished or empty slots are padded with zeros, their outputs are ignored
+            frame_shape = next(window for window in windows if window is not None).shape[1:]
+            x = torch.zeros((length, batch_size) + tuple(frame_shape), device=device)
+            for b, window in enumerate(windows):
+                if window is not None:
+                    x[:min(length, len(window)), b] = window[:length]
+            if is_channels_last(model_json):
+                x = to_channels_last(x)
+            out = cls_model(x).reshape(length, batch_size, num_classes)
+            yhat = torch.nn.functional.softmax(out, dim=-1).cpu().numpy()
+
+        keep_memory = torch.ones(batch_size, device=device)
+        for b, stream in enumerate(slots):
+            if stream is None:
+                continue
+            n = min(length, len(lows[b]))
+            if n:
+                stream.scores.append(yhat[:n, b])
+            stream.consume(n)
+            for is_low in lows[b][:n]:
+                stream.nb_consecutive_low_activity_frames = \
+                    stream.nb_consecutive_low_activity_frames + 1 if is_low else 0
+            if reset_memory and stream.nb_consecutive_low_activity_frames >= max_low_activity_nb_frames:
+                stream.nb_consecutive_low_activity_frames = 0
+                keep_memory[b] = 0
+            if stream.done:
+                finish(stream)
+                slots[b] = next_stream()
+                keep_memory[b] = 0
+        if not keep_memory.all():
+            if batch_size == 1:
+                cls_model.reset_all()
+            else:
+                cls_model.reset(keep_memory)
+    return results
+
+
+def get_h5_paths(path):
+    """Returns the HDF5 files given as a single file, a directory or a glob pattern"""
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.h5")))
+    return sorted(glob.glob(path))
+
+
+def run_offline(args, cls_model, model_json, device, height, width, h5_attrs, roi=None):
+    """Offline mode of the inference script: no display, the outputs are written once at the end
+
+    `args.path` can be a single HDF5 file, a directory or a glob pattern. Feed forward models classify
+    `args.batch_size` timeslices per forward call, recurrent models process `args.batch_size` recordings
+    in parallel with `args.seq_len` timeslices per forward call.
+
+    Args:
+        args: parsed arguments of the inference script
+        cls_model (torch.jit.ScriptModule): classifier
+        model_json (dict): model description
+        device (torch.device): device on which the model runs
+        height (int): input height of the model
+        width (int): input width of the model
+        h5_attrs (dict): attributes of the "cls" dataset of the HDF5 output
+        roi (Roi): optional region of interest cropped from the timeslices
+    """
+    paths = get_h5_paths(args.path)
+    assert len(paths) > 0 and all(p.endswith('h5') for p in paths), \
+        "the offline mode only works on precomputed HDF5 files"
+
+    if args.use_FF_model:
+        scores = {path: infer_ff_batched(path, cls_model, model_json, args.batch_size, args.delta_t, device,
+                                         height, width, roi=roi) for path in paths}
+        for path in paths:
+            print(f"{os.path.basename(path)}: {len(scores[path])} frames classified")
+    else:
+        scores = infer_rnn_sequences(paths, cls_model, model_json, args.seq_len, args.batch_size, args.delta_t,
+                                     device, height, width, args.max_low_activity_tensor,
+                                     args.max_low_activity_nb_frames, reset_memory=args.display_reset_memory,
+                                     roi=roi)
+
+    for path in paths:
+        filename = os.path.splitext(os.path.basename(path))[0]
+        attrs = dict(h5_attrs, input_file_name=os.path.basename(path))
+        if args.save_h5:
+            os.makedirs(args.save_h5, exist_ok=True)
+            save_cls_h5(os.path.join(args.save_h5, filename + '_cls.h5'), scores[path], args.delta_t, attrs)
+        if args.output_csv:
+            # with several recordings, --output-csv is a directory
+            csv_path = args.output_csv if len(paths) == 1 else os.path.join(args.output_csv, filename + '.csv')
+            save_results_csv(scores_to_rows(scores[path], model_json["label_map"]), csv_path)
@@ -0,0 +1,156 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+ONNX export of the classifiers and ONNX Runtime CPU backend of the inference
+
+The hidden state of the RNN models, kept in the attributes of their cells by TorchScript, is an explicit input and
+output of the ONNX graph: the graph computes (logits, next state) from (input, state) and the backend feeds the
+state back between two calls.
+"""
+
+import os
+
+import numpy as np
+import torch
+
+from rnn_state import get_state, is_stateful, set_state
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+ONNX_FILE = "model_classifier.onnx"
+BACKENDS = ("torchscript", "onnxruntime")
+
+
+def _onnx_name(key):
+    return key.replace(".", "_")
+
+
+class _StatefulWrapper(torch.nn.Module):
+    """Classifier taking its hidden state as inputs and returning the next state with its logits"""
+
+    def __init__(self, classifier, state_keys):
+        super().__init__()
+        self.classifier = classifier
+        self.state_keys = state_keys
+
+    def forward(self, x, *state):
+        set_state(self.classifier, dict(zip(self.state_keys, state)))
+        out = self.classifier(x)
+        next_state = get_state(self.classifier)
+        return (out,) + tuple(next_state[key] for key in self.state_keys)
+
+
+@torch.no_grad()
+def export_onnx(classifier, x, out_directory, opset=17):
+    """Exports a classifier in ONNX, with its hidden state as explicit inputs and outputs for RNN models
+
+    Args:
+        classifier (torch.nn.Module): float classifier, in eval mode on CPU
+        x (torch.Tensor): input of the model, of shape (1, 1, C, H, W) for an RNN or (1, C, H, W)
+        out_directory (str): directory where the graph is written
+        opset (int): ONNX opset version
+
+    Returns:
+        dict: description of the graph written in the json
+    """
+    path = os.path.join(out_directory, ONNX_FILE)
+    if not is_stateful(classifier):
+        torch.onnx.export(classifier, (x,), path, input_names=["input"], output_names=["logits"],
+                          dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}}, opset_version=opset)
+        return {"file": ONNX_FILE, "opset": opset, "state": []}
+
+    # the shapes of the state are those it has once the cells have seen an input
+    classifier.reset_all()
+    classifier(x)
+    state = get_state(classifier)
+    classifier.reset_all()
+    keys = list(state)
+    torch.onnx.export(_StatefulWrapper(classifier, keys), (x,) + tuple(torch.zeros_like(state[key]) for key in keys),
+                      path, input_names=["input"] + ["state_in_" + _onnx_name(key) for key in keys],
+                      output_names=["logits"] + ["state_out_" + _onnx_name(key) for key in keys],
+                      opset_version=opset)
+    classifier.reset_all()
+    return {"file": ONNX_FILE, "opset": opset,
+            "state": [{"key": key, "input": "state_in_" + _onnx_name(key), "output": "state_out_" + _onnx_name(key),
+                       "shape": list(state[key].shape)} for key in keys]}
+
+
+class OnnxClassifier(object):
+    """ONNX Runtime session with the call interface of the TorchScript feedforward classifiers
+
+    Args:
+        path (str): ONNX graph
+        onnx_json (dict): description of the graph written by export_onnx
+        num_threads (int): number of intra-op threads of ONNX Runtime, its default if None
+    """
+
+    def __init__(self, path, onnx_json, num_threads=None):
+        assert ort is not None, "onnxruntime is required to run ONNX models"
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.onnx_json = onnx_json
+
+    def __call__(self, x):
+        out = self.session.run(["logits"], {"input": x.detach().cpu().numpy().astype(np.float32)})
+        return torch.from_numpy(out[0])
+
+    def to(self, device):
+        assert torch.device(device).type == "cpu", "ONNX Runtime models run on CPU"
+        return self
+
+    def eval(self):
+        return self
+
+
+class OnnxRNNClassifier(OnnxClassifier):
+    """ONNX Runtime session of an RNN classifier, keeping the state between calls like the TorchScript models"""
+
+    def __init__(self, path, onnx_json, num_threads=None):
+        super().__init__(path, onnx_json, num_threads)
+        self.state_inputs = [item["input"] for item in onnx_json["state"]]
+        self.output_names = ["logits"] + [item["output"] for item in onnx_json["state"]]
+        self.empty = {item["input"]: np.zeros(item["shape"], dtype=np.float32) for item in onnx_json["state"]}
+        self.reset_all()
+
+    def __call__(self, x):
+        feeds = {"input": x.detach().cpu().numpy().astype(np.float32), **self.state}
+        out = self.session.run(self.output_names, feeds)
+        self.state = dict(zip(self.state_inputs, out[1:]))
+        return torch.from_numpy(out[0])
+
+    def reset_all(self):
+        self.state = dict(self.empty)
+
+
+def load_onnx_model(torchscript_dir, model_json, num_threads=None):
+    """Loads the ONNX graph of an export directory as a classifier"""
+    onnx_json = model_json.get("onnx")
+    assert onnx_json, f"{torchscript_dir} has no ONNX graph, export it with --onnx"
+    cls = OnnxRNNClassifier if onnx_json["state"] else OnnxClassifier
+    return cls(os.path.join(torchscript_dir, onnx_json["file"]), onnx_json, num_threads=num_threads)
+
+
+@torch.no_grad()
+def check_onnx(classifier, out_directory, onnx_json, x, num_steps=3, rtol=1e-3, atol=1e-4):
+    """Checks that ONNX Runtime gives the outputs of the classifier over a few steps, the state included"""
+    if ort is None:
+        print("Warning: onnxruntime isn't installed, the ONNX graph isn't tested")
+        return
+    onnx_model = load_onnx_model(out_directory, {"onnx": onnx_json})
+    if is_stateful(classifier):
+        classifier.reset_all()
+    for _ in range(num_steps):
+        np.testing.assert_allclose(onnx_model(x).numpy(), classifier(x).numpy(), rtol=rtol, atol=atol)
+    if is_stateful(classifier):
+        classifier.reset_all()
+    print("onnx result has been tested, OK")
@@ -0,0 +1,254 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Structured channel pruning of a trained classifier, for low-power targets
+
+For each sparsity level, the channels of the convolutions with the lowest L1 (or L2) norm are removed from a copy
+of the trained model, the dependent layers (batch norms, next convolutions) being sliced accordingly, so that the
+pruned network is physically smaller. It is then fine-tuned for a few epochs on the data it was trained on,
+tested, and exported with export_classifier.
+
+Only the feature extractor is pruned. The recurrent cells split the output of their gate convolutions with their
+integer hidden_dim and read their hidden state from an attribute, which the traced graph doesn't show, so the
+layers of the recurrent blocks and the classifier head keep all their channels. Only the input channels of the
+recurrent blocks follow the pruned features.
+
+The dependencies between layers are resolved by torch-pruning (pip install torch-pruning).
+
+Example:
+python3 prune_classifier.py Data_results/EVK_4_LCR/checkpoints/epoch=50.ckpt pruned/ --sparsity 0.25 0.5 0.75 \
+    --epochs 5
+"""
+
+import argparse
+import copy
+import csv
+import os
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+from metavision_ml.classification import get_data_module, get_model_class, is_rnn
+
+from benchmark_roi import count_flops, measure_latency
+from export_classifier import export_classifier
+from rnn_state import STATE_ATTRIBUTES
+from sparse_hdf5 import SparseClassificationDataModule
+
+try:
+    import torch_pruning as tp
+except ImportError:
+    tp = None
+
+CRITERIA = ("l1", "l2")
+
+
+def prune_parser():
+    parser = argparse.ArgumentParser(description='Prune, fine-tune and export a trained classifier',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('checkpoint', type=str, help='checkpoint of the trained model')
+    parser.add_argument('output_dir', type=str, help='one export directory per sparsity level is created in it')
+    parser.add_argument('--sparsity', type=float, nargs="+", default=[0.25, 0.5, 0.75],
+                        help='fractions of the channels removed from each pruned convolution')
+    parser.add_argument('--criterion', default="l1", choices=CRITERIA, help='norm ranking the channels')
+    parser.add_argument('--head', type=str, default=None,
+                        help='name of the classifier head in the network (e.g. "head"), whose output channels are '
+                             'kept. If not set, the last Linear or Conv2d layer run by the forward call')
+    parser.add_argument('--epochs', type=int, default=5, help='number of fine-tuning epochs after pruning')
+    parser.add_argument('--lr', type=float, default=None, help='fine-tuning learning rate, defaults to the training '
+                                                               'one')
+    parser.add_argument('--dataset_path', type=str, default=None,
+                        help='dataset of the fine-tuning and test, defaults to the training dataset')
+    parser.add_argument('--limit_train_batches', type=float, default=1.0,
+                        help='limit train batches to fraction of dataset')
+    parser.add_argument('--cpu', action='store_true', help='fine-tune on CPU')
+    parser.add_argument('--threads', type=int, default=1, help='number of torch threads of the latency measure')
+    parser.add_argument('--num-iters', type=int, default=50, help='number of timed forward calls')
+    return parser
+
+
+def load_lightning_model(checkpoint_path, dataset_path=None):
+    """Loads a trained model with its hyperparameters, as export_classifier.main does"""
+    checkpoint = torch.load(checkpoint_path, map_location=torch.device('cpu'))
+    hparams = argparse.Namespace(**checkpoint['hyper_parameters'])
+    if not hasattr(hparams, "preprocess_channels"):
+        hparams.preprocess_channels = hparams.in_channels
+    if dataset_path is not None:
+        hparams.dataset_path = dataset_path
+    model = get_model_class(hparams.models)(hparams)
+    model.load_state_dict(checkpoint['state_dict'])
+    return model, hparams
+
+
+def example_input(hparams):
+    """One timeslice at the input shape of the model"""
+    if is_rnn(hparams.models):
+        return torch.rand((1, 1, hparams.preprocess_channels, hparams.height, hparams.width))
+    return torch.rand((1, hparams.preprocess_channels * hparams.num_ev_reps, hparams.height, hparams.width))
+
+
+@torch.no_grad()
+def head_layer(net, x, name=None):
+    """Classifier head of a network, whose output channels are the class scores
+
+    Args:
+        net (torch.nn.Module): network of the lightning model
+        x (torch.Tensor): example input
+        name (str): name of the head in the network. If None, the last Linear or Conv2d layer run by the forward
+            call, in execution order.
+    """
+    if name is not None:
+        return net.get_submodule(name)
+    executed = []
+    hooks = [module.register_forward_hook(lambda module, inputs, output: executed.append(module))
+             for module in net.modules() if isinstance(module, (torch.nn.Linear, torch.nn.Conv2d))]
+    if hasattr(net, "reset_all"):
+        net.reset_all()
+    try:
+        net(x)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    assert executed, "the network has no Linear nor Conv2d layer"
+    return executed[-1]
+
+
+def recurrent_layers(net):
+    """Layers of the recurrent blocks: the cells holding a hidden state and the modules containing them
+
+    The gates of a cell are split with its integer hidden_dim and its recurrent convolution reads the previous
+    state from an attribute, so none of these layers can be sliced by the pruner.
+    """
+    layers = []
+    for name, module in net.named_modules():
+        if name and any(hasattr(module, attr) for attr in STATE_ATTRIBUTES + ("hidden_dim",)):
+            # the block holding the cell also holds its input-to-hidden gate convolution
+            parent_name = name.rpartition(".")[0]
+            block = net.get_submodule(parent_name) if parent_name else module
+            layers += [m for m in block.modules() if m not in layers]
+    return layers
+
+
+def prune_net(net, x, sparsity, criterion="l1", head=None):
+    """Removes the least important output channels of the convolutions of the feature extractor, in place
+
+    Args:
+        net (torch.nn.Module): network of the lightning model, on CPU
+        x (torch.Tensor): example input, used to trace the dependencies between the layers
+        sparsity (float): fraction of the channels removed from each convolution
+        criterion (str): l1 or l2 norm of the weights of a channel
+        head (str): name of the classifier head, see head_layer
+    """
+    assert tp is not None, "torch-pruning is required to prune the models"
+    assert criterion in CRITERIA, f"criterion should be one of {CRITERIA}"
+    rnn = hasattr(net, "reset_all")
+    # the forward calls below must not update the statistics of the batch norms
+    training = net.training
+    net.eval()
+    ignored_layers = [head_layer(net, x, head)] + recurrent_layers(net)
+    if rnn:
+        net.reset_all()
+    with torch.no_grad():
+        expected_shape = net(x).shape
+    if rnn:
+        net.reset_all()
+    pruner = tp.pruner.MagnitudePruner(net, x, importance=tp.importance.MagnitudeImportance(p=1 if criterion == "l1"
+                                                                                            else 2),
+                                       pruning_ratio=sparsity, ignored_layers=ignored_layers)
+    pruner.step()
+
+    # the pruned network must run, the recurrent state included: two steps after a reset for an RNN
+    with torch.no_grad():
+        if rnn:
+            net.reset_all()
+        for _ in range(2 if rnn else 1):
+            out = net(x)
+            assert out.shape == expected_shape, \
+                f"the pruned network outputs a tensor of shape {tuple(out.shape)} instead of {tuple(expected_shape)}"
+    if rnn:
+        net.reset_all()
+    net.train(training)
+    return net
+
+
+def count_params(net):
+    return sum(p.numel() for p in net.parameters())
+
+
+def test_metrics(trainer, model, data_module):
+    """Accuracy metrics of the test split, as logged by the lightning model"""
+    metrics = trainer.test(model, dataloaders=data_module.test_dataloader(), verbose=False)
+    metrics = metrics[0] if metrics else {}
+    return {key: float(value) for key, value in metrics.items() if "acc" in key.lower()}
+
+
+@torch.no_grad()
+def profile_net(net, x, threads=1, num_iters=50):
+    """Number of parameters, MACs and CPU latency of one forward call"""
+    net = net.cpu().eval()
+    rnn = hasattr(net, "reset_all")
+    if rnn:
+        net.reset_all()
+    torch.set_num_threads(threads)
+    flops = count_flops(net, x)
+    latencies = measure_latency(net, x, num_iters=num_iters, reset=net.reset_all if rnn else None)
+    return {"params": count_params(net), "GMACs": flops / 2e9, "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95))}
+
+
+def main():
+    args = prune_parser().parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    model, hparams = load_lightning_model(args.checkpoint, args.dataset_path)
+    data_module_class = SparseClassificationDataModule if getattr(hparams, "sparse", False) \
+        else get_data_module(hparams.models)
+    data_module = data_module_class(hparams, data_dir=hparams.dataset_path)
+    x = example_input(hparams)
+    accelerator = "cpu" if args.cpu else "gpu"
+
+    trainer = pl.Trainer(accelerator=accelerator, devices=1, logger=False)
+    rows = [{"sparsity": 0., **profile_net(copy.deepcopy(model.net), x, args.threads, args.num_iters),
+             **test_metrics(trainer, model, data_module)}]
+
+    for sparsity in args.sparsity:
+        pruned = copy.deepcopy(model).cpu()
+        prune_net(pruned.net, x, sparsity, args.criterion, args.head)
+        if args.lr is not None:
+            pruned.hparams.lr = args.lr
+        out_directory = os.path.join(args.output_dir, f"sparsity_{int(round(100 * sparsity))}")
+        os.makedirs(out_directory, exist_ok=True)
+        trainer = pl.Trainer(default_root_dir=out_directory, accelerator=accelerator, devices=1, logger=False,
+                             enable_checkpointing=False, max_epochs=args.epochs,
+                             limit_train_batches=args.limit_train_batches, num_sanity_val_steps=0)
+        trainer.fit(pruned, data_module)
+        metrics = test_metrics(trainer, pruned, data_module)
+
+        pruned = pruned.cpu()
+        # the pruned architecture can't be rebuilt from the hyperparameters, the whole module is saved
+        torch.save(pruned.net, os.path.join(out_directory, "pruned_net.pt"))
+        export_classifier(pruned, out_directory, tseq=1, batch_size=1)
+        rows.append({"sparsity": sparsity, **profile_net(copy.deepcopy(pruned.net), x, args.threads, args.num_iters),
+                     **metrics})
+
+    fieldnames = []
+    for row in rows:
+        fieldnames += [key for key in row if key not in fieldnames]
+    with open(os.path.join(args.output_dir, "pruning_report.csv"), "w", newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    header = f"{'sparsity':>9}{'params':>12}{'GMACs':>9}{'p50 ms':>9}{'p95 ms':>9}  accuracy"
+    print(header + "\n" + "-" * len(header))
+    for row in rows:
+        accuracy = " ".join(f"{key}={value:.4f}" for key, value in row.items() if "acc" in key.lower())
+        print(f"{row['sparsity']:>9.2f}{row['params']:>12}{row['GMACs']:>9.3f}{row['p50_ms']:>9.2f}"
+              f"{row['p95_ms']:>9.2f}  {accuracy}")
+
+
+if __name__ == '__main__':
+    main()
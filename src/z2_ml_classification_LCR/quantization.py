@@ -0,0 +1,107 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Post-training INT8 quantization of the classifiers, for CPU-only targets
+
+- dynamic: the weights of the Linear, LSTM and GRU layers are stored in int8 and their activations are quantized on
+  the fly. It needs no data and applies to every model, but the convolutions stay in float32.
+- static: the weights and activations of the whole network, convolutions included, are quantized with scales
+  calibrated on a few training feature files. The model is traced with torch.fx, which isn't possible for the
+  recurrent models, so it is only available for feedforward models.
+
+The quantized model is compared with the float one on held-out feature files before being exported.
+"""
+
+import glob
+import os
+
+import numpy as np
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from sparse_hdf5 import make_hdf5_iterator
+
+QUANTIZATION_MODES = ("dynamic", "static")
+DYNAMIC_MODULES = {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU}
+
+
+def quantized_engine():
+    """Quantized kernels of the CPU: fbgemm on x86, qnnpack on ARM"""
+    engines = torch.backends.quantized.supported_engines
+    return "fbgemm" if "fbgemm" in engines else "qnnpack"
+
+
+def feature_files(dataset_path, split, num_files):
+    """Returns the first num_files feature files of a split of the dataset, in a stable order"""
+    paths = sorted(glob.glob(os.path.join(dataset_path, split, "*.h5")))
+    assert paths, f"no feature file in {os.path.join(dataset_path, split)}"
+    return paths[:num_files]
+
+
+def model_inputs(paths, params, rnn, roi=None, max_frames=200):
+    """Yields the inputs of the model computed from feature files, at most max_frames per file
+
+    The inputs of an RNN are single timeslices of shape (1, 1, C, H, W) fed in order, a new file starting with a
+    None item so that the state can be reset. The inputs of a feedforward model are num_ev_reps consecutive
+    timeslices concatenated along the channels.
+    """
+    num_ev_reps = 1 if rnn else params.get("num_ev_reps", 1)
+    for path in paths:
+        if rnn:
+            yield None
+        frames = []
+        iterator = make_hdf5_iterator(path, height=params["height"], width=params["width"])
+        for i, tensor in enumerate(iterator):
+            if i >= max_frames:
+                break
+            if roi is not None:
+                tensor = roi(tensor)
+            if rnn:
+                yield tensor[None].float()
+                continue
+            frames.append(tensor.float())
+            if len(frames) == num_ev_reps:
+                yield torch.cat(frames, dim=1)
+                frames = []
+
+
+def quantize_dynamic_classifier(classifier):
+    return quantize_dynamic(classifier, DYNAMIC_MODULES, dtype=torch.qint8)
+
+
+def quantize_static_classifier(classifier, calibration_inputs, example_input):
+    """Quantizes a feedforward classifier with activation scales observed on the calibration inputs"""
+    qconfig_mapping = get_default_qconfig_mapping(quantized_engine())
+    prepared = prepare_fx(classifier, qconfig_mapping, example_inputs=(example_input,))
+    with torch.no_grad():
+        for x in calibration_inputs:
+            prepared(x)
+    return convert_fx(prepared)
+
+
+@torch.no_grad()
+def compare_models(float_model, quantized_model, inputs):
+    """Compares the predictions of the quantized model with those of the float model
+
+    Returns:
+        dict: top-1 agreement, mean and max absolute difference of the softmax scores, number of inputs
+    """
+    agreements, diffs = [], []
+    for x in inputs:
+        if x is None:
+            float_model.reset_all()
+            quantized_model.reset_all()
+            continue
+        float_out = float_model(x)
+        float_scores = torch.softmax(float_out.reshape(-1, float_out.shape[-1]), dim=-1)
+        quantized_scores = torch.softmax(quantized_model(x).reshape(float_scores.shape), dim=-1)
+        agreements.append((float_scores.argmax(-1) == quantized_scores.argmax(-1)).float().mean().item())
+        diffs.append((float_scores - quantized_scores).abs().max().item())
+    assert agreements, "no input to compare the models on"
+    return {"agreement": float(np.mean(agreements)), "mean_score_diff": float(np.mean(diffs)),
+            "max_score_diff": float(np.max(diffs)), "num_inputs": len(agreements)}
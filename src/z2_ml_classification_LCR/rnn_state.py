@@ -0,0 +1,159 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Explicit hidden state of the RNN classifiers
+
+The recurrent cells of the exported models keep their state in their `prev_h` (and `prev_c` for LSTM cells)
+attributes, which `reset_all` empties. These functions read and write those attributes, so that the state of a
+stream can be saved, restored after a restart, or swapped with the state of another stream sharing the model.
+
+Example, two cameras classified by one model with batched forward calls:
+
+    sessions = StreamSessions(model)
+    sessions.open("left_camera")
+    sessions.open("right_camera", state=load_state_checkpoint("right_camera.pt")["state"])
+    logits = sessions.forward({"left_camera": tensor_left, "right_camera": tensor_right})
+"""
+
+import os
+
+import torch
+
+STATE_ATTRIBUTES = ("prev_h", "prev_c")
+CHECKPOINT_VERSION = 1
+
+
+def is_stateful(model):
+    return hasattr(model, "reset_all")
+
+
+def get_state(model):
+    """Returns a copy of the hidden state of the model, as a dictionary of tensors
+
+    A cell that hasn't processed any input since its last reset has an empty state.
+    """
+    state = {}
+    for name, module in model.named_modules():
+        for attr in STATE_ATTRIBUTES:
+            if hasattr(module, attr):
+                state[f"{name}.{attr}" if name else attr] = getattr(module, attr).detach().clone()
+    return state
+
+
+def set_state(model, state):
+    """Loads a hidden state returned by get_state in the model"""
+    modules = dict(model.named_modules())
+    for key, value in state.items():
+        name, _, attr = key.rpartition(".")
+        assert name in modules and hasattr(modules[name], attr), f"the model has no state {key}"
+        setattr(modules[name], attr, value)
+
+
+def empty_state(model):
+    """Returns the state of the model after reset_all, without changing its current state"""
+    current = get_state(model)
+    model.reset_all()
+    empty = get_state(model)
+    set_state(model, current)
+    return empty
+
+
+def save_state_checkpoint(path, state, **metadata):
+    """Saves a hidden state and its metadata (e.g. the timestamp of the last processed event)
+
+    The file is written next to its destination and then renamed, so that a crash never leaves a partial
+    checkpoint.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    torch.save({"version": CHECKPOINT_VERSION, "state": {key: value.cpu() for key, value in state.items()},
+                "metadata": metadata}, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_state_checkpoint(path, device=torch.device("cpu")):
+    """Returns a dictionary with the "state" and "metadata" saved by save_state_checkpoint"""
+    checkpoint = torch.load(path, map_location=device)
+    assert checkpoint.get("version") == CHECKPOINT_VERSION, f"{path} isn't a hidden state checkpoint"
+    return checkpoint
+
+
+class StreamSessions(object):
+    """Hidden states of several streams sharing one classifier
+
+    The states are swapped in the model around each forward call, which classifies one timeslice of every given
+    stream in a single batch. Feedforward models have no state and are simply batched.
+
+    Args:
+        model (torch.jit.ScriptModule): the classifier
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.rnn = is_stateful(model)
+        self.empty = empty_state(model) if self.rnn else {}
+        self.states = {}
+        self.metadata = {}
+
+    def open(self, stream_id, state=None, **metadata):
+        """Adds a stream, with an empty state or the one given"""
+        self.states[stream_id] = dict(state) if state is not None else dict(self.empty)
+        self.metadata[stream_id] = metadata
+
+    def close(self, stream_id):
+        del self.states[stream_id]
+        del self.metadata[stream_id]
+
+    def reset(self, stream_id):
+        self.states[stream_id] = dict(self.empty)
+
+    def save(self, stream_id, path, **metadata):
+        self.metadata[stream_id].update(metadata)
+        save_state_checkpoint(path, self.states[stream_id], stream_id=stream_id, **self.metadata[stream_id])
+
+    def load(self, stream_id, path):
+        """Opens a stream with the state saved by `save`, returns its metadata"""
+        device = next(self.model.parameters()).device
+        checkpoint = load_state_checkpoint(path, device)
+        self.open(stream_id, checkpoint["state"], **checkpoint["metadata"])
+        return checkpoint["metadata"]
+
+    def _batch_state(self, stream_ids):
+        state = {}
+        for key in self.empty:
+            tensors = [self.states[stream_id][key] for stream_id in stream_ids]
+            initialized = [tensor for tensor in tensors if tensor.numel() > 0]
+            if not initialized:
+                # the cells create a zero state of the right size from their first input
+                state[key] = self.empty[key]
+                continue
+            state[key] = torch.cat([tensor if tensor.numel() > 0 else torch.zeros_like(initialized[0])
+                                    for tensor in tensors], dim=0)
+        return state
+
+    @torch.no_grad()
+    def forward(self, tensors):
+        """Classifies one input per stream
+
+        Args:
+            tensors (dict): stream id -> input tensor of shape (T, C, H, W) for an RNN or (1, C, H, W) for a
+                feedforward model, as yielded by the preprocessing iterators
+
+        Returns:
+            dict: stream id -> logits of shape (T, num_classes) for an RNN or (num_classes,)
+        """
+        stream_ids = list(tensors)
+        if not self.rnn:
+            out = self.model(torch.cat([tensors[stream_id] for stream_id in stream_ids], dim=0))
+            return {stream_id: out[i] for i, stream_id in enumerate(stream_ids)}
+
+        set_state(self.model, self._batch_state(stream_ids))
+        out = self.model(torch.stack([tensors[stream_id] for stream_id in stream_ids], dim=1))
+        batched = get_state(self.model)
+        for i, stream_id in enumerate(stream_ids):
+            self.states[stream_id] = {key: value[i:i + 1] for key, value in batched.items()}
+        return {stream_id: out[:, i] for i, stream_id in enumerate(stream_ids)}
@@ -0,0 +1,119 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Region of interest cropping and binning of the tensors given to the classifier
+"""
+
+import glob
+
+import numpy as np
+import torch
+
+# resolution in which the bounding boxes of the labelling tools are drawn (EVK4)
+LABEL_HEIGHT = 720
+LABEL_WIDTH = 1280
+
+
+class Roi(object):
+    """Crops a region of the model input and optionally bins it
+
+    The coordinates are given in the model input resolution (the height and width of the model json).
+    Binning averages bin x bin pixels, so that the values stay in the range the model was trained on.
+
+    Args:
+        x (int): left column of the region
+        y (int): top row of the region
+        width (int): width of the region
+        height (int): height of the region
+        bin (int): binning factor, 1 to only crop
+    """
+
+    def __init__(self, x, y, width, height, bin=1):
+        assert width % bin == 0 and height % bin == 0, "the region size should be a multiple of the binning factor"
+        self.x = int(x)
+        self.y = int(y)
+        self.width = int(width)
+        self.height = int(height)
+        self.bin = int(bin)
+
+    @classmethod
+    def from_dict(cls, dic):
+        return None if not dic else cls(dic["x"], dic["y"], dic["width"], dic["height"], dic.get("bin", 1))
+
+    def to_dict(self):
+        return {"x": self.x, "y": self.y, "width": self.width, "height": self.height, "bin": self.bin}
+
+    @property
+    def output_size(self):
+        """(height, width) of the tensors given to the model"""
+        return self.height // self.bin, self.width // self.bin
+
+    def __call__(self, tensor):
+        """Crops and bins a tensor of shape (..., C, H, W)"""
+        assert self.y + self.height <= tensor.shape[-2] and self.x + self.width <= tensor.shape[-1], \
+            f"ROI {self.to_dict()} is outside of the input of shape {tuple(tensor.shape[-2:])}"
+        out = tensor[..., self.y:self.y + self.height, self.x:self.x + self.width]
+        if self.bin > 1:
+            shape = out.shape
+            out = torch.nn.functional.avg_pool2d(out.reshape((-1,) + tuple(shape[-3:])).float(), self.bin)
+            out = out.reshape(tuple(shape[:-2]) + tuple(out.shape[-2:]))
+        return out
+
+    def __repr__(self):
+        return f"Roi({self.to_dict()})"
+
+
+def roi_from_bbox_labels(paths, input_height, input_width, label_height=LABEL_HEIGHT, label_width=LABEL_WIDTH,
+                         margin=0.1, quantile=0.01, bin=1, align=8):
+    """Learns a region of interest from the bounding boxes of `*_bbox.npy` label files
+
+    The region covers the boxes of all the files, ignoring the `quantile` most extreme coordinates on each side,
+    enlarged by `margin` times its size, converted to the model input resolution and aligned on multiples of
+    `align` * `bin` pixels so that the strided layers of the model see the same grid.
+
+    Args:
+        paths (list or str): label files or glob pattern
+        input_height (int): height of the model input
+        input_width (int): width of the model input
+        label_height (int): height of the frames on which the boxes were drawn
+        label_width (int): width of the frames on which the boxes were drawn
+        margin (float): relative margin added around the boxes
+        quantile (float): fraction of outlying box coordinates ignored on each side
+        bin (int): binning factor of the returned Roi
+        align (int): the region is aligned on multiples of align * bin pixels
+
+    Returns:
+        Roi: the region of interest in the model input resolution
+    """
+    paths = sorted(glob.glob(paths)) if isinstance(paths, str) else list(paths)
+    boxes = [np.load(path) for path in paths]
+    boxes = np.concatenate([b for b in boxes if len(b)]) if any(len(b) for b in boxes) else None
+    assert boxes is not None, f"no bounding box found in {paths}"
+    x0 = np.quantile(boxes["x"], quantile)
+    y0 = np.quantile(boxes["y"], quantile)
+    x1 = np.quantile(boxes["x"] + boxes["w"], 1 - quantile)
+    y1 = np.quantile(boxes["y"] + boxes["h"], 1 - quantile)
+    dx, dy = margin * (x1 - x0), margin * (y1 - y0)
+    sx, sy = input_width / label_width, input_height / label_height
+    x0, x1 = max((x0 - dx) * sx, 0), min((x1 + dx) * sx, input_width)
+    y0, y1 = max((y0 - dy) * sy, 0), min((y1 + dy) * sy, input_height)
+
+    step = align * bin
+    x0, y0 = int(x0) // step * step, int(y0) // step * step
+    width = min(-(-int(np.ceil(x1 - x0)) // step) * step, (input_width - x0) // step * step)
+    height = min(-(-int(np.ceil(y1 - y0)) // step) * step, (input_height - y0) // step * step)
+    return Roi(x0, y0, width, height, bin=bin)
+
+
+def get_roi(args, model_json):
+    """ROI of the inference script: from --roi, from --roi-labels, or recorded in the model json"""
+    height, width = args.hw if args.hw else (model_json["height"], model_json["width"])
+    if args.roi:
+        return Roi(*args.roi, bin=args.roi_bin)
+    if args.roi_labels:
+        return roi_from_bbox_labels(args.roi_labels, height, width, bin=args.roi_bin)
+    return Roi.from_dict(model_json.get("roi"))
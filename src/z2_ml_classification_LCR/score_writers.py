@@ -0,0 +1,251 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Writers for the classification scores produced by the inference scripts
+
+The streaming sinks write the scores of each frame with its real start and end timestamps as the inference
+goes, flushing them to disk every `batch_size` frames: the memory used doesn't grow with the length of the
+recording and at most one batch is lost on a crash. A resumed inference continues the CSV and HDF5 files from
+the frame of its state checkpoint, the rows of the later frames being dropped; Parquet and Arrow files can't be
+appended to, the resumed frames are written in a new file suffixed with the first frame.
+"""
+
+import os
+import csv
+import numpy as np
+import h5py
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+def save_results_csv(results, csv_path):
+    """Save the results list to a CSV file.
+
+    Args:
+        results (list): one dictionary per frame, with a "frame" key followed by one key per class
+        csv_path (str): output path
+    """
+    fieldnames = list(results[0].keys()) if results else ["frame", "background", "left", "center", "right"]
+    # Create the output directory if it doesn't exist
+    os.makedirs(os.path.dirname(csv_path) or ".", exist_ok=True)
+    with open(csv_path, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for res in results:
+            writer.writerow(res)
+
+
+def save_cls_h5(h5_file, scores, delta_t, attrs):
+    """Writes the classification scores of a whole recording in one go
+
+    The layout is the same as the one produced by the streaming inference: a "cls" dataset of shape
+    (num_frames, num_classes) and the "cls_start_ts"/"cls_end_ts" datasets.
+
+    Args:
+        h5_file (str): output path
+        scores (np.ndarray): array of shape (num_frames, num_classes)
+        delta_t (int): duration of a timeslice in us
+        attrs (dict): attributes of the "cls" dataset
+    """
+    num_frames = len(scores)
+    with h5py.File(h5_file, "w") as f:
+        dset = f.create_dataset("cls", data=scores.astype(np.float16))
+        for key, value in attrs.items():
+            dset.attrs[key] = value
+        f.create_dataset("cls_start_ts", data=np.arange(0, num_frames * delta_t, delta_t), compression="gzip")
+        f.create_dataset("cls_end_ts", data=np.arange(delta_t, num_frames * delta_t + 1, delta_t),
+                         compression="gzip")
+
+
+def scores_to_rows(scores, label_map):
+    """Converts a score array into the rows of the CSV output (one dictionary per frame)"""
+    return [dict(frame=i, **{label: float(score) for label, score in zip(label_map, frame_scores)})
+            for i, frame_scores in enumerate(scores)]
+
+
+class ScoreSink(object):
+    """Base class of the streaming score writers
+
+    Args:
+        path (str): output path
+        label_map (list): class names, in the order of the scores
+        batch_size (int): number of frames buffered before being written
+    """
+
+    def __init__(self, path, label_map, batch_size=256):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.label_map = list(label_map)
+        self.batch_size = batch_size
+        self.num_frames = 0
+        self._frames, self._start_ts, self._end_ts, self._scores = [], [], [], []
+
+    def write(self, frame, start_ts, end_ts, scores):
+        """Adds the scores of one frame, covering the events in [start_ts, end_ts)"""
+        self._frames.append(frame)
+        self._start_ts.append(start_ts)
+        self._end_ts.append(end_ts)
+        self._scores.append(scores)
+        if len(self._frames) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._frames:
+            self._write_batch(np.array(self._frames, dtype=np.int64), np.array(self._start_ts, dtype=np.int64),
+                              np.array(self._end_ts, dtype=np.int64), np.array(self._scores, dtype=np.float32))
+            self.num_frames += len(self._frames)
+        self._frames, self._start_ts, self._end_ts, self._scores = [], [], [], []
+
+    def close(self):
+        self.flush()
+
+    def _write_batch(self, frames, start_ts, end_ts, scores):
+        raise NotImplementedError
+
+
+def _truncate_csv(path, num_frames):
+    """Removes the rows of the frames from num_frames on and a partly written last row, returns the rows kept"""
+    with open(path, "r+", newline='') as f:
+        f.readline()
+        kept, offset = 0, f.tell()
+        for line in iter(f.readline, ""):
+            if not line.endswith("\n") or int(line.split(",", 1)[0]) >= num_frames:
+                break
+            kept, offset = kept + 1, f.tell()
+        f.seek(offset)
+        f.truncate()
+    return kept
+
+
+class CSVScoreSink(ScoreSink):
+    """CSV file with the columns frame, one per class, cls_start_ts and cls_end_ts
+
+    Args:
+        resume_frame (int): if set and the file exists, it is continued from this frame
+        (the other arguments are the ones of ScoreSink)
+    """
+
+    def __init__(self, path, label_map, batch_size=256, resume_frame=None):
+        super().__init__(path, label_map, batch_size)
+        if resume_frame is not None and os.path.isfile(path):
+            self.num_frames = _truncate_csv(path, resume_frame)
+            self.file = open(path, 'a', newline='')
+            self.writer = csv.writer(self.file)
+        else:
+            self.file = open(path, 'w', newline='')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(["frame"] + self.label_map + ["cls_start_ts", "cls_end_ts"])
+
+    def _write_batch(self, frames, start_ts, end_ts, scores):
+        self.writer.writerows([frame] + [float(score) for score in frame_scores] + [start, end]
+                              for frame, frame_scores, start, end in zip(frames.tolist(), scores, start_ts.tolist(),
+                                                                         end_ts.tolist()))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+
+class HDF5ScoreSink(ScoreSink):
+    """HDF5 file with the layout of the inference outputs: "cls", "cls_start_ts" and "cls_end_ts" datasets
+
+    Args:
+        attrs (dict): attributes of the "cls" dataset
+        resume_frame (int): if set and the file exists, it is continued from this frame
+        (the other arguments are the ones of ScoreSink)
+    """
+
+    def __init__(self, path, label_map, batch_size=256, attrs=None, resume_frame=None):
+        super().__init__(path, label_map, batch_size)
+        if resume_frame is not None and os.path.isfile(path):
+            self.file = h5py.File(path, "a")
+            self.cls, self.start_ts, self.end_ts = self.file["cls"], self.file["cls_start_ts"], self.file["cls_end_ts"]
+            self.num_frames = min(len(self.cls), len(self.start_ts), len(self.end_ts), resume_frame)
+            for dset in (self.cls, self.start_ts, self.end_ts):
+                dset.resize(self.num_frames, axis=0)
+            return
+        self.file = h5py.File(path, "w")
+        num_classes = len(self.label_map)
+        self.cls = self.file.create_dataset("cls", shape=(0, num_classes), maxshape=(None, num_classes),
+                                            dtype=np.float16, chunks=(batch_size, num_classes))
+        for key, value in (attrs or {}).items():
+            self.cls.attrs[key] = value
+        self.start_ts = self.file.create_dataset("cls_start_ts", shape=(0,), maxshape=(None,), dtype=np.int64,
+                                                 chunks=(batch_size,), compression="gzip")
+        self.end_ts = self.file.create_dataset("cls_end_ts", shape=(0,), maxshape=(None,), dtype=np.int64,
+                                               chunks=(batch_size,), compression="gzip")
+
+    def _write_batch(self, frames, start_ts, end_ts, scores):
+        start, end = self.num_frames, self.num_frames + len(frames)
+        for dset, data in ((self.cls, scores.astype(np.float16)), (self.start_ts, start_ts), (self.end_ts, end_ts)):
+            dset.resize(end, axis=0)
+            dset[start:end] = data
+        self.file.flush()
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+
+class ArrowScoreSink(ScoreSink):
+    """Parquet (.parquet) or Arrow IPC stream (.arrow) file, each batch being a row group or record batch
+
+    An Arrow stream stays readable up to its last batch after a crash, a Parquet file needs to be closed.
+
+    Args:
+        resume_frame (int): if set and the file exists, the frames are written in <name>_<resume_frame><ext>
+        (the other arguments are the ones of ScoreSink)
+    """
+
+    def __init__(self, path, label_map, batch_size=256, resume_frame=None):
+        assert pa is not None, "pyarrow is required to write Parquet or Arrow files"
+        if resume_frame is not None and os.path.isfile(path):
+            path = f"{os.path.splitext(path)[0]}_{resume_frame}{os.path.splitext(path)[1]}"
+        super().__init__(path, label_map, batch_size)
+        self.schema = pa.schema([("frame", pa.int64())] + [(label, pa.float32()) for label in self.label_map] +
+                                [("cls_start_ts", pa.int64()), ("cls_end_ts", pa.int64())])
+        if path.endswith(".parquet"):
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            self.sink = pa.OSFile(path, "wb")
+            self.writer = pa.ipc.new_stream(self.sink, self.schema)
+
+    def _write_batch(self, frames, start_ts, end_ts, scores):
+        columns = [frames] + [scores[:, i] for i in range(len(self.label_map))] + [start_ts, end_ts]
+        batch = pa.RecordBatch.from_arrays([pa.array(column) for column in columns], schema=self.schema)
+        if isinstance(self.writer, pq.ParquetWriter):
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+            self.sink.flush()
+
+    def close(self):
+        super().close()
+        self.writer.close()
+        if not self.path.endswith(".parquet"):
+            self.sink.close()
+
+
+def make_score_sink(path, label_map, batch_size=256, attrs=None, resume_frame=None):
+    """Returns the sink writing the format given by the extension of path: .csv, .h5, .parquet or .arrow
+
+    With resume_frame, the frames written before a crash are kept up to this frame (see the sinks).
+    """
+    ext = os.path.splitext(path)[1]
+    if ext == ".csv":
+        return CSVScoreSink(path, label_map, batch_size, resume_frame=resume_frame)
+    if ext in (".h5", ".hdf5"):
+        return HDF5ScoreSink(path, label_map, batch_size, attrs=attrs, resume_frame=resume_frame)
+    if ext in (".parquet", ".arrow"):
+        return ArrowScoreSink(path, label_map, batch_size, resume_frame=resume_frame)
+    raise ValueError(f"unknown score format {ext}, expected .csv, .h5, .parquet or .arrow")
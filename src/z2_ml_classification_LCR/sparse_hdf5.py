@@ -0,0 +1,302 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Reading of sparse HDF5 feature files, written by labelling_tools/generate_hdf5.py --sparse
+
+A sparse file stores the nonzero voxels of each timeslice in CSR form along time:
+ - "indices" (uint32): flat index c * H * W + y * W + x of each nonzero voxel
+ - "values": value of each nonzero voxel
+ - "offsets" (uint64): the voxels of timeslice i are indices[offsets[i]:offsets[i + 1]]
+The attributes of the dense "data" dataset (events_to_tensor, delta_t, shape, ...) are set on the root group,
+together with format="sparse_csr". The dense tensors are only built on the target device, when they are read.
+
+train_classification.py --sparse trains the RNN models from a dataset of sparse files, with
+SparseClassificationDataModule.
+"""
+
+import glob
+import json
+import os
+import random
+
+import h5py
+import numpy as np
+import pytorch_lightning as pl
+import torch
+from metavision_ml.data import HDF5Iterator
+
+SPARSE_FORMAT = "sparse_csr"
+# attributes of a sparse file which aren't preprocess_kwargs
+SPARSE_ATTRS = ("format", "events_to_tensor", "delta_t", "event_input_height", "event_input_width", "shape",
+                "store_as_uint8", "mode", "n_events")
+
+
+def _attr_str(value):
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def is_sparse_hdf5(path):
+    """Returns True if path is a sparse feature file"""
+    with h5py.File(path, "r") as f:
+        return _attr_str(f.attrs.get("format", "")) == SPARSE_FORMAT
+
+
+class SparseHDF5Reader(object):
+    """Random access to the timeslices of a sparse feature file
+
+    Args:
+        path (str): path to the sparse HDF5 file
+        device (torch.device): device of the dense tensors
+        height (int): if set with width, the tensors are resized to (height, width)
+        width (int): if set with height, the tensors are resized to (height, width)
+    """
+
+    def __init__(self, path, device=torch.device("cpu"), height=None, width=None):
+        self.path = path
+        self.device = device
+        self.file = h5py.File(path, "r")
+        assert _attr_str(self.file.attrs.get("format", "")) == SPARSE_FORMAT, f"{path} is not a sparse feature file"
+        self.attrs = dict(self.file.attrs)
+        self.shape = tuple(int(d) for d in self.attrs["shape"])
+        self.offsets = self.file["offsets"][...].astype(np.int64)
+        self.indices = self.file["indices"]
+        self.values = self.file["values"]
+        self.dtype = torch.from_numpy(np.zeros(0, dtype=self.values.dtype)).dtype
+        self.height = height
+        self.width = width
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def dense(self, start, stop):
+        """Returns the timeslices [start, stop) as a dense tensor of shape (stop - start, C, H, W)"""
+        start, stop = max(start, 0), min(stop, len(self))
+        num_frames = max(stop - start, 0)
+        frame_size = int(np.prod(self.shape))
+        out = torch.zeros(num_frames * frame_size, dtype=self.dtype, device=self.device)
+        lo, hi = (self.offsets[start], self.offsets[stop]) if num_frames else (0, 0)
+        if hi > lo:
+            indices = torch.from_numpy(self.indices[lo:hi].astype(np.int64)).to(self.device)
+            values = torch.from_numpy(self.values[lo:hi]).to(self.device)
+            # frame of each voxel, from the offsets of the requested timeslices
+            counts = torch.from_numpy(np.diff(self.offsets[start:stop + 1])).to(self.device)
+            frames = torch.repeat_interleave(torch.arange(num_frames, device=self.device), counts)
+            out[frames * frame_size + indices] = values
+        out = out.view((num_frames,) + self.shape)
+        if self.height is not None and self.width is not None and (self.height, self.width) != self.shape[1:] \
+                and num_frames:
+            out = torch.nn.functional.interpolate(out.float(), size=(self.height, self.width), mode="area")
+        return out
+
+    def checks(self, preprocess, delta_t):
+        """Same checks as HDF5Iterator.checks"""
+        assert _attr_str(self.attrs["events_to_tensor"]) == preprocess, \
+            f"{self.path} was computed with {_attr_str(self.attrs['events_to_tensor'])} instead of {preprocess}"
+        assert int(self.attrs["delta_t"]) == delta_t, \
+            f"{self.path} was computed with delta_t={int(self.attrs['delta_t'])} instead of {delta_t}"
+
+    def close(self):
+        self.file.close()
+
+
+class SparseHDF5Iterator(object):
+    """Drop-in replacement of HDF5Iterator for sparse feature files
+
+    Yields dense tensors of shape (num_tbins, C, H, W), the last one can be shorter.
+
+    Args:
+        path (str): path to the sparse HDF5 file
+        num_tbins (int): number of timeslices per tensor
+        device (torch.device): device of the tensors
+        height (int): input height of the model
+        width (int): input width of the model
+    """
+
+    def __init__(self, path, num_tbins=1, device=torch.device("cpu"), height=None, width=None):
+        self.reader = SparseHDF5Reader(path, device=device, height=height, width=width)
+        self.num_tbins = num_tbins
+
+    def checks(self, preprocess, delta_t):
+        self.reader.checks(preprocess, delta_t)
+
+    def __len__(self):
+        return (len(self.reader) + self.num_tbins - 1) // self.num_tbins
+
+    def __iter__(self):
+        for start in range(0, len(self.reader), self.num_tbins):
+            yield self.reader.dense(start, start + self.num_tbins)
+
+
+def make_hdf5_iterator(path, num_tbins=1, device=torch.device("cpu"), height=None, width=None):
+    """Returns a SparseHDF5Iterator for sparse feature files and an HDF5Iterator otherwise"""
+    cls = SparseHDF5Iterator if is_sparse_hdf5(path) else HDF5Iterator
+    return cls(path, num_tbins=num_tbins, device=device, height=height, width=width)
+
+
+def infer_sparse_preprocessing(path):
+    """Preprocessing of a sparse feature file, as infer_preprocessing returns it for the dense files
+
+    Returns:
+        (preprocess_dim, preprocess, delta_t, mode, n_events, preprocess_kwargs)
+    """
+    with h5py.File(path, "r") as f:
+        attrs = dict(f.attrs)
+    preprocess_kwargs = {}
+    for key, value in attrs.items():
+        if key in SPARSE_ATTRS:
+            continue
+        value = _attr_str(value) if isinstance(value, (bytes, np.bytes_, str)) else value
+        preprocess_kwargs[key] = value.item() if isinstance(value, np.generic) else value
+    return (tuple(int(d) for d in attrs["shape"]), _attr_str(attrs["events_to_tensor"]), int(attrs["delta_t"]),
+            _attr_str(attrs.get("mode", "delta_t")), int(attrs.get("n_events", 0)), preprocess_kwargs)
+
+
+def class_lookup(dataset_path, classes):
+    """Maps the class ids of the label files to the indices of the model, 0 being the background
+
+    The names of the class ids are read from the label_map_dictionary.json of the dataset, and the classes
+    which are not part of `classes` are mapped to -1 (unlabeled).
+    """
+    with open(os.path.join(dataset_path, "label_map_dictionary.json"), "r") as f:
+        label_map = json.load(f)
+    return {int(class_id): classes.index(name) + 1 if name in classes else -1
+            for class_id, name in label_map.items()}
+
+
+def load_timeslice_labels(label_path, num_frames, delta_t, lookup, use_label_freq=True):
+    """Label of each timeslice of a feature file, from the `*_bbox.npy` file of its recording
+
+    A timeslice takes the class of the last box of its time interval. Timeslices without box are background if
+    use_label_freq is True, and unlabeled otherwise.
+
+    Returns:
+        labels (np.ndarray): class index of each timeslice
+        is_labeled (np.ndarray): False for the timeslices to ignore in the loss
+    """
+    labels = np.zeros(num_frames, dtype=np.int64)
+    is_labeled = np.full(num_frames, use_label_freq, dtype=bool)
+    boxes = np.load(label_path) if os.path.exists(label_path) else np.zeros(0, dtype=[("t", "<i8"),
+                                                                                      ("class_id", "<u4")])
+    frames = boxes["t"] // delta_t
+    keep = (frames >= 0) & (frames < num_frames)
+    for frame, class_id in zip(frames[keep], boxes["class_id"][keep]):
+        label = lookup.get(int(class_id), -1)
+        labels[frame] = max(label, 0)
+        is_labeled[frame] = label >= 0
+    return labels, is_labeled
+
+
+class SparseSequenceDataset(torch.utils.data.IterableDataset):
+    """Batches of consecutive sequences of timeslices from sparse feature files, for the RNN models
+
+    As with the sequential dataloader of the dense files, each of the batch_size slots of a batch reads its own
+    files one after the other, num_tbins timeslices at a time, so that the model keeps its memory from one
+    batch to the next. Each batch is a dictionary with:
+     - "inputs": dense tensor of shape (num_tbins, batch_size, C, H, W)
+     - "labels": class index of each timeslice, of shape (num_tbins, batch_size)
+     - "frame_is_labeled": False for the timeslices ignored by the loss, padding included
+     - "mask_keep_memory": 0 for the slots starting a new file, whose memory must be reset
+    The labels are read from the `<recording>_bbox.npy` file next to each feature file.
+
+    Args:
+        paths (list): paths to the sparse HDF5 files
+        num_tbins (int): number of timeslices per sequence
+        batch_size (int): number of sequences per batch
+        lookup (dict): class index of each class id of the label files, see class_lookup
+        use_label_freq (bool): if False, only the timeslices with a box are labeled
+        height (int): if set with width, the tensors are resized to (height, width)
+        width (int): if set with height, the tensors are resized to (height, width)
+    """
+
+    def __init__(self, paths, num_tbins, batch_size, lookup, use_label_freq=True, height=None, width=None):
+        self.paths = list(paths)
+        self.num_tbins = num_tbins
+        self.batch_size = batch_size
+        self.lookup = lookup
+        self.use_label_freq = use_label_freq
+        self.height = height
+        self.width = width
+
+    def shuffle(self):
+        random.shuffle(self.paths)
+
+    def _sequences(self, paths):
+        for path in paths:
+            reader = SparseHDF5Reader(path, height=self.height, width=self.width)
+            label_path = os.path.splitext(path)[0] + "_bbox.npy"
+            labels, is_labeled = load_timeslice_labels(label_path, len(reader), int(reader.attrs["delta_t"]),
+                                                       self.lookup, self.use_label_freq)
+            try:
+                for start in range(0, len(reader), self.num_tbins):
+                    yield (reader.dense(start, start + self.num_tbins), labels[start:start + self.num_tbins],
+                           is_labeled[start:start + self.num_tbins], start > 0)
+            finally:
+                reader.close()
+
+    def __iter__(self):
+        slots = [self._sequences(self.paths[i::self.batch_size]) for i in range(self.batch_size)]
+        while True:
+            items = [next(slot, None) for slot in slots]
+            if all(item is None for item in items):
+                return
+            frame_shape = next(item[0].shape[1:] for item in items if item is not None)
+            inputs = torch.zeros((self.num_tbins, self.batch_size) + tuple(frame_shape))
+            labels = torch.zeros((self.num_tbins, self.batch_size), dtype=torch.long)
+            frame_is_labeled = torch.zeros((self.num_tbins, self.batch_size), dtype=torch.bool)
+            mask_keep_memory = torch.zeros(self.batch_size)
+            for b, item in enumerate(items):
+                if item is None:
+                    continue
+                frames, frame_labels, frame_is_labeled_b, keep_memory = item
+                # the end of a file shorter than num_tbins is padded with unlabeled empty timeslices
+                inputs[:len(frames), b] = frames
+                labels[:len(frames), b] = torch.from_numpy(frame_labels)
+                frame_is_labeled[:len(frames), b] = torch.from_numpy(frame_is_labeled_b)
+                mask_keep_memory[b] = float(keep_memory)
+            yield {"inputs": inputs, "labels": labels, "frame_is_labeled": frame_is_labeled,
+                   "mask_keep_memory": mask_keep_memory}
+
+
+class SparseClassificationDataModule(pl.LightningDataModule):
+    """Data module of the RNN classifiers reading the sparse feature files of a dataset
+
+    The dataset has the layout of the dense one: train, val and test folders of sparse HDF5 files with their
+    `*_bbox.npy` labels, and a label_map_dictionary.json. The batches are built in the main process, densifying
+    the few nonzero voxels of a timeslice being much cheaper than reading a dense frame.
+
+    Args:
+        params (argparse.Namespace): training parameters (num_tbins, batch_size, classes, height, width,
+            use_label_freq, train_plus_val)
+        data_dir (str): dataset folder
+    """
+
+    def __init__(self, params, data_dir):
+        super().__init__()
+        self.params = params
+        self.data_dir = data_dir
+        self.lookup = class_lookup(data_dir, list(params.classes))
+
+    def _files(self, *splits):
+        return sorted(path for split in splits for path in glob.glob(os.path.join(self.data_dir, split, "*.h5")))
+
+    def _dataloader(self, paths, batch_size=None):
+        dataset = SparseSequenceDataset(paths, self.params.num_tbins, batch_size or self.params.batch_size,
+                                        self.lookup, use_label_freq=self.params.use_label_freq,
+                                        height=self.params.height, width=self.params.width)
+        return torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=0)
+
+    def train_dataloader(self):
+        splits = ("train", "val") if self.params.train_plus_val else ("train",)
+        dataloader = self._dataloader(self._files(*splits))
+        dataloader.dataset.shuffle()
+        return dataloader
+
+    def val_dataloader(self):
+        return self._dataloader(self._files("val"))
+
+    def test_dataloader(self):
+        return self._dataloader(self._files("test"))
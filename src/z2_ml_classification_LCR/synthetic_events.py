@@ -0,0 +1,200 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Synthetic CD event streams shaped like the left / center / right hand swipe recordings
+
+A hand is modelled as the edge of a disk. During a swipe it crosses the field of view towards the left or the
+right, or grows in the middle of it for center (hand pushed towards the camera), generating ON events on its
+leading edge and OFF events on its trailing edge. Swipes are separated by idle periods with background noise
+only.
+
+Example:
+python3 synthetic_events.py synthetic_right.raw --gesture right --rate 5 --duration 10
+"""
+
+import argparse
+import os
+
+import numpy as np
+from metavision_core.event_io import DatWriter
+from metavision_sdk_base import EventCD
+
+GESTURES = ("left", "center", "right", "background", "mixed")
+
+
+class SyntheticEventsIterator(object):
+    """Iterator of synthetic event arrays, one per delta_t, with the interface of EventsIterator
+
+    Args:
+        gesture (str): left, center, right, background (noise only) or mixed (left, center and right in turn)
+        delta_t (int): duration of each event array in us
+        start_ts (int): timestamp in us of the first event array, the stream is the same as from 0 from there on
+        duration (int): duration of the stream in us
+        event_rate (float): rate of the hand events during a swipe, in events per second
+        noise_rate (float): rate of the background noise events, in events per pixel per second
+        height (int): sensor height
+        width (int): sensor width
+        swipe_duration (int): duration of a swipe in us
+        idle_duration (int): duration of the idle periods between two swipes in us
+        seed (int): seed of the random generators, the same seed gives the same stream
+    """
+
+    def __init__(self, gesture="mixed", delta_t=10000, duration=10000000, event_rate=5e6, noise_rate=0.1,
+                 height=720, width=1280, swipe_duration=600000, idle_duration=900000, seed=0, start_ts=0):
+        assert gesture in GESTURES, f"gesture should be one of {GESTURES}"
+        self.gesture = gesture
+        self.delta_t = delta_t
+        self.duration = duration
+        self.event_rate = event_rate
+        self.noise_rate = noise_rate
+        self.height = height
+        self.width = width
+        self.swipe_duration = swipe_duration
+        self.idle_duration = idle_duration
+        self.seed = seed
+        self.start_ts = start_ts
+        self.current_time = start_ts
+
+    def get_size(self):
+        return self.height, self.width
+
+    def get_current_time(self):
+        return self.current_time
+
+    def hand(self, t):
+        """State of the hand at the timestamps t
+
+        Returns:
+            active (np.ndarray): True during a swipe
+            cx, cy, radius (np.ndarray): position and radius of the hand in pixels
+            direction (np.ndarray): 0 for a horizontal motion to the left, 1 to the right, 2 for a growing hand
+        """
+        period = self.idle_duration + self.swipe_duration
+        cycle, phase = np.divmod(t, period)
+        active = (phase >= self.idle_duration) & (self.gesture != "background")
+        u = np.clip((phase - self.idle_duration) / self.swipe_duration, 0, 1)
+        if self.gesture == "mixed":
+            direction = np.array([0, 2, 1])[cycle % 3]
+        else:
+            direction = np.full(t.shape, {"left": 0, "right": 1, "center": 2}.get(self.gesture, 2))
+        h, w = self.height, self.width
+        # horizontal swipes cross 80% of the width, center gestures grow from 5% to 30% of the height
+        cx = np.where(direction == 0, w * (0.9 - 0.8 * u), np.where(direction == 1, w * (0.1 + 0.8 * u), w / 2))
+        cy = np.full(t.shape, h / 2)
+        radius = np.where(direction == 2, h * (0.05 + 0.25 * u), h * 0.2)
+        return active, cx, cy, radius, direction
+
+    def _slice(self, rng, t0, t1):
+        dt_s = (t1 - t0) * 1e-6
+        # hand events, sampled on the edge of the disk at uniform timestamps
+        num_hand = rng.poisson(self.event_rate * dt_s)
+        t_hand = rng.randint(t0, t1, size=num_hand)
+        active, cx, cy, radius, direction = self.hand(t_hand)
+        t_hand, cx, cy, radius, direction = t_hand[active], cx[active], cy[active], radius[active], direction[active]
+        theta = rng.uniform(0, 2 * np.pi, size=len(t_hand))
+        r = radius * (1 + 0.05 * rng.standard_normal(len(t_hand)))
+        x_hand = cx + r * np.cos(theta)
+        y_hand = cy + r * np.sin(theta)
+        # ON events on the leading edge, OFF events on the trailing edge
+        p_hand = np.where(direction == 0, np.cos(theta) < 0, np.where(direction == 1, np.cos(theta) > 0,
+                                                                       r > radius))
+
+        num_noise = rng.poisson(self.noise_rate * self.height * self.width * dt_s)
+        x = np.concatenate((x_hand, rng.uniform(0, self.width, num_noise)))
+        y = np.concatenate((y_hand, rng.uniform(0, self.height, num_noise)))
+        p = np.concatenate((p_hand, rng.randint(0, 2, num_noise).astype(bool)))
+        t = np.concatenate((t_hand, rng.randint(t0, t1, size=num_noise)))
+        keep = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        order = np.argsort(t[keep], kind="stable")
+
+        events = np.empty(len(order), dtype=EventCD)
+        events["x"] = x[keep][order]
+        events["y"] = y[keep][order]
+        events["p"] = p[keep][order]
+        events["t"] = t[keep][order]
+        return events
+
+    def __iter__(self):
+        for t0 in range(self.start_ts // self.delta_t * self.delta_t, self.duration, self.delta_t):
+            t1 = min(t0 + self.delta_t, self.duration)
+            # one generator per event array, so that the stream can start at any of them
+            rng = np.random.RandomState([self.seed, t0 // self.delta_t])
+            events = self._slice(rng, t0, t1)
+            self.current_time = t1
+            yield events
+
+
+def write_evt2_raw(path, events_iterator):
+    """Writes events in a RAW file encoded in EVT 2.0
+
+    Each CD event is a 32 bit word holding its polarity, the 6 low bits of its timestamp and its coordinates,
+    an EVT_TIME_HIGH word giving the upper bits of the timestamp is inserted whenever they change.
+    """
+    height, width = events_iterator.get_size()
+    with open(path, "wb") as f:
+        f.write(f"% evt 2.0\n% format EVT2;height={height};width={width}\n% geometry {width}x{height}\n"
+                f"% end\n".encode())
+        last_time_high = -1
+        for events in events_iterator:
+            if not len(events):
+                continue
+            t = events["t"].astype(np.int64)
+            time_high = t >> 6
+            change = np.empty(len(t), dtype=bool)
+            change[0] = time_high[0] != last_time_high
+            change[1:] = time_high[1:] != time_high[:-1]
+            last_time_high = time_high[-1]
+
+            positions = np.arange(len(t)) + np.cumsum(change)
+            words = np.empty(len(t) + change.sum(), dtype=np.uint32)
+            words[positions[change] - 1] = (0x8 << 28) | (time_high[change] & 0x0FFFFFFF).astype(np.uint32)
+            words[positions] = ((events["p"].astype(np.uint32) & 1) << 28) | ((t & 0x3F).astype(np.uint32) << 22) \
+                | (events["x"].astype(np.uint32) << 11) | events["y"].astype(np.uint32)
+            f.write(words.astype("<u4").tobytes())
+
+
+def write_dat(path, events_iterator):
+    height, width = events_iterator.get_size()
+    writer = DatWriter(path, height=height, width=width)
+    for events in events_iterator:
+        writer.write(events)
+    writer.close()
+
+
+def write_npy(path, events_iterator):
+    np.save(path, np.concatenate(list(events_iterator)))
+
+
+def write_events(path, events_iterator):
+    """Writes the events in a RAW (EVT 2.0), DAT or numpy file, depending on the extension of path"""
+    ext = os.path.splitext(path)[1]
+    writers = {".raw": write_evt2_raw, ".dat": write_dat, ".npy": write_npy}
+    assert ext in writers, f"unknown event file format {ext}, expected .raw, .dat or .npy"
+    writers[ext](path, events_iterator)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic event file shaped like the hand swipe '
+                                                 'recordings', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('output', type=str, help='output file, .raw (EVT 2.0), .dat or .npy')
+    parser.add_argument('--gesture', default="mixed", choices=GESTURES, help='gesture of the stream')
+    parser.add_argument('--rate', type=float, default=5., help='event rate of the hand during a swipe, in Mev/s')
+    parser.add_argument('--noise', type=float, default=0.1, help='background noise in events per pixel per second')
+    parser.add_argument('--duration', type=float, default=10., help='duration of the stream in seconds')
+    parser.add_argument('--size', type=int, nargs=2, default=[720, 1280], metavar=("HEIGHT", "WIDTH"),
+                        help='sensor resolution')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator')
+    args = parser.parse_args()
+
+    events_iterator = SyntheticEventsIterator(args.gesture, duration=int(args.duration * 1e6),
+                                              event_rate=args.rate * 1e6, noise_rate=args.noise,
+                                              height=args.size[0], width=args.size[1], seed=args.seed)
+    write_events(args.output, events_iterator)
+
+
+if __name__ == "__main__":
+    main()
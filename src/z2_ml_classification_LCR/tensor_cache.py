@@ -0,0 +1,243 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+On-disk cache of preprocessed tensor streams
+
+The tensors computed from a recording are stored in a raw binary file, named after a hash of the recording
+content and of the preprocessing parameters. When the same recording is evaluated again with the same
+parameters, the tensors are read back through a memory map and the events are not decoded at all. The end
+timestamp of each tensor, when the iterator computing them tracks the time of the events, is stored alongside.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+
+INDEX_NAME = "index.json"
+LOCK_NAME = "index.lock"
+# bumped when the content of the entries changes, so that the older entries are no longer read
+CACHE_VERSION = 2
+_HASH_BLOCK_SIZE = 1 << 23
+
+
+def file_hash(path):
+    """Returns the hash of the content of a file"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class TensorCache(object):
+    """Content addressed cache of tensor streams with a least recently used eviction policy
+
+    The index (`index.json` in the cache directory) keeps for each entry its shape, dtype, size and
+    last access time. It also remembers the hash of each recording for a given (path, size, mtime) so that
+    large RAW files are only hashed once.
+
+    Args:
+        directory (str): cache directory
+        max_size_bytes (int): when the cache grows above this size, the least recently used entries are removed
+    """
+
+    def __init__(self, directory, max_size_bytes):
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, INDEX_NAME)
+        self._lock_path = os.path.join(directory, LOCK_NAME)
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """Reads the index and saves it back, under a lock shared with the other threads and processes"""
+        with self._lock, open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = {"entries": {}, "file_hashes": {}}
+                if os.path.exists(self._index_path):
+                    with open(self._index_path, "r") as f:
+                        index = json.load(f)
+                yield index
+                tmp_path = self._index_path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(index, f, indent=4, sort_keys=True)
+                os.replace(tmp_path, self._index_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def recording_hash(self, path):
+        """Hash of a recording, computed only when its path, size or modification time changed"""
+        stat = os.stat(path)
+        file_key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        with self._locked_index() as index:
+            digest = index["file_hashes"].get(file_key)
+        if digest is None:
+            digest = file_hash(path)
+            with self._locked_index() as index:
+                index["file_hashes"][file_key] = digest
+        return digest
+
+    def key(self, path, preprocess, preprocess_kwargs, delta_t, height, width, start_ts=0, max_duration=None):
+        """Returns the cache key of the tensor stream of a recording"""
+        params = json.dumps({"recording": self.recording_hash(path), "preprocess": preprocess,
+                             "preprocess_kwargs": preprocess_kwargs, "delta_t": delta_t, "height": height,
+                             "width": width, "start_ts": start_ts, "max_duration": max_duration,
+                             "version": CACHE_VERSION},
+                            sort_keys=True, default=str)
+        return hashlib.blake2b(params.encode(), digest_size=16).hexdigest()
+
+    def _data_path(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    def _timestamps_path(self, key):
+        return os.path.join(self.directory, key + ".ts.npy")
+
+    def get(self, key):
+        """Returns a read-only memory map of shape (num_frames, C, H, W) or None if the key isn't cached"""
+        with self._locked_index() as index:
+            entry = index["entries"].get(key)
+            if entry is None or not os.path.exists(self._data_path(key)):
+                return None
+            entry["last_access"] = time.time()
+        if entry["shape"][0] == 0:
+            return np.zeros(entry["shape"], dtype=entry["dtype"])
+        return np.memmap(self._data_path(key), dtype=entry["dtype"], mode="r", shape=tuple(entry["shape"]))
+
+    def timestamps(self, key):
+        """Returns the end timestamps of the tensors of a cached stream, None if they weren't stored"""
+        path = self._timestamps_path(key)
+        return np.load(path) if os.path.exists(path) else None
+
+    def writer(self, key):
+        """Returns a writer storing a new tensor stream under `key`"""
+        return _CacheWriter(self, key)
+
+    def _commit(self, key, tmp_path, shape, dtype, timestamps_tmp_path=None):
+        with self._locked_index() as index:
+            os.replace(tmp_path, self._data_path(key))
+            size = os.path.getsize(self._data_path(key))
+            if timestamps_tmp_path is not None:
+                os.replace(timestamps_tmp_path, self._timestamps_path(key))
+                size += os.path.getsize(self._timestamps_path(key))
+            elif os.path.exists(self._timestamps_path(key)):
+                os.remove(self._timestamps_path(key))
+            index["entries"][key] = {"shape": list(shape), "dtype": dtype, "size": size,
+                                     "last_access": time.time()}
+            self._evict(index["entries"])
+
+    def _evict(self, entries):
+        total = sum(entry["size"] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["last_access"]):
+            if total <= self.max_size_bytes:
+                break
+            total -= entries[key]["size"]
+            del entries[key]
+            for path in (self._data_path(key), self._timestamps_path(key)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+class _CacheWriter(object):
+    """Appends tensors to a temporary file, which is added to the cache with their end timestamps by `commit`"""
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.tmp_path = cache._data_path(key) + f".{os.getpid()}.tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.frame_shape = None
+        self.dtype = None
+        self.num_frames = 0
+        self.end_ts = []
+
+    def write(self, tensor, end_ts=None):
+        array = tensor.detach().cpu().numpy()
+        if self.frame_shape is None:
+            self.frame_shape, self.dtype = array.shape, array.dtype.str
+        self.file.write(np.ascontiguousarray(array).tobytes())
+        self.num_frames += 1
+        if end_ts is not None:
+            self.end_ts.append(int(end_ts))
+
+    def commit(self):
+        self.file.close()
+        shape = (self.num_frames,) + tuple(self.frame_shape or ())
+        timestamps_tmp_path = None
+        # the timestamps are only kept when every tensor has one
+        if self.num_frames and len(self.end_ts) == self.num_frames:
+            timestamps_tmp_path = self.tmp_path + ".ts"
+            with open(timestamps_tmp_path, "wb") as f:
+                np.save(f, np.array(self.end_ts, dtype=np.int64))
+        self.cache._commit(self.key, self.tmp_path, shape, self.dtype or np.dtype(np.float32).str,
+                           timestamps_tmp_path)
+
+    def abort(self):
+        self.file.close()
+        for path in (self.tmp_path, self.tmp_path + ".ts"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class CachedTensorIterator(object):
+    """Iterates over the tensors of a recording, reading them from the cache when available
+
+    On a cache miss, the tensors are computed by `make_iterator()` (typically a CDProcessorIterator) and
+    written to the cache, with the end timestamps given by its get_time. The stream is only added to the cache
+    if it was read until the end. get_time returns the end timestamp of the last tensor, None if unknown.
+
+    Args:
+        cache (TensorCache): the cache
+        key (str): key of the tensor stream, see `TensorCache.key`
+        make_iterator (function): returns the iterator computing the tensors on a cache miss
+        device (torch.device): device of the returned tensors
+    """
+
+    def __init__(self, cache, key, make_iterator, device):
+        self.cache = cache
+        self.key = key
+        self.make_iterator = make_iterator
+        self.device = device
+        self.hit = None
+        self.current_time = None
+
+    def get_time(self):
+        return self.current_time
+
+    def __iter__(self):
+        frames = self.cache.get(self.key)
+        self.hit = frames is not None
+        if self.hit:
+            timestamps = self.cache.timestamps(self.key)
+            for i, frame in enumerate(frames):
+                self.current_time = int(timestamps[i]) if timestamps is not None else None
+                yield torch.from_numpy(np.array(frame)).to(self.device)
+            return
+
+        writer = self.cache.writer(self.key)
+        completed = False
+        try:
+            iterator = self.make_iterator()
+            get_time = getattr(iterator, "get_time", None)
+            for tensor in iterator:
+                self.current_time = get_time() if get_time is not None else None
+                writer.write(tensor, self.current_time)
+                yield tensor
+            completed = True
+        finally:
+            if completed:
+                writer.commit()
+            else:
+                writer.abort()
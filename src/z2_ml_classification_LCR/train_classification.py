@@ -40,6 +40,9 @@ import warnings
 import argparse
 from types import SimpleNamespace
 
+from distillation import distillation_class
+from sparse_hdf5 import SparseClassificationDataModule, infer_sparse_preprocessing
+
 
 def autocomplete_params(params: argparse.Namespace):
     """
@@ -79,7 +82,14 @@ def autocomplete_params(params: argparse.Namespace):
         params.forward_label_dict = get_label_forward_map_dict(label_map_path)
         params.backward_label_dict = backward_label_dict
 
-    preprocess_dim, preprocess, delta_t, mode, n_events, preprocess_kwargs = infer_preprocessing(params)
+    if params.sparse:
+        assert is_rnn(params.models), "only the RNN models can be trained from sparse feature files"
+        train_files = sorted(glob.glob(os.path.join(params.dataset_path, "train", "*.h5")))
+        assert len(train_files) > 0, f"no HDF5 file in {os.path.join(params.dataset_path, 'train')}"
+        preprocess_dim, preprocess, delta_t, mode, n_events, preprocess_kwargs = \
+            infer_sparse_preprocessing(train_files[0])
+    else:
+        preprocess_dim, preprocess, delta_t, mode, n_events, preprocess_kwargs = infer_preprocessing(params)
 
     if preprocess_dim is None:
         preprocess_dim, preprocess, delta_t = (6, 240, 320), "event_cube", params.delta_t
@@ -204,6 +214,8 @@ def train_parser():
                         help="if set, train using train+val, test on test")
     parser.add_argument("--shuffle", action="store_false",
                         help="shuffle the input dataset")
+    parser.add_argument("--sparse", action="store_true",
+                        help="the dataset holds sparse feature files (generate_hdf5.py --sparse), RNN models only")
 
     # model params
     parser.add_argument('--models', default='ConvRNNClassifier', type=str, choices=get_model_names(),
@@ -213,6 +225,15 @@ def train_parser():
                         help='growth factor of feature extractor for MobileNet2')
     parser.add_argument('--feature_channels_out', type=int, default=128, help='number of channels per feature-map')
 
+    # distillation params
+    parser.add_argument('--teacher', type=str, default='',
+                        help='checkpoint of a trained model supervising the training with its soft targets, '
+                             'see distillation.py')
+    parser.add_argument('--distill_temperature', type=float, default=4.,
+                        help='temperature softening the scores of the teacher and the student')
+    parser.add_argument('--distill_alpha', type=float, default=0.7,
+                        help='weight of the distillation loss, the loss on the labels is weighted by 1 - alpha')
+
     # display params
     parser.add_argument("--no_window", action="store_true",
                         help="Disable output window during demo (only write a video)")
@@ -260,14 +281,16 @@ def check_params(params):
     train_files = glob.glob(os.path.join(params.dataset_path, "train", '*.h5'))
     assert len(train_files) > 0
     with h5py.File(train_files[0], "r") as f:
-        precomputed_dataset_mode =  f["data"].attrs.get("mode", "delta_t")
+        # the attributes of the sparse files are on their root group
+        attrs = f.attrs if params.sparse else f["data"].attrs
+        precomputed_dataset_mode =  attrs.get("mode", "delta_t")
         assert precomputed_dataset_mode in ["delta_t", "n_events"], "only n_events and delta_t mode are supported."
         if precomputed_dataset_mode == "n_events":
             assert not is_rnn(params.models), "only feed forward models can be trained in n_events mode"
             print("Training in n_events mode!")
         else:
             if not params.allow_labels_interpolation:
-                assert params.label_delta_t <= f["data"].attrs["delta_t"], "label frequency smaller than frame frequency! \
+                assert params.label_delta_t <= attrs["delta_t"], "label frequency smaller than frame frequency! \
                              Consider using option --allow_labels_interpolation." 
 
 def train(params: argparse.Namespace):
@@ -277,16 +300,22 @@ def train(params: argparse.Namespace):
     Every X epochs it creates a demonstration video and computes
     Accuracy metrics.
 
+    With --teacher, the model is a student trained with the soft targets of a trained teacher, e.g. a smaller
+    --feature_base or --height_width than the teacher (see distillation.py).
+
     Otherwise, you need to indicate a valid dataset path with format compatible
-    with metavision_ml/data/sequential_dataset.py (.h5 or .dat files)
+    with metavision_ml/data/sequential_dataset.py (.h5 or .dat files), or with --sparse a dataset of sparse
+    feature files read by sparse_hdf5.py
 
     You can visualize logs with tensorboard:
 
     %tensorboard --log_dir=.
     """
     model_class = get_model_class(params.models)
+    if params.teacher:
+        model_class = distillation_class(model_class)
     model = model_class(params)
-    data_module = get_data_module(params.models)
+    data_module = SparseClassificationDataModule if params.sparse else get_data_module(params.models)
     classif_data = data_module(params, data_dir=params.dataset_path)
 
     # check params compatibility